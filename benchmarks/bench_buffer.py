@@ -0,0 +1,88 @@
+"""
+Compare apply_operation on a plain list of lines against LineBuffer.
+
+Run with ``python benchmarks/bench_buffer.py [--lines N] [--ops N]``.
+"""
+import argparse
+import json
+import random
+import time
+
+from quokka_editor_back.models.operation import Op, OperationType
+from quokka_editor_back.utils.buffer import LineBuffer
+from quokka_editor_back.utils.ot import apply_operation
+
+
+def make_operation(
+    op_type: OperationType, from_pos: tuple[int, int], to_pos: tuple[int, int], text
+) -> Op:
+    return Op(*from_pos, *to_pos, text, op_type, 0)
+
+
+def make_workloads(lines: int, ops: int) -> dict[str, list[Op]]:
+    randomizer = random.Random(0)
+    workloads: dict[str, list[Op]] = {
+        "keystroke": [],
+        "newline + join": [],
+        "paste 20 lines + delete": [],
+    }
+    for _ in range(ops // 2):
+        line = randomizer.randrange(lines // 2)
+        workloads["keystroke"] += [
+            make_operation(OperationType.INPUT, (line, 0), (line, 0), ["x"]),
+            make_operation(OperationType.DELETE, (line, 0), (line, 1), [""]),
+        ]
+        workloads["newline + join"] += [
+            make_operation(OperationType.INPUT, (line, 0), (line, 0), ["", ""]),
+            make_operation(OperationType.DELETE, (line, 0), (line + 1, 0), [""]),
+        ]
+        workloads["paste 20 lines + delete"] += [
+            make_operation(
+                OperationType.PASTE, (line, 0), (line, 0), ["pasted"] * 19 + ["x"]
+            ),
+            make_operation(OperationType.DELETE, (line, 0), (line + 19, 1), [""]),
+        ]
+    return workloads
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def apply_all(content, ops: list[Op]) -> None:
+    for op in ops:
+        apply_operation(content, op)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=200_000)
+    parser.add_argument("--ops", type=int, default=2_000)
+    args = parser.parse_args()
+
+    document = [
+        f"{number:08d} " + "generated content " * 3 for number in range(args.lines)
+    ]
+    encoded = json.dumps(document).encode()
+    print(f"document: {args.lines} lines, {len(encoded) / 1e6:.1f} MB of JSON")
+    print(f"{'workload':<26}{'list[str]':>14}{'LineBuffer':>14}")
+
+    for name, ops in make_workloads(args.lines, args.ops).items():
+        list_time = timed(apply_all, list(document), ops)
+        buffer_time = timed(apply_all, LineBuffer(document), ops)
+        print(
+            f"{name:<26}{list_time / len(ops) * 1e6:>11.1f} us"
+            f"{buffer_time / len(ops) * 1e6:>11.1f} us"
+        )
+
+    decode_time = timed(lambda: LineBuffer(json.loads(encoded)))
+    line_buffer = LineBuffer(document)
+    encode_time = timed(lambda: json.dumps(list(line_buffer)).encode())
+    print(f"{'JSON -> LineBuffer':<26}{decode_time * 1e3:>25.1f} ms")
+    print(f"{'LineBuffer -> JSON':<26}{encode_time * 1e3:>25.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
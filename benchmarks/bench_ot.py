@@ -0,0 +1,165 @@
+"""
+Rebase one operation against a history of committed operations.
+
+"before" is the pydantic-based transform the worker used to run: history
+rows parsed with ``PosSchema.parse_raw`` and a new ``OperationSchema`` built
+for every adjusted position. "after" decodes rows straight into ``Op`` and
+runs ``utils.ot.transform``.
+
+Run with ``python benchmarks/bench_ot.py [--history N] [--repeat N]``.
+"""
+import argparse
+import json
+import random
+import time
+
+from quokka_editor_back.models.operation import (
+    Op,
+    OperationSchema,
+    OperationType,
+    PosSchema,
+)
+from quokka_editor_back.utils.ot import transform
+
+INSERT_TYPES = (OperationType.INPUT, OperationType.PASTE, OperationType.UNDO)
+
+
+def legacy_adjust_position(
+    new_pos: PosSchema, prev_pos: PosSchema, prev_text: str
+) -> PosSchema:
+    if (
+        new_pos.line < prev_pos.line
+        or (new_pos.line == prev_pos.line and new_pos.ch < prev_pos.ch)
+        or (new_pos.line > prev_pos.line)
+    ):
+        return new_pos
+    return PosSchema(line=new_pos.line, ch=new_pos.ch + len(prev_text))
+
+
+def legacy_transform(
+    new_op: OperationSchema, prev_op: OperationSchema
+) -> OperationSchema | None:
+    if new_op.type in INSERT_TYPES and prev_op.type in INSERT_TYPES:
+        return OperationSchema(
+            from_pos=legacy_adjust_position(
+                new_op.from_pos, prev_op.from_pos, prev_op.text[0]
+            ),
+            to_pos=legacy_adjust_position(
+                new_op.to_pos, prev_op.to_pos, prev_op.text[0]
+            ),
+            text=new_op.text,
+            type=new_op.type,
+            revision=new_op.revision,
+        )
+    if new_op.type in INSERT_TYPES and prev_op.type == OperationType.DELETE:
+        if new_op.from_pos.line < prev_op.from_pos.line or (
+            new_op.from_pos.line == prev_op.from_pos.line
+            and new_op.from_pos.ch <= prev_op.from_pos.ch
+        ):
+            return new_op
+        return OperationSchema(
+            from_pos=PosSchema(line=new_op.from_pos.line - 1, ch=new_op.from_pos.ch),
+            to_pos=new_op.to_pos,
+            text=new_op.text,
+            type=new_op.type,
+            revision=new_op.revision,
+        )
+    if new_op.type == OperationType.DELETE and prev_op.type in INSERT_TYPES:
+        return OperationSchema(
+            from_pos=legacy_adjust_position(
+                new_op.from_pos, prev_op.from_pos, prev_op.text[0]
+            ),
+            to_pos=new_op.to_pos,
+            text=new_op.text,
+            type=OperationType.DELETE,
+            revision=new_op.revision,
+        )
+    if new_op.type == OperationType.DELETE and prev_op.type == OperationType.DELETE:
+        return new_op
+
+
+def make_history_rows(size: int) -> list[dict]:
+    randomizer = random.Random(0)
+    rows = []
+    for revision in range(1, size + 1):
+        line = randomizer.randrange(50)
+        ch = randomizer.randrange(40)
+        op_type = randomizer.choice([OperationType.INPUT] * 4 + [OperationType.DELETE])
+        rows.append(
+            {
+                "from_pos": json.dumps({"line": line, "ch": ch}),
+                "to_pos": json.dumps({"line": line, "ch": ch + 1}),
+                "text": json.dumps(["x" if op_type == OperationType.INPUT else ""]),
+                "type": op_type,
+                "revision": revision,
+            }
+        )
+    return rows
+
+
+def rebase_before(op_data: dict, rows: list[dict]) -> OperationSchema | None:
+    new_op = OperationSchema(**op_data)
+    for row in rows:
+        prev_op = OperationSchema(
+            from_pos=PosSchema.parse_raw(row["from_pos"]),
+            to_pos=PosSchema.parse_raw(row["to_pos"]),
+            text=json.loads(row["text"]),
+            type=row["type"],
+            revision=row["revision"],
+        )
+        new_op = legacy_transform(new_op, prev_op)
+    return new_op
+
+
+def rebase_after(op_data: dict, rows: list[dict]) -> Op | None:
+    new_op = Op.from_schema(OperationSchema(**op_data))
+    for row in rows:
+        from_pos = json.loads(row["from_pos"])
+        to_pos = json.loads(row["to_pos"])
+        prev_op = Op(
+            from_pos["line"],
+            from_pos["ch"],
+            to_pos["line"],
+            to_pos["ch"],
+            json.loads(row["text"]),
+            row["type"],
+            row["revision"],
+        )
+        new_op = transform(new_op, prev_op)
+    return new_op
+
+
+def best_of(repeat: int, function, *args) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--history", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_history_rows(args.history)
+    op_data = {
+        "from_pos": {"line": 10, "ch": 5},
+        "to_pos": {"line": 10, "ch": 5},
+        "text": ["y"],
+        "type": OperationType.INPUT,
+        "revision": 0,
+    }
+    assert rebase_before(op_data, rows).dict() == rebase_after(op_data, rows).to_dict()
+
+    before = best_of(args.repeat, rebase_before, op_data, rows)
+    after = best_of(args.repeat, rebase_after, op_data, rows)
+    print(f"rebase against {args.history} operations")
+    print(f"before (pydantic): {before * 1e3:8.2f} ms")
+    print(f"after (Op):        {after * 1e3:8.2f} ms  ({before / after:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
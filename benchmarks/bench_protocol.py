@@ -0,0 +1,123 @@
+"""
+Compare the JSON and MessagePack websocket protocols on typical streams.
+
+Each stream is a list of server-to-client messages: EXT_CHANGE operations,
+cursor updates and acks. Frames are encoded the way the outboxes send them
+and decoded the way a client would read them.
+
+Run with ``python benchmarks/bench_protocol.py [--messages N]``.
+"""
+import argparse
+import json
+import random
+import time
+
+import msgpack
+
+from quokka_editor_back.models.operation import Op, OperationType
+from quokka_editor_back.schema.websocket import MessageTypeEnum, WireProtocol
+from quokka_editor_back.utils.protocol import encode_frame
+
+USER_TOKEN = "0b7c52f4-6a0e-4f65-9d7a-2c55a3f0b9d1"
+
+
+def change_message(op: Op) -> dict:
+    return {
+        "data": op.to_dict(),
+        "type": MessageTypeEnum.EXT_CHANGE,
+        "user_token": USER_TOKEN,
+        "revision": op.revision,
+    }
+
+
+def cursor_message(line: int, ch: int) -> dict:
+    return {
+        "data": {
+            "type": "cursor",
+            "from_pos": {"line": line, "ch": ch},
+            "to_pos": {"line": line, "ch": ch},
+        },
+        "user_token": USER_TOKEN,
+    }
+
+
+def ack_message(revision: int) -> dict:
+    return {
+        "revision_log": revision,
+        "user_token": USER_TOKEN,
+        "type": MessageTypeEnum.ACKNOWLEDGE,
+    }
+
+
+def make_streams(messages: int) -> dict[str, list[dict]]:
+    randomizer = random.Random(0)
+    streams: dict[str, list[dict]] = {
+        "keystrokes": [],
+        "cursor chatter": [],
+        "paste 20 lines": [],
+        "acks": [],
+    }
+    for revision in range(messages):
+        line, ch = randomizer.randrange(5_000), randomizer.randrange(80)
+        streams["keystrokes"].append(
+            change_message(
+                Op(line, ch, line, ch, ["x"], OperationType.INPUT, revision)
+            )
+        )
+        streams["cursor chatter"].append(cursor_message(line, ch))
+        streams["paste 20 lines"].append(
+            change_message(
+                Op(
+                    line,
+                    0,
+                    line,
+                    0,
+                    ["pasted line of code"] * 20,
+                    OperationType.PASTE,
+                    revision,
+                )
+            )
+        )
+        streams["acks"].append(ack_message(revision))
+    return streams
+
+
+def decode(frame: str | bytes, protocol: WireProtocol):
+    if protocol == WireProtocol.MSGPACK:
+        return msgpack.unpackb(frame)
+    return json.loads(frame)
+
+
+def measure(stream: list[dict], protocol: WireProtocol) -> tuple[float, float, float]:
+    start = time.perf_counter()
+    frames = [encode_frame(message, protocol) for message in stream]
+    encoded = time.perf_counter()
+    for frame in frames:
+        decode(frame, protocol)
+    decoded = time.perf_counter()
+    return (
+        sum(map(len, frames)) / len(frames),
+        (encoded - start) / len(frames) * 1e6,
+        (decoded - encoded) / len(frames) * 1e6,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(
+        f"{'stream':<16}{'protocol':<10}{'frame':>10}{'encode':>12}{'decode':>12}"
+    )
+    for name, stream in make_streams(args.messages).items():
+        for protocol in WireProtocol:
+            size, encode_time, decode_time = measure(stream, protocol)
+            print(
+                f"{name:<16}{protocol:<10}{size:>8.0f} B"
+                f"{encode_time:>9.2f} us{decode_time:>9.2f} us"
+            )
+
+
+if __name__ == "__main__":
+    main()
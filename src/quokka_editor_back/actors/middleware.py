@@ -1,9 +1,17 @@
 import asyncio
+import logging
 
+from dramatiq.asyncio import get_event_loop_thread
+from dramatiq.common import dq_name
 from dramatiq.middleware import Middleware
 from tortoise import Tortoise
+from tortoise.connection import connections
 
 from quokka_editor_back.settings import TORTOISE_ORM
+from quokka_editor_back.utils.redis import close_redis_pool, get_redis, redis_pool
+from quokka_editor_back.utils.sharding import WorkerSlot, slot_queue
+
+logger = logging.getLogger(__name__)
 
 
 class DBConnectionMiddleware(Middleware):
@@ -13,3 +21,100 @@ class DBConnectionMiddleware(Middleware):
 
     async def configure_db(self):
         await Tortoise.init(config=TORTOISE_ORM)
+
+
+class EventLoopResourcesMiddleware(Middleware):
+    """
+    Open the database and Redis pools once, on the worker's event loop.
+
+    Has to come after dramatiq's AsyncIO middleware, which starts the loop
+    before the worker boots and stops it once the worker has shut down.
+    """
+
+    def after_worker_boot(self, broker, worker):
+        get_event_loop_thread().run_coroutine(self.open())
+
+    def before_worker_shutdown(self, broker, worker):
+        get_event_loop_thread().run_coroutine(self.close())
+
+    async def open(self):
+        await Tortoise.init(config=TORTOISE_ORM)
+        redis_pool()
+
+    async def close(self):
+        await close_redis_pool()
+        await connections.close_all()
+
+
+class WorkerSlotMiddleware(Middleware):
+    """
+    Claim a worker slot at boot and consume its queue besides the shared ones.
+
+    Runs on the AsyncIO middleware's event loop, and has to release the slot
+    before EventLoopResourcesMiddleware closes the Redis pool. A worker whose
+    slot is taken over stops consuming its queue and claims a free one.
+    """
+
+    def __init__(self):
+        self.worker_slot: WorkerSlot | None = None
+        self.keep_alive = None
+
+    def after_worker_boot(self, broker, worker):
+        event_loop_thread = get_event_loop_thread()
+        slot = event_loop_thread.run_coroutine(self.claim())
+        # Queues declared later, to send documents to other slots, are not ours
+        worker.consumer_whitelist = set(
+            worker.consumer_whitelist or broker.get_declared_queues()
+        )
+        if slot is None:
+            logger.warning("No free worker slot, consuming the shared queue only")
+            return
+        self.consume_slot(broker, worker, slot)
+        self.keep_alive = asyncio.run_coroutine_threadsafe(
+            self.hold_slot(broker, worker), event_loop_thread.loop
+        )
+
+    def before_worker_shutdown(self, broker, worker):
+        if self.keep_alive is not None:
+            self.keep_alive.cancel()
+        if self.worker_slot is not None:
+            get_event_loop_thread().run_coroutine(self.worker_slot.release())
+
+    async def claim(self) -> int | None:
+        self.worker_slot = WorkerSlot(await get_redis())
+        return await self.worker_slot.claim()
+
+    async def hold_slot(self, broker, worker):
+        while True:
+            lost = await self.worker_slot.keep_alive()
+            self.stop_consuming_slot(worker, lost)
+            if (slot := await self.worker_slot.claim()) is None:
+                logger.warning("No free worker slot, consuming the shared queue only")
+                return
+            logger.info("Moved from worker slot %s to %s", lost, slot)
+            self.consume_slot(broker, worker, slot)
+
+    @staticmethod
+    def consume_slot(broker, worker, slot: int):
+        queue = slot_queue(slot)
+        worker.consumer_whitelist.add(queue)
+        if queue in worker.consumers:
+            # A slot this worker held before
+            for name in (queue, dq_name(queue)):
+                if consumer := worker.consumers.get(name):
+                    consumer.resume()
+        elif queue in broker.get_declared_queues():
+            # Declared to send documents to the slot, so not consumed yet
+            broker.emit_after("declare_queue", queue)
+            broker.emit_after("declare_delay_queue", dq_name(queue))
+        else:
+            broker.declare_queue(queue)
+
+    @staticmethod
+    def stop_consuming_slot(worker, slot: int):
+        queue = slot_queue(slot)
+        worker.consumer_whitelist.discard(queue)
+        # Paused rather than stopped: worker threads ack its messages through it
+        for name in (queue, dq_name(queue)):
+            if consumer := worker.consumers.get(name):
+                consumer.pause()
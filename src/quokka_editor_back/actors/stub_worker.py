@@ -0,0 +1,36 @@
+"""
+Run dramatiq actors inside the API process, for the STUB task broker.
+
+Messages never leave the process: a dramatiq worker started here consumes
+them, and its threads hand the coroutine actors over to the API's event loop,
+where they share its database and Redis pools.
+"""
+import asyncio
+from collections.abc import Coroutine
+
+from dramatiq import Worker
+from dramatiq.asyncio import set_event_loop_thread
+from dramatiq.broker import Broker
+
+
+class RunningEventLoop:
+    """Stands in for dramatiq's event loop thread with a loop already running."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def run_coroutine(self, coroutine: Coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+async def start_stub_worker(broker: Broker, worker_threads: int) -> Worker:
+    set_event_loop_thread(RunningEventLoop(asyncio.get_running_loop()))
+    worker = Worker(broker, worker_threads=worker_threads)
+    worker.start()
+    return worker
+
+
+async def stop_stub_worker(worker: Worker) -> None:
+    # Joining the worker threads blocks, while they wait on this very loop
+    await asyncio.get_running_loop().run_in_executor(None, worker.stop)
+    set_event_loop_thread(None)
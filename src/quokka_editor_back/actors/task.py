@@ -1,6 +1,10 @@
+import asyncio
 import json
 import logging
+import time
 import uuid
+from collections.abc import MutableSequence
+from itertools import islice, repeat
 
 from asgiref.sync import AsyncToSync
 from redis.asyncio import Redis as AsyncRedis
@@ -9,136 +13,483 @@ from tortoise.transactions import in_transaction
 
 from quokka_editor_back.actors import dramatiq
 from quokka_editor_back.models.document import Document
-from quokka_editor_back.models.operation import (
-    Operation,
-    OperationSchema,
-    PosSchema,
-)
+from quokka_editor_back.models.operation import Op, Operation, OperationSchema
 from quokka_editor_back.routers.documents import get_document
-from quokka_editor_back.schema.websocket import MessageTypeEnum
-from quokka_editor_back.utils.ot import apply_operation, transform
-from quokka_editor_back.utils.redis import get_redis
+from quokka_editor_back.schema.document import TaskBroker, TransformEngine
+from quokka_editor_back.settings import settings
+from quokka_editor_back.utils.buffer import LineBuffer
+from quokka_editor_back.utils.document_cache import DocumentCache
+from quokka_editor_back.utils.history_cache import HistoryCache
+from quokka_editor_back.utils.leases import (
+    DocumentLease,
+    acquire_lease,
+    operations_key,
+    orphaned_documents,
+    processing_key,
+)
+from quokka_editor_back.utils.live_documents import (
+    is_live_backend,
+    load_live_changes,
+    load_live_document,
+    save_live_operations,
+)
+from quokka_editor_back.utils.messages import (
+    change_message,
+    encode_message,
+    pack_message,
+)
+from quokka_editor_back.utils.ot import apply_operation, rebase_batch
+from quokka_editor_back.utils.redis import (
+    close_redis_pool,
+    document_channel,
+    get_redis,
+    redis_pool_stats,
+)
+from quokka_editor_back.utils.sharding import ShardRouter
+from quokka_editor_back.utils.snapshots import maybe_take_snapshot
 
 logger = logging.getLogger(__name__)
 
+document_cache = DocumentCache(
+    max_documents=settings.document_cache_max_documents,
+    max_bytes=settings.document_cache_max_bytes,
+)
+history_cache = HistoryCache(
+    max_documents=settings.history_cache_max_documents,
+    max_operations=settings.history_cache_max_operations,
+    max_age=settings.history_cache_max_age,
+)
+shard_router = ShardRouter()
+# Tasks draining document queues in this process, with the in-process engine
+sequencers: dict[str, asyncio.Task] = {}
+
 
 def decode_document_content(document):
     return json.loads((document.content or b"{}").decode())
 
 
-async def async_document_task(document_id: str, *args, **kwargs) -> None:
+def load_document_content(document: Document) -> MutableSequence[str]:
+    content = document_cache.get(
+        document.id, document.last_revision, document.content_generation
+    )
+    if content is None:
+        content = LineBuffer(decode_document_content(document))
+    return content
+
+
+async def async_document_task(
+    document_id: str, lease_token: str | None = None, *args, **kwargs
+) -> None:
     redis_client: AsyncRedis = await get_redis()
+    lease = None
+    if lease_token is not None:
+        lease = DocumentLease(redis_client, document_id, lease_token)
+        keep_alive = asyncio.create_task(lease.keep_alive())
     try:
+        if lease is not None and not await lease.held():
+            # Dispatched again since, to the new owner after a rebalance
+            logger.info("Skipping document %s, its lease moved on", document_id)
+            return
         document = await get_document(document_id=uuid.UUID(document_id))
-        await process_operations(redis_client, document)
+        if is_live_backend():
+            await load_live_document(redis_client, document)
+        await process_operations(redis_client, document, lease)
     except Exception as err:
         logger.warning("THERE IS AN ERROR %s", err)
     finally:
-        await cleanup(redis_client, document_id)
+        if lease is not None:
+            keep_alive.cancel()
+        logger.debug("Document cache stats %s", document_cache.stats())
+        logger.debug("History cache stats %s", history_cache.stats())
+        logger.debug("Redis pool stats %s", redis_pool_stats())
+        await cleanup(redis_client, document_id, lease)
 
 
-async def process_one_operation(
-    loaded_op_data: dict, document: Document
-) -> OperationSchema | None:
-    async with in_transaction():
-        new_op = await transform_and_prepare_operation(
-            loaded_op_data["data"],
-            document,
-        )
-        if not new_op:
-            return
-        await apply_and_save_operation(new_op, document)
-    return new_op
-
-
-async def process_operations(redis_client: AsyncRedis, document: Document) -> None:
-    async for op_data in fetch_operations_from_redis(redis_client, str(document.id)):
-        loaded_op_data = json.loads(op_data)
-        user_token = loaded_op_data["user_token"]
-        if new_op := await process_one_operation(loaded_op_data, document):
-            await publish_operation(
-                redis_client,
-                str(document.id),
-                user_token,
-                new_op,
+async def dispatch_document(redis_client: AsyncRedis, document_id: str) -> bool:
+    """Send the document's queue to a worker, unless one holds its lease."""
+    if (lease_token := await acquire_lease(redis_client, document_id)) is None:
+        return False
+    await send_transform(redis_client, document_id, lease_token)
+    return True
+
+
+async def send_transform(
+    redis_client: AsyncRedis, document_id: str, lease_token: str
+) -> None:
+    """
+    Hand the document's queue to whatever processes it.
+
+    That is a task of this process with the in-process engine, otherwise the
+    worker slot the document is pinned to, if sharding, or any worker.
+    """
+    if settings.transform_engine == TransformEngine.IN_PROCESS:
+        start_sequencer(document_id, lease_token)
+        return
+    queue_name = None
+    if settings.worker_sharding:
+        queue_name = await shard_router.queue_for(redis_client, document_id)
+    if queue_name is None:
+        transform_document.send(document_id, lease_token)
+        return
+    message = transform_document.message(document_id, lease_token)
+    transform_document.broker.declare_queue(queue_name)
+    transform_document.broker.enqueue(message.copy(queue_name=queue_name))
+
+
+def start_sequencer(document_id: str, lease_token: str) -> asyncio.Task:
+    sequencer = asyncio.create_task(async_document_task(document_id, lease_token))
+    sequencers[document_id] = sequencer
+
+    def forget(task: asyncio.Task) -> None:
+        # A sequencer redispatching its document in cleanup was replaced already
+        if sequencers.get(document_id) is task:
+            del sequencers[document_id]
+
+    sequencer.add_done_callback(forget)
+    return sequencer
+
+
+async def finish_sequencers() -> None:
+    while sequencers:
+        await asyncio.gather(*sequencers.values(), return_exceptions=True)
+
+
+async def sweep_orphaned_queues(redis_client: AsyncRedis) -> int:
+    """Dispatch the queues left behind by workers whose lease expired."""
+    dispatched = 0
+    async for document_id in orphaned_documents(redis_client):
+        if await dispatch_document(redis_client, document_id):
+            logger.warning("Dispatching orphaned queue of document %s", document_id)
+            dispatched += 1
+    return dispatched
+
+
+async def run_sweeper() -> None:
+    while True:
+        await asyncio.sleep(settings.orphan_sweep_interval)
+        redis_client = await get_redis()
+        try:
+            await sweep_orphaned_queues(redis_client)
+        except Exception as err:
+            logger.warning("Sweeping orphaned queues failed: %s", err)
+        finally:
+            await redis_client.close()
+
+
+async def process_operation_batch(
+    loaded_ops_data: list[dict],
+    document: Document,
+    redis_client: AsyncRedis | None = None,
+) -> list[tuple[str, Op | list[Op]]]:
+    """
+    Commit queued messages and return what to publish for each of them.
+
+    A message carries one operation, or a client's batch of them as a list;
+    a batch is returned as the list of its operations that survived. Live
+    documents are committed through `redis_client`.
+    """
+    ops_data: list[dict] = []
+    groups: list[int] = []
+    user_tokens: list[str] = []
+    for index, loaded_op_data in enumerate(loaded_ops_data):
+        data = loaded_op_data["data"]
+        batch = data if isinstance(data, list) else [data]
+        ops_data.extend(batch)
+        groups.extend([index] * len(batch))
+        user_tokens.extend([loaded_op_data["user_token"]] * len(batch))
+
+    content, last_revision = document.content, document.last_revision
+    try:
+        async with in_transaction():
+            new_ops = await transform_and_prepare_operations(
+                ops_data, document, groups, redis_client
+            )
+            committed = [
+                (user_token, new_op)
+                for user_token, new_op in zip(user_tokens, new_ops, strict=True)
+                if new_op
+            ]
+            if committed:
+                await apply_and_save_operations(
+                    [new_op for _, new_op in committed],
+                    document,
+                    [user_token for user_token, _ in committed],
+                    redis_client,
+                )
+    except Exception:
+        # The transaction was rolled back, so nothing of the batch may linger
+        document.content, document.last_revision = content, last_revision
+        document_cache.invalidate(document.id)
+        history_cache.invalidate(document.id)
+        raise
+
+    results: list[tuple[str, Op | list[Op]]] = []
+    remaining = iter(new_ops)
+    for loaded_op_data in loaded_ops_data:
+        user_token, data = loaded_op_data["user_token"], loaded_op_data["data"]
+        if isinstance(data, list):
+            if batch_ops := [op for op in islice(remaining, len(data)) if op]:
+                results.append((user_token, batch_ops))
+        elif new_op := next(remaining):
+            results.append((user_token, new_op))
+    return results
+
+
+async def commit_operation_batch(
+    loaded_ops_data: list[dict],
+    document: Document,
+    redis_client: AsyncRedis | None = None,
+) -> list[tuple[str, Op | list[Op]]]:
+    """
+    Commit queued messages together, or one by one if that fails.
+
+    A message that fails on its own, being invalid or not applying to the
+    document, is dropped, so it can't take the rest of the batch with it.
+    """
+    if len(loaded_ops_data) > 1:
+        try:
+            return await process_operation_batch(
+                loaded_ops_data, document, redis_client
+            )
+        except Exception as err:
+            logger.warning(
+                "Batch of document %s failed, committing it message by message: %s",
+                document.id,
+                err,
             )
+    results: list[tuple[str, Op | list[Op]]] = []
+    for loaded_op_data in loaded_ops_data:
+        try:
+            results.extend(
+                await process_operation_batch([loaded_op_data], document, redis_client)
+            )
+        except Exception as err:
+            logger.warning("Dropping message %s: %s", loaded_op_data, err)
+    return results
+
+
+def decode_queued_messages(batch: list[str]) -> list[dict]:
+    loaded_ops_data = []
+    for op_data in batch:
+        try:
+            loaded_ops_data.append(json.loads(op_data))
+        except ValueError as err:
+            logger.warning("Dropping message %s: %s", op_data, err)
+    return loaded_ops_data
+
+
+async def process_operations(
+    redis_client: AsyncRedis, document: Document, lease: DocumentLease | None = None
+) -> None:
+    """
+    Work through the document's queue for one turn.
 
+    A turn ends after `document_turn_max_operations` queued messages or
+    `document_turn_max_time` seconds, so a busy document can't keep a worker
+    from the others. `cleanup` dispatches what is left to the back of the
+    queue, behind the documents already waiting.
+    """
+    deadline = time.monotonic() + settings.document_turn_max_time
+    async for batch in fetch_operations_from_redis(
+        redis_client,
+        str(document.id),
+        settings.operations_batch_size,
+        settings.document_turn_max_operations,
+    ):
+        loaded_ops_data = decode_queued_messages(batch)
+        if results := await commit_operation_batch(
+            loaded_ops_data, document, redis_client
+        ):
+            await publish_operations(redis_client, str(document.id), results)
+        if lease is not None and lease.lost:
+            # Another worker may have been dispatched for the rest of the queue
+            break
+        if time.monotonic() >= deadline:
+            logger.debug("Turn of document %s ran out of time", document.id)
+            break
+
+
+def operation_message(user_token: str, new_op: Op | list[Op]) -> str:
+    if isinstance(new_op, list):
+        payload = encode_message([change_message(user_token, op) for op in new_op])
+        return pack_message(
+            user_token, new_op[-1].revision, payload, new_op[0].revision
+        )
+    payload = encode_message(change_message(user_token, new_op))
+    return pack_message(user_token, new_op.revision, payload)
 
-async def publish_operation(
+
+async def publish_operations(
     redis_client: AsyncRedis,
     document_id: str,
-    user_token: str,
-    new_op: OperationSchema,
+    results: list[tuple[str, Op | list[Op]]],
 ) -> None:
-    await redis_client.publish(
-        f"{document_id}_{user_token}",
-        json.dumps(
-            {
-                "data": new_op.dict(),
-                "type": MessageTypeEnum.EXT_CHANGE,
-                "user_token": user_token,
-                "revision": new_op.revision,
-            }
-        ),
-    )
+    pipeline = redis_client.pipeline(transaction=False)
+    for user_token, new_op in results:
+        pipeline.publish(
+            document_channel(document_id), operation_message(user_token, new_op)
+        )
+    await pipeline.execute()
 
 
-async def fetch_operations_from_redis(redis_client: AsyncRedis, document_id: str):
-    while True:
-        data = await redis_client.lpop(f"document_operations_{document_id}")  # type: ignore
+async def fetch_operations_from_redis(
+    redis_client: AsyncRedis,
+    document_id: str,
+    batch_size: int,
+    max_items: int | None = None,
+):
+    key = operations_key(document_id)
+    remaining = max_items
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        pipeline = redis_client.pipeline(transaction=True)
+        pipeline.lrange(key, 0, size - 1)
+        pipeline.ltrim(key, size, -1)
+        data, _ = await pipeline.execute()
         if not data:
             break
-        yield data.decode()  # type:ignore
-
-
-async def transform_and_prepare_operation(
-    op_data: dict, document: Document
-) -> OperationSchema | None:
-    new_op = OperationSchema(**op_data)
-
-    if new_op.revision < document.last_revision:
-        for prev_op in await document.operations.filter(revision__gt=new_op.revision):
-            prev_op_schema = OperationSchema(
-                from_pos=PosSchema.parse_raw(
-                    prev_op.from_pos,
-                ),
-                to_pos=PosSchema.parse_raw(
-                    prev_op.to_pos,
-                ),
-                text=json.loads(prev_op.text),
-                type=prev_op.type,
-                revision=prev_op.revision,
-            )
-            new_op = transform(new_op, prev_op_schema)
-    new_op.revision = document.last_revision + 1
-    return new_op
-
-
-async def apply_and_save_operation(op: OperationSchema, document: Document) -> None:
-    content = apply_operation(decode_document_content(document), op)
-    document.update_from_dict({"last_revision": op.revision})
-    new_op = Operation(
-        from_pos=op.from_pos.json(),
-        to_pos=op.to_pos.json(),
-        text=json.dumps(op.text),
-        type=op.type,
-        revision=op.revision,
+        if remaining is not None:
+            remaining -= len(data)
+        yield [item.decode() for item in data]
+
+
+async def load_history(
+    document: Document, base_revision: int, redis_client: AsyncRedis | None = None
+) -> list[Op]:
+    history = history_cache.bridge(document.id, base_revision, document.last_revision)
+    if history is None and is_live_backend():
+        changes = await load_live_changes(redis_client, document.id, base_revision)
+        history = [op for _, op in changes]
+        history_cache.store(document.id, base_revision, history)
+    elif history is None:
+        history = await Operation.load_ops(document.id, base_revision)
+        history_cache.store(document.id, base_revision, history)
+    return history
+
+
+async def transform_and_prepare_operations(
+    ops_data: list[dict],
+    document: Document,
+    groups: list[int] | None = None,
+    redis_client: AsyncRedis | None = None,
+) -> list[Op | None]:
+    """
+    Rebase queued operations onto the document head, in queue order.
+
+    Operations prepared earlier in the batch become history for the later
+    ones, exactly as if they had been committed one by one, except for those
+    sent together in the same client batch, as told by `groups`.
+    """
+    new_ops = [Op.from_schema(OperationSchema(**op_data)) for op_data in ops_data]
+    history: list[Op] = []
+    base_revision = min(new_op.revision for new_op in new_ops)
+    if base_revision < document.last_revision:
+        history = await load_history(document, base_revision, redis_client)
+    return rebase_batch(new_ops, history, document.last_revision, groups)
+
+
+async def apply_and_save_operations(
+    ops: list[Op],
+    document: Document,
+    user_tokens: list[str] | None = None,
+    redis_client: AsyncRedis | None = None,
+) -> None:
+    content = load_document_content(document)
+    try:
+        for op in ops:
+            content = apply_operation(content, op)
+        if is_live_backend():
+            await save_live_document(redis_client, ops, document, content, user_tokens)
+        else:
+            await save_document(ops, document, content, user_tokens)
+    except Exception:
+        # apply_operation edits the cached lines in place
+        document_cache.invalidate(document.id)
+        raise
+    document_cache.put(
+        document.id, content, ops[-1].revision, document.content_generation
+    )
+    history_cache.extend(document.id, ops)
+
+
+async def save_document(
+    ops: list[Op],
+    document: Document,
+    content: MutableSequence[str],
+    user_tokens: list[str] | None = None,
+) -> None:
+    await Operation.bulk_create(
+        [
+            Operation.from_op(document.id, op, user_token)
+            for op, user_token in zip(ops, user_tokens or repeat(None))
+        ]
     )
+    document.update_from_dict(
+        {
+            "content": json.dumps(list(content)).encode(),
+            "last_revision": ops[-1].revision,
+        }
+    )
+    # content_generation is left to update_document
+    await document.save(update_fields=["content", "last_revision"])
+    await maybe_take_snapshot(document, document.content, ops[-1].revision)
+
 
-    await new_op.save()
-    await document.operations.add(new_op)
-    document.update_from_dict({"content": json.dumps(content).encode()})
-    await document.save()
+async def save_live_document(
+    redis_client: AsyncRedis,
+    ops: list[Op],
+    document: Document,
+    content: MutableSequence[str],
+    user_tokens: list[str] | None = None,
+) -> None:
+    encoded_content = json.dumps(list(content)).encode()
+    await save_live_operations(
+        redis_client,
+        document.id,
+        ops,
+        list(user_tokens or repeat(None, len(ops))),
+        encoded_content,
+    )
+    document.content, document.last_revision = encoded_content, ops[-1].revision
 
 
-async def cleanup(redis_client: AsyncRedis, document_id: str) -> None:
-    await redis_client.delete(f"document_processing_{document_id}")
-    await connections.close_all()
+async def cleanup(
+    redis_client: AsyncRedis, document_id: str, lease: DocumentLease | None = None
+) -> None:
+    if lease is None:
+        await redis_client.delete(processing_key(document_id))
+    else:
+        await lease.release()
+    # Operations queued after the last fetch, while the lease was still held,
+    # would otherwise wait for the next one to be sent
+    if await redis_client.llen(operations_key(document_id)):
+        await dispatch_document(redis_client, document_id)
+    await redis_client.close()
+    if (
+        settings.transform_engine == TransformEngine.DRAMATIQ
+        and not on_persistent_event_loop()
+    ):
+        # Every message runs on a fresh event loop, which had a pool of its own
+        await close_redis_pool()
+        await connections.close_all()
 
 
 class NamedAsyncToSync(AsyncToSync):
     __name__ = "transform_document"
 
 
-sync_document_task = NamedAsyncToSync(async_document_task)
-transform_document = dramatiq.actor(sync_document_task, max_retries=1)
+def on_persistent_event_loop() -> bool:
+    return (
+        settings.worker_persistent_event_loop or settings.task_broker == TaskBroker.STUB
+    )
+
+
+if on_persistent_event_loop():
+    # dramatiq runs coroutine actors on the AsyncIO middleware's event loop,
+    # or on the API's one with the stub worker
+    transform_document = dramatiq.actor(
+        async_document_task, actor_name="transform_document", max_retries=1
+    )
+else:
+    sync_document_task = NamedAsyncToSync(async_document_task)
+    transform_document = dramatiq.actor(sync_document_task, max_retries=1)
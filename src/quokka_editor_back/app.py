@@ -1,3 +1,5 @@
+import asyncio
+import contextlib
 from pathlib import Path
 
 from fastapi import FastAPI, Request
@@ -6,6 +8,9 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from tortoise.contrib.fastapi import register_tortoise
 
+from quokka_editor_back.actors import broker
+from quokka_editor_back.actors.stub_worker import start_stub_worker, stop_stub_worker
+from quokka_editor_back.actors.task import finish_sequencers, run_sweeper
 from quokka_editor_back.routers import (
     auth,
     document_templates,
@@ -14,7 +19,14 @@ from quokka_editor_back.routers import (
     users,
     websockets,
 )
-from quokka_editor_back.settings import TORTOISE_ORM
+from quokka_editor_back.schema.document import TaskBroker
+from quokka_editor_back.settings import TORTOISE_ORM, settings
+from quokka_editor_back.utils.live_documents import (
+    flush_live_documents,
+    is_live_backend,
+    run_flusher,
+)
+from quokka_editor_back.utils.redis import close_redis_pool, get_redis, redis_pool
 
 MODULE_DIR = Path(__file__).parent.absolute()
 templates = Jinja2Templates(directory=MODULE_DIR / "templates")
@@ -33,6 +45,67 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def open_redis():
+    redis_pool()
+
+
+@app.on_event("startup")
+async def start_task_worker():
+    if settings.task_broker == TaskBroker.STUB:
+        app.state.stub_worker = await start_stub_worker(
+            broker, settings.stub_worker_threads
+        )
+
+
+@app.on_event("shutdown")
+async def stop_task_worker():
+    if (worker := getattr(app.state, "stub_worker", None)) is not None:
+        await stop_stub_worker(worker)
+
+
+@app.on_event("startup")
+async def start_orphan_sweeper():
+    app.state.orphan_sweeper = asyncio.create_task(run_sweeper())
+
+
+@app.on_event("shutdown")
+async def stop_orphan_sweeper():
+    if (sweeper := getattr(app.state, "orphan_sweeper", None)) is not None:
+        sweeper.cancel()
+
+
+@app.on_event("shutdown")
+async def stop_sequencers():
+    # Operations already taken off the queue are committed and published
+    await finish_sequencers()
+
+
+@app.on_event("startup")
+async def start_live_document_flusher():
+    if is_live_backend():
+        app.state.live_document_flusher = asyncio.create_task(run_flusher())
+
+
+@app.on_event("shutdown")
+async def stop_live_document_flusher():
+    if (flusher := getattr(app.state, "live_document_flusher", None)) is None:
+        return
+    flusher.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await flusher
+    redis_client = await get_redis()
+    try:
+        await flush_live_documents(redis_client)
+    finally:
+        await redis_client.close()
+
+
+@app.on_event("shutdown")
+async def close_redis():
+    await close_redis_pool()
+
+
 @app.get("/mock-ui/{document_id}")
 async def get_mock_ui(request: Request, document_id: str):
     return templates.TemplateResponse(
@@ -3,6 +3,7 @@ from tortoise import fields, models
 from quokka_editor_back.models.operation import Operation
 from quokka_editor_back.models.project import Project
 from quokka_editor_back.models.user import User
+from quokka_editor_back.models.utils import TimestampedModel
 
 
 class Document(models.Model):
@@ -15,19 +16,29 @@ class Document(models.Model):
         related_name="documents",
         on_delete=fields.CASCADE,
     )
-    operations: fields.ManyToManyRelation[Operation] = fields.ManyToManyField(
-        model_name="quokka_editor_back.Operation",
-        related_name="operations",
-        on_delete=fields.SET_NULL,
-        through="document_operation",
-        null=True,
-    )
     project: fields.ForeignKeyRelation[Project] = fields.ForeignKeyField(
         model_name="quokka_editor_back.Project",
         related_name="documents",
         on_delete=fields.CASCADE,
     )
     last_revision = fields.BigIntField(default=0)
+    content_generation = fields.IntField(default=0)
+
+    operations: fields.ReverseRelation[Operation]
+
+
+class DocumentSnapshot(TimestampedModel):
+    id = fields.UUIDField(pk=True)
+    document: fields.ForeignKeyRelation[Document] = fields.ForeignKeyField(
+        model_name="quokka_editor_back.Document",
+        related_name="snapshots",
+        on_delete=fields.CASCADE,
+    )
+    revision = fields.BigIntField()
+    content = fields.BinaryField(null=True)
+
+    class Meta:
+        unique_together = (("document", "revision"),)
 
 
 class DocumentTemplate(models.Model):
@@ -0,0 +1,21 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "documentsnapshot" (
+    "created_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    "updated_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    "id" UUID NOT NULL  PRIMARY KEY,
+    "revision" BIGINT NOT NULL,
+    "content" BYTEA,
+    "document_id" UUID NOT NULL REFERENCES "document" ("id") ON DELETE CASCADE,
+    CONSTRAINT "uid_documentsna_documen_0c1f6b" UNIQUE ("document_id", "revision")
+);
+        INSERT INTO "documentsnapshot" ("id", "document_id", "revision", "content")
+        SELECT gen_random_uuid(), "id", "last_revision", "content" FROM "document";"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "documentsnapshot";"""
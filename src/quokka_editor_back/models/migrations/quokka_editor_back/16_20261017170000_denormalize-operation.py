@@ -0,0 +1,61 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "operation" ADD "document_id" UUID;
+        ALTER TABLE "operation" ADD "from_line" INT;
+        ALTER TABLE "operation" ADD "from_ch" INT;
+        ALTER TABLE "operation" ADD "to_line" INT;
+        ALTER TABLE "operation" ADD "to_ch" INT;
+        UPDATE "operation" SET "document_id" = "document_operation"."document_id"
+            FROM "document_operation"
+            WHERE "document_operation"."operation_id" = "operation"."id";
+        DELETE FROM "operation" WHERE "document_id" IS NULL;
+        DELETE FROM "operation" AS "duplicate" USING "operation"
+            WHERE "duplicate"."document_id" = "operation"."document_id"
+            AND "duplicate"."revision" = "operation"."revision"
+            AND "duplicate"."id" > "operation"."id";
+        UPDATE "operation" SET
+            "from_line" = ("from_pos"::JSONB ->> 'line')::INT,
+            "from_ch" = ("from_pos"::JSONB ->> 'ch')::INT,
+            "to_line" = ("to_pos"::JSONB ->> 'line')::INT,
+            "to_ch" = ("to_pos"::JSONB ->> 'ch')::INT,
+            "text" = ARRAY_TO_STRING(
+                ARRAY(SELECT JSONB_ARRAY_ELEMENTS_TEXT("text"::JSONB)), E'\\n'
+            );
+        ALTER TABLE "operation" DROP COLUMN "from_pos";
+        ALTER TABLE "operation" DROP COLUMN "to_pos";
+        ALTER TABLE "operation" ALTER COLUMN "document_id" SET NOT NULL;
+        ALTER TABLE "operation" ALTER COLUMN "from_line" SET NOT NULL;
+        ALTER TABLE "operation" ALTER COLUMN "from_ch" SET NOT NULL;
+        ALTER TABLE "operation" ALTER COLUMN "to_line" SET NOT NULL;
+        ALTER TABLE "operation" ALTER COLUMN "to_ch" SET NOT NULL;
+        ALTER TABLE "operation" ADD CONSTRAINT "fk_operatio_document_7e6f3c52" FOREIGN KEY ("document_id") REFERENCES "document" ("id") ON DELETE CASCADE;
+        CREATE UNIQUE INDEX "uid_operation_documen_2b1e4d" ON "operation" ("document_id", "revision");
+        DROP TABLE IF EXISTS "document_operation";"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE "document_operation" (
+    "document_id" UUID NOT NULL REFERENCES "document" ("id") ON DELETE CASCADE,
+    "operation_id" UUID NOT NULL REFERENCES "operation" ("id") ON DELETE SET NULL
+);
+        INSERT INTO "document_operation" ("document_id", "operation_id")
+            SELECT "document_id", "id" FROM "operation";
+        DROP INDEX IF EXISTS "uid_operation_documen_2b1e4d";
+        ALTER TABLE "operation" DROP CONSTRAINT "fk_operatio_document_7e6f3c52";
+        ALTER TABLE "operation" ADD "from_pos" TEXT;
+        ALTER TABLE "operation" ADD "to_pos" TEXT;
+        UPDATE "operation" SET
+            "from_pos" = JSON_BUILD_OBJECT('line', "from_line", 'ch', "from_ch")::TEXT,
+            "to_pos" = JSON_BUILD_OBJECT('line', "to_line", 'ch', "to_ch")::TEXT,
+            "text" = TO_JSON(STRING_TO_ARRAY("text", E'\\n'))::TEXT;
+        ALTER TABLE "operation" ALTER COLUMN "from_pos" SET NOT NULL;
+        ALTER TABLE "operation" ALTER COLUMN "to_pos" SET NOT NULL;
+        ALTER TABLE "operation" DROP COLUMN "document_id";
+        ALTER TABLE "operation" DROP COLUMN "from_line";
+        ALTER TABLE "operation" DROP COLUMN "from_ch";
+        ALTER TABLE "operation" DROP COLUMN "to_line";
+        ALTER TABLE "operation" DROP COLUMN "to_ch";"""
@@ -1,7 +1,13 @@
 from enum import StrEnum
+from typing import TYPE_CHECKING, NamedTuple
+from uuid import UUID
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, validator
 from tortoise import fields, models
+from tortoise.queryset import QuerySet
+
+if TYPE_CHECKING:
+    from quokka_editor_back.models.document import Document
 
 
 class OperationType(StrEnum):
@@ -27,11 +33,160 @@ class OperationSchema(BaseModel):
     type: OperationType
     revision: int = Field(..., gte=0)
 
+    @validator("text", each_item=True)
+    def text_has_no_newline(cls, line: str) -> str:
+        # The text is stored joined by TEXT_SEPARATOR
+        if TEXT_SEPARATOR in line:
+            raise ValueError("lines of text must not contain a newline")
+        return line
+
+
+# Lines never contain a newline, so an operation's text is stored joined by one
+TEXT_SEPARATOR = "\n"
+
+# The columns the OT engine needs, in ``Op`` field order
+OP_COLUMNS = ("from_line", "from_ch", "to_line", "to_ch", "text", "type", "revision")
+
+
+class Op(NamedTuple):
+    """
+    Lightweight operation used by the OT engine.
+
+    Validation happens once, when a client operation is parsed into an
+    ``OperationSchema``; everything past that boundary works on plain ints.
+    """
+
+    from_line: int
+    from_ch: int
+    to_line: int
+    to_ch: int
+    text: list[str]
+    type: OperationType
+    revision: int
+
+    @classmethod
+    def from_schema(cls, schema: OperationSchema) -> "Op":
+        return cls(
+            schema.from_pos.line,
+            schema.from_pos.ch,
+            schema.to_pos.line,
+            schema.to_pos.ch,
+            schema.text,
+            schema.type,
+            schema.revision,
+        )
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "Op":
+        """Build an ``Op`` from an ``OP_COLUMNS`` values_list row."""
+        from_line, from_ch, to_line, to_ch, text, type, revision = row
+        return cls(
+            from_line,
+            from_ch,
+            to_line,
+            to_ch,
+            text.split(TEXT_SEPARATOR),
+            OperationType(type),
+            revision,
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Op":
+        """Inverse of ``to_dict``, for operations this server serialised."""
+        return cls(
+            data["from_pos"]["line"],
+            data["from_pos"]["ch"],
+            data["to_pos"]["line"],
+            data["to_pos"]["ch"],
+            data["text"],
+            OperationType(data["type"]),
+            data["revision"],
+        )
+
+    def to_schema(self) -> OperationSchema:
+        return OperationSchema(**self.to_dict())
+
+    def to_dict(self) -> dict:
+        return {
+            "from_pos": {"line": self.from_line, "ch": self.from_ch},
+            "to_pos": {"line": self.to_line, "ch": self.to_ch},
+            "text": self.text,
+            "type": self.type,
+            "revision": self.revision,
+        }
+
 
 class Operation(models.Model):
+    """Append-only log entry; one row per committed document revision."""
+
     id = fields.UUIDField(pk=True)
-    from_pos = fields.TextField()
-    to_pos = fields.TextField()
+    document: fields.ForeignKeyRelation["Document"] = fields.ForeignKeyField(
+        model_name="quokka_editor_back.Document",
+        related_name="operations",
+        on_delete=fields.CASCADE,
+    )
+    from_line = fields.IntField()
+    from_ch = fields.IntField()
+    to_line = fields.IntField()
+    to_ch = fields.IntField()
     text = fields.TextField()
     type = fields.CharEnumField(OperationType)
     revision = fields.BigIntField()
+    # Lets a reconnecting client recognise its own operations while catching up
+    user_token = fields.CharField(max_length=64, null=True)
+
+    class Meta:
+        unique_together = (("document", "revision"),)
+
+    @classmethod
+    def from_op(
+        cls, document_id: UUID, op: Op, user_token: str | None = None
+    ) -> "Operation":
+        return cls(
+            document_id=document_id,
+            from_line=op.from_line,
+            from_ch=op.from_ch,
+            to_line=op.to_line,
+            to_ch=op.to_ch,
+            text=TEXT_SEPARATOR.join(op.text),
+            type=op.type,
+            revision=op.revision,
+            user_token=user_token,
+        )
+
+    @classmethod
+    async def load_ops(
+        cls,
+        document_id: UUID,
+        after_revision: int,
+        up_to_revision: int | None = None,
+    ) -> list[Op]:
+        """Read a revision range of a document's log, oldest first."""
+        query = cls.log_query(document_id, after_revision, up_to_revision)
+        return [Op.from_row(row) for row in await query.values_list(*OP_COLUMNS)]
+
+    @classmethod
+    async def load_changes(
+        cls,
+        document_id: UUID,
+        after_revision: int,
+        up_to_revision: int | None = None,
+    ) -> list[tuple[str | None, Op]]:
+        """Like ``load_ops``, with the token of each operation's author."""
+        query = cls.log_query(document_id, after_revision, up_to_revision)
+        return [
+            (row[-1], Op.from_row(row[:-1]))
+            for row in await query.values_list(*OP_COLUMNS, "user_token")
+        ]
+
+    @classmethod
+    def log_query(
+        cls,
+        document_id: UUID,
+        after_revision: int,
+        up_to_revision: int | None = None,
+    ) -> QuerySet["Operation"]:
+        query = cls.filter(document_id=document_id, revision__gt=after_revision)
+        if up_to_revision is not None:
+            query = query.filter(revision__lte=up_to_revision)
+        return query.order_by("revision")
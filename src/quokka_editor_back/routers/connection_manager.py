@@ -1,11 +1,26 @@
+import asyncio
+import logging
 import random
-from collections import defaultdict
-from uuid import UUID
+import time
+from collections import defaultdict, deque
+from collections.abc import Awaitable, Callable
+from typing import NamedTuple
+from uuid import UUID, uuid4
 
-from asgiref.sync import sync_to_async
-from fastapi import WebSocket
+from fastapi import WebSocket, status
 
-from quokka_editor_back.schema.websocket import MessageTypeEnum
+from quokka_editor_back.schema.websocket import (
+    MessageTypeEnum,
+    OverflowPolicy,
+    PresenceEvent,
+    WireProtocol,
+)
+from quokka_editor_back.settings import settings
+from quokka_editor_back.utils.protocol import EncodedMessage, Frame, encode_frame
+
+logger = logging.getLogger(__name__)
+
+CursorPublisher = Callable[[UUID, list[dict]], Awaitable[None]]
 
 
 def rand_hex_color():
@@ -17,15 +32,201 @@ def rand_hex_color():
     return hex_color
 
 
-class ConnectionManager:
+def ack_payload(
+    revision: int | None, user_token: str, first_revision: int | None = None
+) -> dict:
+    payload = {
+        "revision_log": revision,
+        "user_token": user_token,
+        "type": MessageTypeEnum.ACKNOWLEDGE,
+    }
+    if first_revision is not None and first_revision != revision:
+        payload["revision_range"] = [first_revision, revision]
+    return payload
+
+
+def disconnect_payload(user_token: str) -> dict:
+    return {
+        "message": f"User {user_token} Disconnected from the file.",
+        "user_token": user_token,
+    }
+
+
+class CatchUp(NamedTuple):
+    """Messages bringing a joining or reconnecting client up to `revision`."""
+
+    messages: list[EncodedMessage | dict | str]
+    revision: int
+
+
+async def send_frame(websocket: WebSocket, frame: Frame) -> None:
+    if isinstance(frame, bytes):
+        await websocket.send_bytes(frame)
+    else:
+        await websocket.send_text(frame)
+
+
+class SendMetrics:
+    __slots__ = (
+        "sent",
+        "dropped",
+        "coalesced",
+        "overflows",
+        "peak_depth",
+        "latency",
+        "max_latency",
+    )
+
     def __init__(self):
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.overflows = 0
+        self.peak_depth = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def record_send(self, latency: float) -> None:
+        self.sent += 1
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+
+class Outbox:
+    """
+    Bounded queue of outgoing messages for one socket, drained by its writer.
+
+    Putting a message never waits on the client. When the queue is full the
+    overflow policy either makes room by dropping a queued cursor update, or
+    gives up on the client and closes its socket.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        metrics: SendMetrics,
+        max_size: int,
+        overflow_policy: OverflowPolicy,
+        protocol: WireProtocol = WireProtocol.JSON,
+    ):
+        self.websocket = websocket
+        self.protocol = protocol
+        self.metrics = metrics
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.closed = False
+        # (encoded frame, is a droppable cursor update, enqueued at)
+        self._messages: deque[tuple[Frame, bool, float]] = deque()
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._writer = asyncio.create_task(self._drain())
+        self._closing: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def put(self, message: Frame, droppable: bool = False) -> bool:
+        if self.closed:
+            return False
+        if len(self._messages) >= self.max_size and not self._make_room(droppable):
+            return False
+        self._messages.append((message, droppable, time.monotonic()))
+        self.metrics.peak_depth = max(self.metrics.peak_depth, len(self._messages))
+        self._idle.clear()
+        self._ready.set()
+        return True
+
+    async def join(self) -> None:
+        await self._idle.wait()
+
+    def stop(self) -> None:
+        self.closed = True
+        self._messages.clear()
+        self._writer.cancel()
+        self._idle.set()
+
+    def _make_room(self, droppable: bool) -> bool:
+        if self.overflow_policy == OverflowPolicy.DROP_CURSORS:
+            for index, (_, queued_droppable, _) in enumerate(self._messages):
+                if queued_droppable:
+                    del self._messages[index]
+                    self.metrics.dropped += 1
+                    return True
+            if droppable:
+                self.metrics.dropped += 1
+                return False
+        self.metrics.overflows += 1
+        self.stop()
+        self._closing = asyncio.create_task(
+            self.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        )
+        return False
+
+    async def _drain(self) -> None:
+        while True:
+            await self._ready.wait()
+            while self._messages:
+                message, _, enqueued_at = self._messages.popleft()
+                try:
+                    await send_frame(self.websocket, message)
+                except Exception as err:
+                    logger.debug("Dropping outbox of a failed socket: %s", err)
+                    self.closed = True
+                    self._messages.clear()
+                    self._idle.set()
+                    return
+                self.metrics.record_send(time.monotonic() - enqueued_at)
+            self._ready.clear()
+            self._idle.set()
+
+
+class ConnectionManager:
+    def __init__(
+        self,
+        send_queue_size: int | None = None,
+        overflow_policy: OverflowPolicy | None = None,
+        cursor_flush_rate: float | None = None,
+        cursor_send_budget: int | None = None,
+    ):
         self.active_connections: dict[
             UUID, dict[WebSocket, dict[str, str]]
         ] = defaultdict(dict)
+        self.listeners: dict[UUID, asyncio.Task] = {}
+        # Set while the document's listener receives its published messages
+        self.subscribed: dict[UUID, asyncio.Event] = {}
+        # Tells this process apart in the events it publishes to the others
+        self.node_id = uuid4().hex
+        self.connection_ids: dict[WebSocket, str] = {}
+        # Every connection to the document, in any process, by connection id
+        self.presence: dict[UUID, dict[str, dict[str, str]]] = defaultdict(dict)
+        # Recently broadcast operations as (first revision, revision, payload)
+        self.recent_operations: dict[UUID, deque[tuple[int, int, str]]] = {}
+        # The last snapshot message sent to a joining client, with its revision
+        self.snapshots: dict[UUID, tuple[int, EncodedMessage]] = {}
+        self.outboxes: dict[WebSocket, Outbox] = {}
+        # The revision a joining socket was caught up to, until it is passed
+        self.start_revisions: dict[WebSocket, int] = {}
+        self.send_metrics: dict[UUID, SendMetrics] = defaultdict(SendMetrics)
+        self.send_queue_size = send_queue_size or settings.websocket_send_queue_size
+        self.overflow_policy = overflow_policy or settings.websocket_overflow_policy
+        self.cursor_flush_rate = cursor_flush_rate or settings.cursor_flush_rate
+        self.cursor_send_budget = cursor_send_budget or settings.cursor_send_budget
+        # Latest cursor message of each user, waiting for the next flush.
+        self.pending_cursors: dict[UUID, dict[str, dict]] = defaultdict(dict)
+        self.cursor_flushers: dict[UUID, asyncio.Task] = {}
 
-    async def send_all_users_info(self, websocket: WebSocket, document_id: UUID):
-        all_users = [conn for conn in self.active_connections[document_id].values()]
-        await websocket.send_json(all_users)
+    async def send_all_users_info(
+        self,
+        websocket: WebSocket,
+        document_id: UUID,
+        protocol: WireProtocol = WireProtocol.JSON,
+    ):
+        all_users = list(self.presence[document_id].values())
+        if protocol == WireProtocol.JSON:
+            await websocket.send_json(all_users)
+        else:
+            await websocket.send_bytes(encode_frame(all_users, protocol))
 
     async def broadcast_new_user(
         self, username: str, user_token: str, document_id: UUID, websocket: WebSocket
@@ -37,43 +238,366 @@ class ConnectionManager:
         }
         self.active_connections[document_id][websocket] = websocket_data
 
+        encoded_data = EncodedMessage(websocket_data)
         for websocket, data in self.active_connections[document_id].items():
             if data["user_token"] != user_token:
-                await websocket.send_json(websocket_data)
+                self.enqueue(websocket, encoded_data)
 
     async def connect(
-        self, websocket: WebSocket, document_id: UUID, username: str, user_token: str
-    ):
-        await websocket.accept()
-        await self.send_all_users_info(websocket, document_id)
+        self,
+        websocket: WebSocket,
+        document_id: UUID,
+        username: str,
+        user_token: str,
+        protocol: WireProtocol = WireProtocol.JSON,
+        subprotocol: str | None = None,
+        users: dict[str, dict] | None = None,
+        catch_up: CatchUp | None = None,
+    ) -> str:
+        """
+        Accept the socket, tell it who is connected and announce it locally.
+
+        `users` are the document's connections loaded from the presence
+        registry. Returns the id to register the new connection there with.
+        The client is first sent its `catch_up`, a snapshot or the operations
+        it missed, and, once it is known who is connected, the operations
+        broadcast since then and a CATCH_UP message with its revision.
+        """
+        await websocket.accept(subprotocol=subprotocol)
+        if catch_up is not None:
+            for message in catch_up.messages:
+                if not isinstance(message, EncodedMessage):
+                    message = EncodedMessage(message)
+                await send_frame(websocket, message.frame(protocol))
+        if users:
+            self.presence[document_id].update(users)
+        await self.send_all_users_info(websocket, document_id, protocol)
+        self.outboxes[websocket] = Outbox(
+            websocket,
+            self.send_metrics[document_id],
+            self.send_queue_size,
+            self.overflow_policy,
+            protocol,
+        )
+        if catch_up is not None:
+            # Nothing is awaited since the outbox was created, so every
+            # operation missed meanwhile is in the recent ring
+            revision = self.replay_recent(websocket, document_id, catch_up.revision)
+            self.enqueue(
+                websocket, {"type": MessageTypeEnum.CATCH_UP, "revision": revision}
+            )
+            self.start_revisions[websocket] = revision
         await self.broadcast_new_user(username, user_token, document_id, websocket)
+        connection_id = self.connection_ids[websocket] = uuid4().hex
+        user = self.active_connections[document_id][websocket]
+        self.presence[document_id][connection_id] = user
+        return connection_id
+
+    def subscribe(
+        self,
+        document_id: UUID,
+        listen: Callable[[UUID, asyncio.Event], Awaitable[None]],
+    ) -> asyncio.Event:
+        """
+        Run one `listen` task per document for all of its local sockets.
+
+        Returns the event `listen` sets once it receives the document's
+        messages; a joining socket's catch-up must only be read after that.
+        """
+        listener = self.listeners.get(document_id)
+        if listener is None or listener.done():
+            subscribed = self.subscribed[document_id] = asyncio.Event()
+            self.listeners[document_id] = asyncio.create_task(
+                listen(document_id, subscribed)
+            )
+        return self.subscribed[document_id]
+
+    def unsubscribe_idle(self, document_id: UUID) -> None:
+        """Stop the document's listener when no local socket is left."""
+        if not self.active_connections.get(document_id):
+            if listener := self.listeners.pop(document_id, None):
+                listener.cancel()
+            self.subscribed.pop(document_id, None)
+
+    async def disconnect(self, websocket: WebSocket, document_id: UUID):
+        data = self.active_connections[document_id].pop(websocket)
+        if (outbox := self.outboxes.pop(websocket, None)) is not None:
+            outbox.stop()
+        self.start_revisions.pop(websocket, None)
+        self.presence[document_id].pop(self.connection_ids.pop(websocket, None), None)
+        self.pending_cursors[document_id].pop(data["user_token"], None)
+        if not self.active_connections[document_id]:
+            self.unsubscribe_idle(document_id)
+            if flusher := self.cursor_flushers.pop(document_id, None):
+                flusher.cancel()
+            self.pending_cursors.pop(document_id, None)
+            self.presence.pop(document_id, None)
+            self.recent_operations.pop(document_id, None)
+            self.snapshots.pop(document_id, None)
+            logger.debug("Send stats %s", self.send_stats(document_id))
+            self.send_metrics.pop(document_id, None)
+
+    def remember_operations(
+        self, document_id: UUID, first_revision: int, revision: int, payload: str
+    ) -> None:
+        if document_id not in self.recent_operations:
+            self.recent_operations[document_id] = deque(
+                maxlen=settings.websocket_recent_operations
+            )
+        self.recent_operations[document_id].append((first_revision, revision, payload))
+
+    def recent_changes(self, document_id: UUID, revision: int) -> CatchUp | None:
+        """
+        Catch a client at `revision` up from the recent ring, when it can.
+
+        The ring only covers the time the document's listener has been
+        running, so None means the client must be caught up from the log.
+        """
+        recent = self.recent_operations.get(document_id)
+        if not recent or not recent[0][0] <= revision + 1 <= recent[-1][1] + 1:
+            return None
+        messages = []
+        for first_revision, last_revision, payload in recent:
+            if first_revision > revision:
+                if first_revision != revision + 1:
+                    # Operations between the two were never broadcast here
+                    return None
+                messages.append(payload)
+                revision = last_revision
+            elif last_revision > revision:
+                # Part of a batch the client already has
+                return None
+        return CatchUp(messages, revision)
+
+    def cache_snapshot(
+        self, document_id: UUID, revision: int, snapshot: EncodedMessage
+    ) -> None:
+        self.snapshots[document_id] = (revision, snapshot)
+
+    def cached_snapshot(self, document_id: UUID) -> CatchUp | None:
+        """
+        Serve a joining client the cached snapshot and the operations after it.
+
+        The snapshot stays usable while the recent ring holds every operation
+        broadcast since it was taken.
+        """
+        if (cached := self.snapshots.get(document_id)) is None:
+            return None
+        revision, snapshot = cached
+        if (recent := self.recent_changes(document_id, revision)) is None:
+            return None
+        return CatchUp([snapshot, *recent.messages], recent.revision)
+
+    def forget_content(self, document_id: UUID) -> None:
+        """Drop what was cached of a document, once it may have missed changes."""
+        self.recent_operations.pop(document_id, None)
+        self.snapshots.pop(document_id, None)
+
+    def replay_recent(
+        self, websocket: WebSocket, document_id: UUID, revision: int
+    ) -> int:
+        """Queue recent operations newer than `revision`; return the newest."""
+        recent = self.recent_operations.get(document_id, ())
+        for first_revision, last_revision, payload in recent:
+            if first_revision > revision:
+                self.enqueue(websocket, payload)
+                revision = last_revision
+        return revision
+
+    def local_presence(self, document_id: UUID) -> dict[str, dict[str, str]]:
+        return {
+            self.connection_ids[websocket]: data
+            for websocket, data in self.active_connections[document_id].items()
+            if websocket in self.connection_ids
+        }
+
+    async def sync_presence(self, document_id: UUID, members: dict[str, dict]) -> None:
+        """
+        Replace the document's presence with `members` from the registry.
 
-    @sync_to_async()
-    def disconnect(self, websocket: WebSocket, document_id: UUID):
-        del self.active_connections[document_id][websocket]
-
-    @staticmethod
-    async def ack_message(websocket: WebSocket, revision: int, user_token: str):
-        await websocket.send_json(
-            {
-                "revision_log": revision,
-                "user_token": user_token,
-                "type": MessageTypeEnum.ACKNOWLEDGE,
-            }
+        Connections missing there belonged to a process that went away without
+        announcing their departure, so local users are told they disconnected.
+        """
+        local = self.local_presence(document_id)
+        vanished = [
+            data
+            for connection_id, data in self.presence[document_id].items()
+            if connection_id not in members and connection_id not in local
+        ]
+        self.presence[document_id] = {**members, **local}
+        for data in vanished:
+            await self.broadcast(
+                disconnect_payload(data["user_token"]),
+                document_id=document_id,
+                user_token=data["user_token"],
+                send_to_owner=False,
+            )
+
+    async def handle_event(
+        self, document_id: UUID, event: PresenceEvent, payload: dict
+    ) -> None:
+        """Deliver an event published by another process to the local sockets."""
+        if payload["origin"] == self.node_id:
+            return
+        if event == PresenceEvent.JOIN:
+            user = payload["user"]
+            self.presence[document_id][payload["connection_id"]] = user
+            await self.broadcast(
+                user,
+                document_id=document_id,
+                user_token=user["user_token"],
+                send_to_owner=False,
+            )
+        elif event == PresenceEvent.LEAVE:
+            self.presence[document_id].pop(payload["connection_id"], None)
+            await self.broadcast(
+                disconnect_payload(payload["user_token"]),
+                document_id=document_id,
+                user_token=payload["user_token"],
+                send_to_owner=False,
+            )
+        elif event == PresenceEvent.CONTENT:
+            self.forget_content(document_id)
+        elif event == PresenceEvent.CURSORS:
+            for cursor in payload["cursors"]:
+                await self.broadcast(
+                    cursor,
+                    document_id=document_id,
+                    user_token=cursor["user_token"],
+                    send_to_owner=False,
+                    droppable=True,
+                )
+
+    def enqueue(
+        self,
+        websocket: WebSocket,
+        message: EncodedMessage | dict | list | str,
+        droppable: bool = False,
+    ) -> bool:
+        if not isinstance(message, EncodedMessage):
+            message = EncodedMessage(message)
+        if (outbox := self.outboxes.get(websocket)) is not None:
+            return outbox.put(message.frame(outbox.protocol), droppable)
+        return False
+
+    async def drain(self, document_id: UUID) -> None:
+        """Wait until every queued message of the document has been sent."""
+        await asyncio.gather(
+            *(
+                self.outboxes[websocket].join()
+                for websocket in self.active_connections[document_id]
+                if websocket in self.outboxes
+            )
         )
 
-    async def broadcast(
+    def send_stats(self, document_id: UUID) -> dict[str, float]:
+        metrics = self.send_metrics[document_id]
+        depths = [
+            len(self.outboxes[websocket])
+            for websocket in self.active_connections[document_id]
+            if websocket in self.outboxes
+        ]
+        return {
+            "connections": len(depths),
+            "queue_depth": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "peak_queue_depth": metrics.peak_depth,
+            "sent": metrics.sent,
+            "dropped": metrics.dropped,
+            "coalesced": metrics.coalesced,
+            "overflows": metrics.overflows,
+            "avg_send_latency": metrics.latency / metrics.sent if metrics.sent else 0.0,
+            "max_send_latency": metrics.max_latency,
+        }
+
+    def update_cursor(
         self,
+        document_id: UUID,
+        user_token: str,
         message: dict,
-        websocket: WebSocket,
+        publish: CursorPublisher | None = None,
+    ) -> None:
+        """
+        Keep `message` as the user's latest cursor until the next flush.
+
+        A newer cursor replaces the pending one, so however fast clients move,
+        each user's cursor is sent to the other viewers at most once per tick.
+        Flushed cursors are also handed to `publish` for the other processes.
+        """
+        pending = self.pending_cursors[document_id]
+        if user_token in pending:
+            self.send_metrics[document_id].coalesced += 1
+        pending[user_token] = message
+        flusher = self.cursor_flushers.get(document_id)
+        if flusher is None or flusher.done():
+            self.cursor_flushers[document_id] = asyncio.create_task(
+                self.flush_cursors(document_id, publish)
+            )
+
+    def cursor_interval(self, document_id: UUID) -> float:
+        """
+        Time between cursor flushes of the document.
+
+        Each flush sends every pending cursor to every other viewer, so the
+        tick stretches beyond `1 / cursor_flush_rate` once that would exceed
+        `cursor_send_budget` messages per second.
+        """
+        viewers = len(self.presence[document_id])
+        pending = len(self.pending_cursors[document_id])
+        return max(
+            1 / self.cursor_flush_rate,
+            pending * max(viewers - 1, 0) / self.cursor_send_budget,
+        )
+
+    async def flush_cursors(
+        self, document_id: UUID, publish: CursorPublisher | None = None
+    ) -> None:
+        while self.pending_cursors.get(document_id):
+            await asyncio.sleep(self.cursor_interval(document_id))
+            pending = self.pending_cursors.pop(document_id, {})
+            for user_token, message in pending.items():
+                await self.broadcast(
+                    message,
+                    document_id=document_id,
+                    user_token=user_token,
+                    send_to_owner=False,
+                    droppable=True,
+                )
+            if publish and pending:
+                try:
+                    await publish(document_id, list(pending.values()))
+                except Exception as err:
+                    logger.warning("Could not publish cursors: %s", err)
+
+    async def broadcast(
+        self,
+        message: dict | str,
         document_id: UUID,
         user_token: str,
         revision: int | None = None,
         send_to_owner: bool = True,
+        droppable: bool = False,
+        first_revision: int | None = None,
     ):
+        """
+        Queue `message` for the document's other users and an ack for its owner.
+
+        Nothing here waits on a client; each socket's writer sends in the
+        background. `droppable` marks updates, like cursor moves, that may be
+        discarded when a client falls behind. The message, which may already be
+        encoded JSON text, is encoded once per wire protocol in use. A batch of
+        operations is acked once, with its `first_revision` to `revision` range.
+        A socket that joined at `revision` or later already has the operation.
+        """
+        message = EncodedMessage(message)
+        ack = EncodedMessage(ack_payload(revision, user_token, first_revision))
         for websocket_conn, data in self.active_connections[document_id].items():
+            if revision is not None and websocket_conn in self.start_revisions:
+                if revision <= self.start_revisions[websocket_conn]:
+                    continue
+                del self.start_revisions[websocket_conn]
             if user_token == data["user_token"]:
                 if send_to_owner:
-                    await self.ack_message(websocket, revision, user_token)
+                    self.enqueue(websocket_conn, ack)
             else:
-                await websocket_conn.send_json(message)
+                self.enqueue(websocket_conn, message, droppable)
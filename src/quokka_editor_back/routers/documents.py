@@ -2,7 +2,7 @@ import json
 from typing import Annotated, Any
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Path, Query
 from fastapi_pagination import Page, add_pagination
 from fastapi_pagination.ext.tortoise import paginate
 from starlette import status
@@ -13,10 +13,21 @@ from quokka_editor_back.auth.utils import get_current_user
 from quokka_editor_back.models.document import Document, DocumentTemplate
 from quokka_editor_back.models.project import Project
 from quokka_editor_back.models.user import User
+from quokka_editor_back.routers import manager
 from quokka_editor_back.schema.document import (
     DocumentCreatePayload,
+    DocumentRevisionResponse,
     DocumentUpdatePayload,
 )
+from quokka_editor_back.schema.websocket import PresenceEvent
+from quokka_editor_back.utils.live_documents import (
+    evict_live_document,
+    is_live_backend,
+    load_live_document,
+)
+from quokka_editor_back.utils.messages import encode_message, pack_event
+from quokka_editor_back.utils.redis import document_channel, get_redis
+from quokka_editor_back.utils.snapshots import load_document_at, take_snapshot
 
 router = APIRouter(tags=["documents"])
 
@@ -85,6 +96,7 @@ async def create_document(
         content=content,
         project=project,
     )
+    await take_snapshot(new_document, content, new_document.last_revision)
     return new_document
 
 
@@ -93,7 +105,36 @@ async def read_document(
     document_id: UUID,
     current_user: Annotated[User, Depends(get_current_user)],
 ):
-    return await get_document(document_id=document_id, user=current_user)
+    document = await get_document(document_id=document_id, user=current_user)
+    if is_live_backend():
+        redis_client = await get_redis()
+        try:
+            await load_live_document(redis_client, document)
+        finally:
+            await redis_client.close()
+    return document
+
+
+@router.get(
+    "/{document_id}/revisions/{revision}", response_model=DocumentRevisionResponse
+)
+async def read_document_revision(
+    document_id: UUID,
+    revision: Annotated[int, Path(ge=0)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    document = await get_document(document_id=document_id, user=current_user)
+    content = None
+    if revision <= document.last_revision:
+        content = await load_document_at(document, revision)
+    if content is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Revision {revision} of document {document_id} not found",
+        )
+    return DocumentRevisionResponse(
+        id=document.id, revision=revision, content=list(content)
+    )
 
 
 @router.delete("/{document_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -114,12 +155,41 @@ async def update_document(
     document_payload: DocumentUpdatePayload,
     current_user: Annotated[User, Depends(get_current_user)],
 ):
+    if document_payload.content and is_live_backend():
+        # the new content would be overwritten by the next flush
+        redis_client = await get_redis()
+        try:
+            evicted = await evict_live_document(redis_client, document_id)
+        finally:
+            await redis_client.close()
+        if not evicted:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Document {document_id} is being edited",
+            )
     document = await get_document(document_id=document_id)
     if document_payload.title:
         document.title = document_payload.title
     if document_payload.content:
         document.content = json.dumps(document_payload.content).encode()
+        # workers holding the old content parsed must not apply ops onto it
+        document.content_generation += 1
     await document.save()
+    if document_payload.content:
+        # the content was replaced outside the operation log
+        await take_snapshot(document, document.content, document.last_revision)
+        # joining clients must not be served the old content's snapshot
+        manager.forget_content(document_id)
+        redis_client = await get_redis()
+        try:
+            await redis_client.publish(
+                document_channel(document_id),
+                pack_event(
+                    PresenceEvent.CONTENT, encode_message({"origin": manager.node_id})
+                ),
+            )
+        finally:
+            await redis_client.close()
     return document
 
 
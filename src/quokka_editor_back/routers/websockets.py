@@ -3,133 +3,333 @@ import json
 import logging
 from uuid import UUID
 
-from fastapi import APIRouter, Query, WebSocket, WebSocketDisconnect
+from fastapi import (
+    APIRouter,
+    Query,
+    WebSocket,
+    WebSocketDisconnect,
+    WebSocketException,
+    status,
+)
 from redis.asyncio import Redis as AsyncRedis
 from redis.client import PubSub
 
-from quokka_editor_back.actors import transform_document
+from quokka_editor_back.actors import send_transform
 from quokka_editor_back.auth.utils import authenticate_websocket
+from quokka_editor_back.models.document import Document
+from quokka_editor_back.models.operation import Operation
 from quokka_editor_back.models.project import ShareRole
 from quokka_editor_back.routers import manager
-from quokka_editor_back.utils.redis import get_redis
+from quokka_editor_back.routers.connection_manager import CatchUp, disconnect_payload
+from quokka_editor_back.schema.websocket import (
+    MessageTypeEnum,
+    PresenceEvent,
+    WireProtocol,
+)
+from quokka_editor_back.settings import settings
+from quokka_editor_back.utils.leases import (
+    lease_ttl_ms,
+    new_lease_token,
+    operations_key,
+    processing_key,
+)
+from quokka_editor_back.utils.live_documents import (
+    is_live_backend,
+    load_live_changes,
+    load_live_document,
+)
+from quokka_editor_back.utils.messages import (
+    change_message,
+    encode_message,
+    is_event,
+    pack_event,
+    unpack_event,
+    unpack_message,
+)
+from quokka_editor_back.utils.presence import (
+    join_presence,
+    leave_presence,
+    load_presence,
+    refresh_presence,
+)
+from quokka_editor_back.utils.protocol import (
+    EncodedMessage,
+    Frame,
+    decode_frame,
+    negotiate_protocol,
+)
+from quokka_editor_back.utils.redis import (
+    document_channel,
+    get_redis,
+    redis_pool_stats,
+)
 
 logger = logging.getLogger(__name__)
 router = APIRouter(tags=["websockets"])
 
 
-def decode_redis_message(message: dict) -> dict:
-    return json.loads(message["data"].decode("utf-8"))
-
-
-# TODO add test for subscribe_channel_and_broadcast_redis_messages
 async def subscribe_channel_and_broadcast_redis_messages(
     pubsub: PubSub,
-    websocket: WebSocket,
     document_id: UUID,
-    user_token: str,
     channel_name: str,
+    subscribed: asyncio.Event | None = None,
 ):
-    await pubsub.psubscribe(channel_name)
+    await pubsub.subscribe(channel_name)
 
     try:
         async for message in pubsub.listen():
-            if message and message["type"] in ["message", "pmessage"]:
+            if message and message["type"] == "subscribe" and subscribed:
+                # Redis confirmed it, so every later publish reaches us
+                subscribed.set()
+            elif message and message["type"] == "message":
                 logger.debug("Broadcast message %s", message["data"])
-                decoded_message = decode_redis_message(message)
-                await manager.broadcast(
-                    message=decoded_message,
-                    websocket=websocket,
-                    document_id=document_id,
-                    revision=decoded_message["revision"],
-                    user_token=user_token,
-                )
+                try:
+                    await broadcast_redis_message(document_id, message["data"])
+                except Exception as err:
+                    logger.warning("Broadcasting %s failed: %s", message["data"], err)
     finally:
         await pubsub.unsubscribe(channel_name)
 
 
-async def forward_from_redis_to_websocket(
-    websocket: WebSocket, document_id: UUID, user_token: str
+async def broadcast_redis_message(document_id: UUID, data: bytes):
+    if is_event(data):
+        event, payload = unpack_event(data)
+        await manager.handle_event(
+            document_id, PresenceEvent(event), json.loads(payload)
+        )
+        return
+    user_token, first_revision, revision, payload = unpack_message(data)
+    manager.remember_operations(document_id, first_revision, revision, payload)
+    await manager.broadcast(
+        message=payload,
+        document_id=document_id,
+        revision=revision,
+        user_token=user_token,
+        first_revision=first_revision,
+    )
+
+
+async def forward_from_redis_to_websockets(
+    document_id: UUID, subscribed: asyncio.Event | None = None
 ):
     redis_client = await get_redis()
-    channel_name = f"{str(document_id)}_{user_token}"
+    heartbeat = asyncio.create_task(heartbeat_presence(redis_client, document_id))
+    try:
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await subscribe_channel_and_broadcast_redis_messages(
+                    pubsub, document_id, document_channel(document_id), subscribed
+                )
+                return
+            except Exception as err:
+                # The only listener of the document's local sockets must not die
+                logger.warning("Listening to document %s failed: %s", document_id, err)
+                if subscribed:
+                    subscribed.clear()
+                # Operations published until the resubscription are never seen
+                manager.forget_content(document_id)
+            finally:
+                await pubsub.reset()
+            await asyncio.sleep(settings.websocket_resubscribe_delay)
+    finally:
+        heartbeat.cancel()
+        await redis_client.close()
+
 
-    pubsub = redis_client.pubsub()
-    await subscribe_channel_and_broadcast_redis_messages(
-        pubsub, websocket, document_id, user_token, channel_name
+async def heartbeat_presence(redis_client: AsyncRedis, document_id: UUID):
+    """Keep this process' connections registered and prune dead processes'."""
+    while True:
+        await asyncio.sleep(settings.presence_heartbeat_interval)
+        try:
+            await refresh_presence(
+                redis_client, document_id, manager.local_presence(document_id)
+            )
+            await manager.sync_presence(
+                document_id, await load_presence(redis_client, document_id)
+            )
+        except Exception as err:
+            logger.warning("Presence heartbeat failed: %s", err)
+
+
+async def publish_event(
+    redis_client: AsyncRedis, document_id: UUID, event: PresenceEvent, payload: dict
+):
+    await redis_client.publish(
+        document_channel(document_id),
+        pack_event(event, encode_message({"origin": manager.node_id, **payload})),
     )
 
-    await redis_client.close()
+
+async def publish_cursors(document_id: UUID, cursors: list[dict]):
+    redis_client = await get_redis()
+    try:
+        await publish_event(
+            redis_client, document_id, PresenceEvent.CURSORS, {"cursors": cursors}
+        )
+    finally:
+        await redis_client.close()
+
+
+async def load_catch_up(
+    document_id: UUID,
+    last_revision: int | None,
+    redis_client: AsyncRedis | None = None,
+) -> CatchUp:
+    """
+    Find what a client joining, or reconnecting at `last_revision`, needs.
+
+    A joining client gets a snapshot of the document, cached while it can be
+    brought up to date from memory. For a reconnecting client, recently
+    broadcast operations are replayed from memory, older ones are read from
+    the operation log. A gap over the catch-up limit, or a revision the
+    document never had, is answered with a snapshot as well. Live documents
+    are read through `redis_client`.
+    """
+    if last_revision is None:
+        catch_up = manager.cached_snapshot(document_id)
+    else:
+        catch_up = manager.recent_changes(document_id, last_revision)
+    if catch_up:
+        return catch_up
+    document = await Document.get(id=document_id)
+    if is_live_backend():
+        await load_live_document(redis_client, document)
+    head = document.last_revision
+    if last_revision is not None and (
+        last_revision >= 0
+        and 0 <= head - last_revision <= settings.websocket_catch_up_max_operations
+    ):
+        if is_live_backend():
+            changes = await load_live_changes(
+                redis_client, document_id, last_revision, head
+            )
+        else:
+            changes = await Operation.load_changes(document_id, last_revision, head)
+        return CatchUp(
+            [change_message(user_token, op) for user_token, op in changes], head
+        )
+    snapshot = EncodedMessage(
+        {
+            "type": MessageTypeEnum.SNAPSHOT,
+            "revision": head,
+            "content": json.loads((document.content or b"[]").decode()),
+        }
+    )
+    manager.cache_snapshot(document_id, head, snapshot)
+    return CatchUp([snapshot], head)
 
 
 async def process_websocket_message(
-    data: str,
-    websocket: WebSocket,
+    data: Frame,
     redis_client: AsyncRedis,
     document_id: UUID,
     user_token: str,
     read_only: bool,
+    protocol: WireProtocol = WireProtocol.JSON,
 ):
-    json_data = json.loads(data)
+    json_data = decode_frame(data, protocol)
     new_data = {"data": json_data, "user_token": user_token}
 
-    if json_data["type"] == "cursor":
-        await manager.broadcast(
-            new_data,
-            websocket,
-            document_id=document_id,
-            send_to_owner=False,
-            user_token=user_token,
-        )
+    if isinstance(json_data, dict) and json_data["type"] == "cursor":
+        manager.update_cursor(document_id, user_token, new_data, publish_cursors)
         return
 
     logger.debug("Input data %s", new_data)
 
-    if read_only:
+    if read_only or not json_data:
         return
-    await redis_client.rpush(f"document_operations_{document_id}", json.dumps(new_data))
-    if await redis_client.set(f"document_processing_{document_id}", 1, nx=True):
-        transform_document.send(str(document_id))
+    # A batch stays one queue entry, so the worker never splits it
+    lease_token = new_lease_token()
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.rpush(operations_key(document_id), json.dumps(new_data))
+    pipeline.set(processing_key(document_id), lease_token, nx=True, px=lease_ttl_ms())
+    _, dispatch = await pipeline.execute()
+    if dispatch:
+        await send_transform(redis_client, str(document_id), lease_token)
 
 
 @router.websocket("/{document_id}")
 async def websocket_endpoint(
-    websocket: WebSocket, document_id: UUID, token: str | None = Query(None)
+    websocket: WebSocket,
+    document_id: UUID,
+    token: str | None = Query(None),
+    protocol: WireProtocol | None = Query(None),
+    last_revision: int | None = Query(None),
 ):
     user, shared_role = await authenticate_websocket(document_id, token)
     user_token = str(user.id) if user else str(id(websocket))
     username = user.username if user else "Anonymous"
     read_only = not (user or shared_role == ShareRole.EDIT)
-
-    await manager.connect(websocket, document_id, username, user_token)
-
-    listen_task = asyncio.create_task(
-        forward_from_redis_to_websocket(websocket, document_id, user_token)
+    protocol, subprotocol = negotiate_protocol(
+        websocket.scope.get("subprotocols", []), protocol
     )
     redis_client = await get_redis()
+    logger.debug("Redis pool stats %s", redis_pool_stats())
+
+    # The catch-up is read once the listener receives the document's messages,
+    # so any operation published after the read is broadcast to this socket
+    subscribed = manager.subscribe(document_id, forward_from_redis_to_websockets)
+    try:
+        try:
+            await asyncio.wait_for(
+                subscribed.wait(), settings.websocket_subscribe_timeout
+            )
+        except TimeoutError as err:
+            logger.warning("Subscribing to document %s timed out", document_id)
+            raise WebSocketException(code=status.WS_1013_TRY_AGAIN_LATER) from err
+        connection_id = await manager.connect(
+            websocket,
+            document_id,
+            username,
+            user_token,
+            protocol,
+            subprotocol,
+            users=await load_presence(redis_client, document_id),
+            catch_up=await load_catch_up(document_id, last_revision, redis_client),
+        )
+    except BaseException:
+        manager.unsubscribe_idle(document_id)
+        await redis_client.close()
+        raise
+    user = manager.active_connections[document_id][websocket]
+    await join_presence(redis_client, document_id, connection_id, user)
+    await publish_event(
+        redis_client,
+        document_id,
+        PresenceEvent.JOIN,
+        {"connection_id": connection_id, "user": user},
+    )
 
     try:
         while True:
-            data = await websocket.receive_text()
+            if protocol == WireProtocol.MSGPACK:
+                data = await websocket.receive_bytes()
+            else:
+                data = await websocket.receive_text()
             await process_websocket_message(
                 data=data,
-                websocket=websocket,
                 redis_client=redis_client,
                 document_id=document_id,
                 user_token=user_token,
                 read_only=read_only,
+                protocol=protocol,
             )
     except WebSocketDisconnect:
-        listen_task.cancel()
+        pass
     finally:
         await manager.disconnect(websocket, document_id)
         await manager.broadcast(
-            message={
-                "message": f"User {user_token} Disconnected from the file.",
-                "user_token": user_token,
-            },
-            websocket=websocket,
+            message=disconnect_payload(user_token),
             document_id=document_id,
             user_token=user_token,
             send_to_owner=False,
         )
+        await leave_presence(redis_client, document_id, connection_id)
+        await publish_event(
+            redis_client,
+            document_id,
+            PresenceEvent.LEAVE,
+            {"connection_id": connection_id, "user_token": user_token},
+        )
         await redis_client.close()
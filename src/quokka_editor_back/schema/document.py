@@ -1,8 +1,30 @@
+from enum import StrEnum
 from uuid import UUID
 
 from pydantic import BaseModel, Field
 
 
+class DocumentStateBackend(StrEnum):
+    # Every committed operation is written to Postgres right away
+    POSTGRES = "POSTGRES"
+    # Live documents are kept in Redis and written behind to Postgres
+    REDIS = "REDIS"
+
+
+class TransformEngine(StrEnum):
+    # Queued operations are sent to dramatiq workers
+    DRAMATIQ = "DRAMATIQ"
+    # The API process sequences documents itself, without a broker hop
+    IN_PROCESS = "IN_PROCESS"
+
+
+class TaskBroker(StrEnum):
+    RABBITMQ = "RABBITMQ"
+    REDIS = "REDIS"
+    # Messages stay in the process, consumed by a worker the API starts
+    STUB = "STUB"
+
+
 class DocumentCreatePayload(BaseModel):
     template_id: UUID | None = None
     project_id: UUID
@@ -11,3 +33,9 @@ class DocumentCreatePayload(BaseModel):
 class DocumentUpdatePayload(BaseModel):
     title: str | None = Field(None, max_length=255)
     content: list[str] | None = Field(None)
+
+
+class DocumentRevisionResponse(BaseModel):
+    id: UUID
+    revision: int
+    content: list[str]
@@ -7,3 +7,24 @@ class MessageTypeEnum(StrEnum):
     CURSOR = "CURSOR"
     ACKNOWLEDGE = "ACKNOWLEDGE"
     EXT_CHANGE = "EXT_CHANGE"
+    CATCH_UP = "CATCH_UP"
+    SNAPSHOT = "SNAPSHOT"
+
+
+class PresenceEvent(StrEnum):
+    JOIN = "join"
+    LEAVE = "leave"
+    CURSORS = "cursors"
+    # The document's content was replaced outside the operation log
+    CONTENT = "content"
+
+
+class OverflowPolicy(StrEnum):
+    # Drop queued cursor updates first, disconnect once only changes are left
+    DROP_CURSORS = "DROP_CURSORS"
+    DISCONNECT = "DISCONNECT"
+
+
+class WireProtocol(StrEnum):
+    JSON = "json"
+    MSGPACK = "msgpack"
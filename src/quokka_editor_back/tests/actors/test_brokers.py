@@ -0,0 +1,70 @@
+import asyncio
+from unittest.mock import AsyncMock, Mock
+
+import dramatiq
+from dramatiq.brokers.rabbitmq import RabbitmqBroker
+from dramatiq.brokers.redis import RedisBroker
+from dramatiq.brokers.stub import StubBroker
+from dramatiq.middleware import Prometheus
+
+from quokka_editor_back.actors import make_broker
+from quokka_editor_back.actors.middleware import WorkerSlotMiddleware
+from quokka_editor_back.actors.stub_worker import start_stub_worker, stop_stub_worker
+from quokka_editor_back.schema.document import TaskBroker
+
+
+def test_make_broker(mocker):
+    # Given
+    settings_path = "quokka_editor_back.actors.settings.task_broker"
+
+    # When / Then
+    mocker.patch(settings_path, TaskBroker.RABBITMQ)
+    assert isinstance(make_broker(), RabbitmqBroker)
+    mocker.patch(settings_path, TaskBroker.REDIS)
+    assert isinstance(make_broker(), RedisBroker)
+    mocker.patch(settings_path, TaskBroker.STUB)
+    stub_broker = make_broker()
+    assert isinstance(stub_broker, StubBroker)
+    assert not any(isinstance(m, Prometheus) for m in stub_broker.middleware)
+
+
+async def test_stub_worker_runs_coroutine_actors_on_the_running_loop():
+    # Given
+    broker = StubBroker()
+    loop = asyncio.get_running_loop()
+    loops = []
+
+    async def record_loop():
+        loops.append(asyncio.get_running_loop())
+
+    actor = dramatiq.actor(record_loop, broker=broker)
+    worker = await start_stub_worker(broker, worker_threads=1)
+
+    # When
+    actor.send()
+    await loop.run_in_executor(None, broker.join, actor.queue_name)
+    await stop_stub_worker(worker)
+
+    # Then
+    assert loops == [loop]
+
+
+async def test_worker_slot_middleware_moves_to_a_free_slot():
+    # Given
+    broker = StubBroker()
+    slot_consumer = Mock()
+    worker = Mock(consumer_whitelist={"default", "documents-1"})
+    worker.consumers = {"documents-1": slot_consumer}
+    middleware = WorkerSlotMiddleware()
+    middleware.worker_slot = Mock(
+        keep_alive=AsyncMock(side_effect=[1, 2]),
+        claim=AsyncMock(side_effect=[2, None]),
+    )
+
+    # When
+    await middleware.hold_slot(broker, worker)
+
+    # Then
+    slot_consumer.pause.assert_called_once()
+    assert worker.consumer_whitelist == {"default"}
+    assert "documents-2" in broker.get_declared_queues()
@@ -7,26 +7,40 @@ import pytest
 import tortoise
 
 from quokka_editor_back.actors.task import (
-    apply_and_save_operation,
+    apply_and_save_operations,
     async_document_task,
     cleanup,
     decode_document_content,
+    dispatch_document,
+    document_cache,
     fetch_operations_from_redis,
-    process_one_operation,
+    finish_sequencers,
+    history_cache,
+    load_document_content,
+    process_operation_batch,
     process_operations,
-    publish_operation,
-    transform_and_prepare_operation,
+    publish_operations,
+    send_transform,
+    sequencers,
+    shard_router,
+    sweep_orphaned_queues,
+    transform_and_prepare_operations,
+    transform_document,
 )
 from quokka_editor_back.auth import auth_handler
 from quokka_editor_back.models.document import Document
 from quokka_editor_back.models.operation import (
+    Op,
     Operation,
     OperationSchema,
     OperationType,
-    PosSchema,
 )
 from quokka_editor_back.models.user import User
+from quokka_editor_back.schema.document import TaskBroker, TransformEngine
 from quokka_editor_back.schema.websocket import MessageTypeEnum
+from quokka_editor_back.settings import settings
+from quokka_editor_back.utils.buffer import LineBuffer
+from quokka_editor_back.utils.leases import DocumentLease
 
 LOGGER = logging.getLogger(__name__)
 
@@ -58,6 +72,42 @@ def test_decode_document_content_with_invalid_json():
         decode_document_content(document)
 
 
+async def test_load_document_content_cache_miss(document: Document):
+    # Given
+    document_cache.invalidate(document.id)
+
+    # When
+    content = load_document_content(document)
+
+    # Then
+    assert isinstance(content, LineBuffer)
+    assert content == ["test"]
+
+
+async def test_load_document_content_cache_hit(document: Document):
+    # Given
+    cached_content = ["cached"]
+    document_cache.put(document.id, cached_content, document.last_revision)
+
+    # When
+    content = load_document_content(document)
+
+    # Then
+    assert content is cached_content
+
+
+async def test_load_document_content_stale_cache(document: Document):
+    # Given
+    document_cache.put(document.id, ["cached"], document.last_revision + 1)
+
+    # When
+    content = load_document_content(document)
+
+    # Then
+    assert content == ["test"]
+    assert document.id not in document_cache
+
+
 @patch("quokka_editor_back.actors.task.process_operations", new_callable=AsyncMock)
 @patch("quokka_editor_back.actors.task.cleanup", new_callable=AsyncMock)
 @patch("quokka_editor_back.actors.task.get_redis", new_callable=AsyncMock)
@@ -73,8 +123,8 @@ async def test_async_document_task(
 
     # Then
     mocked_get_redis.assert_called_once()
-    mocked_process_operations.assert_called_once_with(ANY, document)
-    mocked_cleanup.assert_called_once_with(ANY, str(document.id))
+    mocked_process_operations.assert_called_once_with(ANY, document, None)
+    mocked_cleanup.assert_called_once_with(ANY, str(document.id), None)
 
 
 @patch(
@@ -99,7 +149,7 @@ async def test_async_document_task_exception(
     assert "THERE IS AN ERROR Message" in caplog.text
     mocked_get_redis.assert_called_once()
     mocked_process_operations.assert_called_once()
-    mocked_cleanup.assert_called_once_with(ANY, str(document.id))
+    mocked_cleanup.assert_called_once_with(ANY, str(document.id), None)
 
 
 class MockAsyncIterator:
@@ -126,50 +176,99 @@ async def test_process_operations(
     # Given
     user_token = "<PASSWORD>"
     value_1 = '{"data": "test data", "user_token": "<PASSWORD>"}'
+    value_2 = '{"data": "more data", "user_token": "<PASSWORD>"}'
 
-    mock_op = OperationSchema(
-        revision=3,
-        from_pos=PosSchema(line=0, ch=0),
-        to_pos=PosSchema(line=0, ch=0),
-        text=["new text"],
-        type=OperationType.INPUT.value,
-    )
+    mock_op = Op(0, 0, 0, 0, ["new text"], OperationType.INPUT, 3)
     redis_client_mock = mocker.patch("redis.asyncio", new_callable=AsyncMock)
     mocker.patch(
         "quokka_editor_back.actors.task.fetch_operations_from_redis",
-        return_value=MockAsyncIterator([value_1]),
+        return_value=MockAsyncIterator([[value_1, value_2]]),
     )
-    mock_process_one_operation = mocker.patch(
-        "quokka_editor_back.actors.task.process_one_operation", return_value=mock_op
+    mock_process_operation_batch = mocker.patch(
+        "quokka_editor_back.actors.task.process_operation_batch",
+        return_value=[(user_token, mock_op)],
     )
-    mock_publish_operation = mocker.patch(
-        "quokka_editor_back.actors.task.publish_operation", new_callable=AsyncMock
+    mock_publish_operations = mocker.patch(
+        "quokka_editor_back.actors.task.publish_operations", new_callable=AsyncMock
     )
 
     # When
     await process_operations(redis_client_mock, document)
 
     # Then
-    mock_process_one_operation.assert_called_once_with(json.loads(value_1), document)
-    mock_publish_operation.assert_called_once_with(
+    mock_process_operation_batch.assert_called_once_with(
+        [json.loads(value_1), json.loads(value_2)], document, redis_client_mock
+    )
+    mock_publish_operations.assert_called_once_with(
         redis_client_mock,
         str(document.id),
-        user_token,
-        ANY,
+        [(user_token, mock_op)],
     )
 
 
+def input_message(user_token: str, line: int, ch: int, text: str) -> str:
+    return json.dumps(
+        {
+            "data": {
+                "from_pos": {"line": line, "ch": ch},
+                "to_pos": {"line": line, "ch": ch},
+                "text": [text],
+                "type": OperationType.INPUT.value,
+                "revision": 0,
+            },
+            "user_token": user_token,
+        }
+    )
+
+
+async def test_process_operations_drops_poisoned_messages(document: Document, mocker):
+    # Given
+    invalid_message = json.loads(input_message("invalid", 0, 0, "?"))
+    del invalid_message["data"]["type"]
+    batch = [
+        input_message("first", 0, 0, "a"),
+        input_message("out_of_range", 5, 0, "?"),
+        json.dumps(invalid_message),
+        "not json",
+        input_message("second", 0, 4, "b"),
+    ]
+    mocker.patch(
+        "quokka_editor_back.actors.task.fetch_operations_from_redis",
+        return_value=MockAsyncIterator([batch]),
+    )
+    mock_publish_operations = mocker.patch(
+        "quokka_editor_back.actors.task.publish_operations", new_callable=AsyncMock
+    )
+    redis_client = AsyncMock()
+
+    # When
+    await process_operations(redis_client, document)
+
+    # Then
+    await document.refresh_from_db()
+    assert document.content == b'["atestb"]'
+    assert document.last_revision == 2
+    assert await Operation.filter(document_id=document.id).values_list(
+        "revision", "user_token"
+    ) == [(1, "first"), (2, "second")]
+    _, _, results = mock_publish_operations.call_args.args
+    assert [(user_token, op.revision) for user_token, op in results] == [
+        ("first", 1),
+        ("second", 2),
+    ]
+
+
 @patch(
-    "quokka_editor_back.actors.task.apply_and_save_operation",
+    "quokka_editor_back.actors.task.apply_and_save_operations",
     new_callable=AsyncMock,
 )
 @patch(
-    "quokka_editor_back.actors.task.transform_and_prepare_operation",
+    "quokka_editor_back.actors.task.transform_and_prepare_operations",
     new_callable=AsyncMock,
 )
-async def test_process_one_operation(
-    mocked_transform_and_prepare_operation,
-    mocked_apply_and_save_operation,
+async def test_process_operation_batch(
+    mocked_transform_and_prepare_operations,
+    mocked_apply_and_save_operations,
     document: Document,
 ):
     # Given
@@ -179,88 +278,210 @@ async def test_process_one_operation(
         "text": ["text"],
         "type": OperationType.INPUT,
         "revision": 0,
-        "data": "Test",
     }
+    new_op = Op.from_schema(OperationSchema(**op_data))
+    mocked_transform_and_prepare_operations.return_value = [new_op, None]
 
     # When
-    await process_one_operation(op_data, document)
+    results = await process_operation_batch(
+        [
+            {"data": op_data, "user_token": "first"},
+            {"data": op_data, "user_token": "second"},
+        ],
+        document,
+    )
 
     # Then
-    mocked_transform_and_prepare_operation.asser_called_once_with(
-        op_data["data"],
+    assert results == [("first", new_op)]
+    mocked_transform_and_prepare_operations.assert_called_once_with(
+        [op_data, op_data],
         document,
+        [0, 1],
+        None,
+    )
+    mocked_apply_and_save_operations.assert_called_once_with(
+        [new_op], document, ["first"], None
     )
-    mocked_apply_and_save_operation.assert_called_once_with(ANY, document)
 
 
-async def test_publish_operation(document: Document, active_user: User, mocker):
+@patch(
+    "quokka_editor_back.actors.task.apply_and_save_operations",
+    new_callable=AsyncMock,
+)
+@patch(
+    "quokka_editor_back.actors.task.transform_and_prepare_operations",
+    new_callable=AsyncMock,
+)
+async def test_process_operation_batch_with_client_batch(
+    mocked_transform_and_prepare_operations,
+    mocked_apply_and_save_operations,
+    document: Document,
+):
     # Given
-    user_token = "user_token"
-    redis_client_mock = mocker.patch("redis.asyncio", new_callable=AsyncMock)
-    token = auth_handler.encode_token(active_user.username)
-    new_op = OperationSchema(
-        revision=0,
-        from_pos=PosSchema(line=0, ch=0),
-        to_pos=PosSchema(line=0, ch=0),
-        text=["new text"],
-        type=OperationType.INPUT.value,
+    op_data = {
+        "from_pos": {"line": 0, "ch": 0},
+        "to_pos": {"line": 0, "ch": 0},
+        "text": ["text"],
+        "type": OperationType.INPUT,
+        "revision": 0,
+    }
+    first_op = Op.from_schema(OperationSchema(**op_data))._replace(revision=1)
+    second_op = first_op._replace(revision=2)
+    third_op = first_op._replace(revision=3)
+    mocked_transform_and_prepare_operations.return_value = [
+        first_op,
+        None,
+        second_op,
+        third_op,
+    ]
+
+    # When
+    results = await process_operation_batch(
+        [
+            {"data": op_data, "user_token": "single"},
+            {"data": [op_data, op_data, op_data], "user_token": "batch"},
+        ],
+        document,
+    )
+
+    # Then
+    assert results == [("single", first_op), ("batch", [second_op, third_op])]
+    mocked_transform_and_prepare_operations.assert_called_once_with(
+        [op_data] * 4,
+        document,
+        [0, 1, 1, 1],
+        None,
+    )
+    mocked_apply_and_save_operations.assert_called_once_with(
+        [first_op, second_op, third_op],
+        document,
+        ["single", "batch", "batch"],
+        None,
     )
 
+
+async def test_publish_operations(document: Document, active_user: User, mocker):
+    # Given
+    redis_client_mock = Mock()
+    pipeline_mock = Mock(execute=AsyncMock())
+    redis_client_mock.pipeline.return_value = pipeline_mock
+    token = auth_handler.encode_token(active_user.username)
+    new_op = Op(0, 0, 0, 0, ["new text"], OperationType.INPUT, 0)
+
     # When
-    await publish_operation(redis_client_mock, document.id, token, new_op)
+    await publish_operations(redis_client_mock, document.id, [(token, new_op)])
 
     # Then
-    redis_client_mock.publish.assert_called_with(
-        f"{document.id}_{token}",
-        json.dumps(
+    pipeline_mock.publish.assert_called_once_with(
+        f"document_{document.id}",
+        f"{token} 0\n"
+        + json.dumps(
             {
-                "data": {**new_op.dict()},
+                "data": new_op.to_schema().dict(),
                 "type": MessageTypeEnum.EXT_CHANGE,
                 "user_token": token,
                 "revision": new_op.revision,
-            }
+            },
+            separators=(",", ":"),
         ),
     )
+    pipeline_mock.execute.assert_called_once_with()
+
+
+async def test_publish_operations_batch(document: Document):
+    # Given
+    redis_client_mock = Mock()
+    pipeline_mock = Mock(execute=AsyncMock())
+    redis_client_mock.pipeline.return_value = pipeline_mock
+    new_ops = [
+        Op(0, 0, 0, 0, ["a"], OperationType.INPUT, 4),
+        Op(0, 1, 0, 1, ["b"], OperationType.INPUT, 5),
+    ]
+
+    # When
+    await publish_operations(redis_client_mock, document.id, [("token", new_ops)])
+
+    # Then
+    channel, message = pipeline_mock.publish.call_args.args
+    header, _, payload = message.partition("\n")
+    assert channel == f"document_{document.id}"
+    assert header == "token 4-5"
+    assert [change["revision"] for change in json.loads(payload)] == [4, 5]
+
+
+def mock_redis_pipeline(results):
+    pipeline_mock = Mock(execute=AsyncMock(side_effect=results))
+    return Mock(pipeline=Mock(return_value=pipeline_mock)), pipeline_mock
 
 
 async def test_fetch_operations_from_redis():
     # Given
-    mock_redis_client = AsyncMock()
-    redis_data = [b"data1", b"data2", b"data3"]
-    mock_redis_client.lpop.side_effect = redis_data + [None]
+    mock_redis_client, pipeline_mock = mock_redis_pipeline(
+        [
+            [[b"data1", b"data2"], True],
+            [[b"data3"], True],
+            [[], True],
+        ]
+    )
     document_id = uuid.uuid4()
 
     # When
     result = [
         data
-        async for data in fetch_operations_from_redis(mock_redis_client, document_id)
+        async for data in fetch_operations_from_redis(mock_redis_client, document_id, 2)
     ]
 
     # Then
-    assert result == ["data1", "data2", "data3"]
-    assert mock_redis_client.lpop.call_count == len(redis_data) + 1
-    mock_redis_client.lpop.assert_called_with(f"document_operations_{document_id}")
+    assert result == [["data1", "data2"], ["data3"]]
+    assert pipeline_mock.execute.call_count == 3
+    mock_redis_client.pipeline.assert_called_with(transaction=True)
+    pipeline_mock.lrange.assert_called_with(f"document_operations_{document_id}", 0, 1)
+    pipeline_mock.ltrim.assert_called_with(f"document_operations_{document_id}", 2, -1)
 
 
 async def test_fetch_operations_from_redis_with_empty_data():
     # Given
-    mock_redis_client = AsyncMock()
-    mock_redis_client.lpop.return_value = None
+    mock_redis_client, pipeline_mock = mock_redis_pipeline([[[], True]])
 
     # When
     result = [
         data
         async for data in fetch_operations_from_redis(
-            mock_redis_client, "some_document_id"
+            mock_redis_client, "some_document_id", 10
         )
     ]
 
     # Then
     assert result == []
-    assert mock_redis_client.lpop.call_count == 1
+    assert pipeline_mock.execute.call_count == 1
+
+
+async def test_fetch_operations_from_redis_stops_at_max_items():
+    # Given
+    mock_redis_client, pipeline_mock = mock_redis_pipeline(
+        [
+            [[b"data1", b"data2"], True],
+            [[b"data3"], True],
+        ]
+    )
+    document_id = uuid.uuid4()
+
+    # When
+    result = [
+        data
+        async for data in fetch_operations_from_redis(
+            mock_redis_client, document_id, 2, 3
+        )
+    ]
+
+    # Then
+    assert result == [["data1", "data2"], ["data3"]]
+    assert pipeline_mock.execute.call_count == 2
+    pipeline_mock.lrange.assert_called_with(f"document_operations_{document_id}", 0, 0)
+    pipeline_mock.ltrim.assert_called_with(f"document_operations_{document_id}", 1, -1)
 
 
-async def test_transform_and_prepare_operation(document: Document):
+async def test_transform_and_prepare_operations(document: Document):
     # Given
     op_data = {
         "from_pos": {"line": 0, "ch": 0},
@@ -271,13 +492,14 @@ async def test_transform_and_prepare_operation(document: Document):
     }
     document.last_revision = 0
     # When
-    result = await transform_and_prepare_operation(op_data, document)
+    result = await transform_and_prepare_operations([op_data, op_data], document)
 
     # Then
-    assert result.revision == 1
+    assert [new_op.revision for new_op in result] == [1, 2]
+    assert (result[1].from_line, result[1].from_ch) == (0, 4)
 
 
-async def test_transform_and_prepare_operation_document_revision_higher(
+async def test_transform_and_prepare_operations_document_revision_higher(
     document: Document,
 ):
     # Given
@@ -288,64 +510,169 @@ async def test_transform_and_prepare_operation_document_revision_higher(
         "type": OperationType.INPUT.value,
         "revision": 1,
     }
-    to_pos = PosSchema(line=0, ch=0)
-    from_pos = PosSchema(line=1, ch=1)
-    operation = Operation(
-        from_pos=from_pos.json(),
-        to_pos=to_pos.json(),
-        text=json.dumps(["new text"]),
+    await Operation.create(
+        document=document,
+        from_line=1,
+        from_ch=1,
+        to_line=0,
+        to_ch=0,
+        text="new text",
         type=OperationType.INPUT.value,
         revision=2,
     )
-    await operation.save()
-    await document.operations.add(operation)
     document.last_revision = 2
     await document.save()
 
-    with patch("quokka_editor_back.actors.task.transform") as mock_transform:
-        mock_transform.return_value = OperationSchema(
-            revision=2,
-            from_pos=PosSchema(line=0, ch=0),
-            to_pos=PosSchema(line=0, ch=0),
-            text=["new text"],
-            type=OperationType.INPUT.value,
+    with patch("quokka_editor_back.utils.ot.transform") as mock_transform:
+        mock_transform.return_value = Op(
+            0, 0, 0, 0, ["new text"], OperationType.INPUT, 2
         )
 
         # When
-        result = await transform_and_prepare_operation(op_data, document)
+        result = await transform_and_prepare_operations([op_data], document)
 
-    assert result is not None
-    assert isinstance(result, OperationSchema)
-    assert result.revision == 3
+    assert len(result) == 1
+    assert isinstance(result[0], Op)
+    assert result[0].revision == 3
 
-    mock_transform.assert_called_once_with(OperationSchema(**op_data), ANY)
+    mock_transform.assert_called_once_with(
+        Op.from_schema(OperationSchema(**op_data)),
+        Op(1, 1, 0, 0, ["new text"], OperationType.INPUT, 2),
+    )
+
+
+async def test_transform_and_prepare_operations_uses_history_cache(
+    document: Document, mocker
+):
+    # Given
+    op_data = {
+        "from_pos": {"line": 0, "ch": 0},
+        "to_pos": {"line": 0, "ch": 0},
+        "text": ["text"],
+        "type": OperationType.INPUT.value,
+        "revision": 1,
+    }
+    history = [Op(0, 0, 0, 0, ["new text"], OperationType.INPUT, 2)]
+    history_cache.store(document.id, 1, history)
+    document.last_revision = 2
+    load_ops_mock = mocker.patch.object(Operation, "load_ops")
+
+    # When
+    result = await transform_and_prepare_operations([op_data], document)
+
+    # Then
+    load_ops_mock.assert_not_called()
+    assert result[0].revision == 3
+    assert (result[0].from_line, result[0].from_ch) == (0, 8)
 
 
-async def test_apply_and_save_operation(document: Document, mocker):
+async def test_apply_and_save_operations(document: Document, mocker):
     # Given
-    data = "some test content"
+    data = ["some test content"]
     mocker.patch(
         "quokka_editor_back.actors.task.apply_operation",
-        return_value=data,
-    )
-    to_pos = PosSchema(line=0, ch=0)
-    from_pos = PosSchema(line=1, ch=1)
-    op = OperationSchema(
-        from_pos=from_pos,
-        to_pos=to_pos,
-        text=["new text"],
-        type=OperationType.INPUT.value,
-        revision=0,
+        return_value=LineBuffer(data),
     )
+    ops = [
+        Op(1, 1, 0, 0, ["new text"], OperationType.INPUT, revision)
+        for revision in (1, 2)
+    ]
 
     # When
-    await apply_and_save_operation(op, document)
+    await apply_and_save_operations(ops, document, ["first", "second"])
 
     # Then
     await document.refresh_from_db()
-    filtered_operations = await document.operations.filter(revision=op.revision)
-    assert len(filtered_operations) == 1
+    assert await Operation.filter(document_id=document.id).values_list(
+        "revision", "text", "user_token"
+    ) == [(1, "new text", "first"), (2, "new text", "second")]
     assert document.content == json.dumps(data).encode()
+    assert document.last_revision == 2
+
+
+async def test_apply_and_save_operations_caches_content(document: Document):
+    # Given
+    op = Op(0, 4, 0, 4, ["!"], OperationType.INPUT, 1)
+
+    # When
+    await apply_and_save_operations([op], document)
+
+    # Then
+    assert document_cache.get(document.id, 1) == ["test!"]
+
+
+async def test_apply_and_save_operations_after_content_replaced(
+    client, mock_get_current_user, document: Document, mocker
+):
+    # Given
+    mocker.patch("quokka_editor_back.routers.documents.get_redis", new=AsyncMock())
+    await apply_and_save_operations(
+        [Op(0, 4, 0, 4, ["!"], OperationType.INPUT, 1)], document
+    )
+    client.patch(url=f"/documents/{document.id}/", json={"content": ["new"]})
+    document = await Document.get(id=document.id)
+
+    # When
+    await apply_and_save_operations(
+        [Op(0, 3, 0, 3, ["!"], OperationType.INPUT, 2)], document
+    )
+
+    # Then
+    await document.refresh_from_db()
+    assert document.content == b'["new!"]'
+    assert document.content_generation == 1
+
+
+async def test_apply_and_save_operations_extends_history_cache(
+    document: Document,
+):
+    # Given
+    history_cache.store(document.id, 0, [])
+    op = Op(0, 4, 0, 4, ["!"], OperationType.INPUT, 1)
+
+    # When
+    await apply_and_save_operations([op], document)
+
+    # Then
+    assert history_cache.bridge(document.id, 0, 1) == [op]
+
+
+async def test_apply_and_save_operations_to_live_document(document: Document, mocker):
+    # Given
+    mocker.patch("quokka_editor_back.actors.task.is_live_backend", return_value=True)
+    mock_save_live_operations = mocker.patch(
+        "quokka_editor_back.actors.task.save_live_operations", new_callable=AsyncMock
+    )
+    redis_client_mock = Mock()
+    op = Op(0, 4, 0, 4, ["!"], OperationType.INPUT, 1)
+
+    # When
+    await apply_and_save_operations([op], document, ["first"], redis_client_mock)
+
+    # Then
+    mock_save_live_operations.assert_called_once_with(
+        redis_client_mock, document.id, [op], ["first"], b'["test!"]'
+    )
+    assert (document.content, document.last_revision) == (b'["test!"]', 1)
+    await document.refresh_from_db()
+    assert document.last_revision == 0
+    assert not await Operation.filter(document_id=document.id).exists()
+
+
+async def test_apply_and_save_operations_invalidates_cache_on_error(
+    document: Document, mocker
+):
+    # Given
+    document_cache.put(document.id, ["test"], document.last_revision)
+    mocker.patch.object(Document, "save", side_effect=Exception("Message"))
+    op = Op(0, 4, 0, 4, ["!"], OperationType.INPUT, 1)
+
+    # When
+    with pytest.raises(Exception, match="Message"):
+        await apply_and_save_operations([op], document)
+
+    # Then
+    assert document.id not in document_cache
 
 
 @patch("quokka_editor_back.routers.websockets.get_redis", new_callable=AsyncMock)
@@ -353,10 +680,230 @@ async def test_cleanup_with_redis_error(mock_get_redis, mocker):
     # Given
     document_id = uuid.uuid4()
     mocker.patch("tortoise.connection.connections.close_all", return_value=Mock())
+    mocker.patch(
+        "quokka_editor_back.actors.task.settings.worker_persistent_event_loop", False
+    )
+    mocker.patch(
+        "quokka_editor_back.actors.task.settings.task_broker", TaskBroker.RABBITMQ
+    )
+    mock_close_redis_pool = mocker.patch(
+        "quokka_editor_back.actors.task.close_redis_pool", new_callable=AsyncMock
+    )
+    mock_get_redis.llen.return_value = 0
 
     # When
     await cleanup(mock_get_redis, document_id)
 
     # Then
     mock_get_redis.delete.assert_called_once_with(f"document_processing_{document_id}")
+    mock_get_redis.close.assert_called_once_with()
+    mock_close_redis_pool.assert_called_once_with()
     tortoise.connections.close_all.assert_called_once_with()
+
+
+async def test_cleanup_keeps_pools_of_persistent_event_loop(mocker):
+    # Given
+    mock_close_all = mocker.patch(
+        "tortoise.connection.connections.close_all", new_callable=AsyncMock
+    )
+    mock_close_redis_pool = mocker.patch(
+        "quokka_editor_back.actors.task.close_redis_pool", new_callable=AsyncMock
+    )
+    redis_client_mock = AsyncMock()
+    redis_client_mock.llen.return_value = 0
+
+    # When
+    await cleanup(redis_client_mock, str(uuid.uuid4()))
+
+    # Then
+    redis_client_mock.close.assert_called_once_with()
+    mock_close_redis_pool.assert_not_called()
+    mock_close_all.assert_not_called()
+
+
+async def test_cleanup_releases_lease_and_redispatches_queue(mocker):
+    # Given
+    document_id = str(uuid.uuid4())
+    mocker.patch("tortoise.connection.connections.close_all", new_callable=AsyncMock)
+    mock_send = mocker.patch("quokka_editor_back.actors.task.transform_document.send")
+    redis_client_mock = AsyncMock()
+    redis_client_mock.llen.return_value = 2
+    redis_client_mock.set.return_value = True
+    lease = AsyncMock(spec=DocumentLease)
+
+    # When
+    await cleanup(redis_client_mock, document_id, lease)
+
+    # Then
+    lease.release.assert_called_once_with()
+    redis_client_mock.delete.assert_not_called()
+    lease_token = redis_client_mock.set.call_args.args[1]
+    mock_send.assert_called_once_with(document_id, lease_token)
+
+
+async def test_dispatch_document_with_lease_held(mocker):
+    # Given
+    mock_send = mocker.patch("quokka_editor_back.actors.task.transform_document.send")
+    redis_client_mock = AsyncMock()
+    redis_client_mock.set.return_value = None
+
+    # When
+    result = await dispatch_document(redis_client_mock, "document")
+
+    # Then
+    assert result is False
+    mock_send.assert_not_called()
+
+
+async def test_sweep_orphaned_queues(mocker):
+    # Given
+    mocker.patch(
+        "quokka_editor_back.actors.task.orphaned_documents",
+        return_value=MockAsyncIterator(["first", "second"]),
+    )
+    mock_dispatch_document = mocker.patch(
+        "quokka_editor_back.actors.task.dispatch_document",
+        new_callable=AsyncMock,
+        side_effect=[True, False],
+    )
+    redis_client_mock = AsyncMock()
+
+    # When
+    result = await sweep_orphaned_queues(redis_client_mock)
+
+    # Then
+    assert result == 1
+    assert mock_dispatch_document.call_count == 2
+
+
+async def test_process_operations_stops_when_lease_is_lost(document: Document, mocker):
+    # Given
+    value = '{"data": "test data", "user_token": "token"}'
+    mocker.patch(
+        "quokka_editor_back.actors.task.fetch_operations_from_redis",
+        return_value=MockAsyncIterator([[value], [value]]),
+    )
+    mock_process_operation_batch = mocker.patch(
+        "quokka_editor_back.actors.task.process_operation_batch", return_value=[]
+    )
+    lease = Mock(spec=DocumentLease, lost=True)
+
+    # When
+    await process_operations(AsyncMock(), document, lease)
+
+    # Then
+    mock_process_operation_batch.assert_called_once()
+
+
+async def test_process_operations_ends_turn_out_of_time(document: Document, mocker):
+    # Given
+    value = '{"data": "test data", "user_token": "token"}'
+    mock_fetch = mocker.patch(
+        "quokka_editor_back.actors.task.fetch_operations_from_redis",
+        return_value=MockAsyncIterator([[value], [value]]),
+    )
+    mock_process_operation_batch = mocker.patch(
+        "quokka_editor_back.actors.task.process_operation_batch", return_value=[]
+    )
+    mocker.patch("quokka_editor_back.actors.task.settings.document_turn_max_time", 0)
+    mocker.patch(
+        "quokka_editor_back.actors.task.settings.document_turn_max_operations", 7
+    )
+    redis_client = AsyncMock()
+
+    # When
+    await process_operations(redis_client, document)
+
+    # Then
+    mock_process_operation_batch.assert_called_once()
+    mock_fetch.assert_called_once_with(
+        redis_client, str(document.id), settings.operations_batch_size, 7
+    )
+
+
+async def test_async_document_task_skips_lease_taken_over(document: Document, mocker):
+    # Given
+    redis_client_mock = AsyncMock()
+    lock_mock = Mock(owned=AsyncMock(return_value=False))
+    redis_client_mock.lock = Mock(return_value=lock_mock)
+    mocker.patch(
+        "quokka_editor_back.actors.task.get_redis", return_value=redis_client_mock
+    )
+    mock_process_operations = mocker.patch(
+        "quokka_editor_back.actors.task.process_operations", new_callable=AsyncMock
+    )
+    mock_cleanup = mocker.patch(
+        "quokka_editor_back.actors.task.cleanup", new_callable=AsyncMock
+    )
+
+    # When
+    await async_document_task(str(document.id), "stale token")
+
+    # Then
+    mock_process_operations.assert_not_called()
+    mock_cleanup.assert_called_once_with(redis_client_mock, str(document.id), ANY)
+    assert mock_cleanup.call_args.args[2].lost
+
+
+async def test_send_transform_to_pinned_worker_slot(mocker):
+    # Given
+    mocker.patch("quokka_editor_back.actors.task.settings.worker_sharding", True)
+    mocker.patch.object(
+        shard_router, "queue_for", new_callable=AsyncMock, return_value="documents-3"
+    )
+    mock_declare_queue = mocker.patch.object(transform_document.broker, "declare_queue")
+    mock_enqueue = mocker.patch.object(transform_document.broker, "enqueue")
+
+    # When
+    await send_transform(AsyncMock(), "document", "token")
+
+    # Then
+    mock_declare_queue.assert_called_once_with("documents-3")
+    message = mock_enqueue.call_args.args[0]
+    assert message.queue_name == "documents-3"
+    assert message.actor_name == "transform_document"
+    assert message.args == ("document", "token")
+
+
+async def test_send_transform_in_process(mocker):
+    # Given
+    mocker.patch(
+        "quokka_editor_back.actors.task.settings.transform_engine",
+        TransformEngine.IN_PROCESS,
+    )
+    mock_async_document_task = mocker.patch(
+        "quokka_editor_back.actors.task.async_document_task", new_callable=AsyncMock
+    )
+    mock_send = mocker.patch("quokka_editor_back.actors.task.transform_document.send")
+
+    # When
+    await send_transform(AsyncMock(), "document", "token")
+    await finish_sequencers()
+
+    # Then
+    mock_async_document_task.assert_called_once_with("document", "token")
+    mock_send.assert_not_called()
+    assert sequencers == {}
+
+
+async def test_cleanup_keeps_pools_of_in_process_engine(mocker):
+    # Given
+    mocker.patch(
+        "quokka_editor_back.actors.task.settings.transform_engine",
+        TransformEngine.IN_PROCESS,
+    )
+    mocker.patch(
+        "quokka_editor_back.actors.task.settings.worker_persistent_event_loop", False
+    )
+    mock_close_all = mocker.patch(
+        "tortoise.connection.connections.close_all", new_callable=AsyncMock
+    )
+    redis_client_mock = AsyncMock()
+    redis_client_mock.llen.return_value = 0
+
+    # When
+    await cleanup(redis_client_mock, str(uuid.uuid4()))
+
+    # Then
+    redis_client_mock.close.assert_called_once_with()
+    mock_close_all.assert_not_called()
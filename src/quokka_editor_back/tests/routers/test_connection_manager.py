@@ -1,12 +1,22 @@
+import asyncio
 import uuid
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, call
 
+import msgpack
 import pytest
 from fastapi import WebSocket
 
 from quokka_editor_back.models.user import User
 from quokka_editor_back.routers import manager
-from quokka_editor_back.schema.websocket import MessageTypeEnum
+from quokka_editor_back.routers.connection_manager import CatchUp, ConnectionManager
+from quokka_editor_back.schema.websocket import (
+    MessageTypeEnum,
+    OverflowPolicy,
+    PresenceEvent,
+    WireProtocol,
+)
+from quokka_editor_back.utils.messages import encode_message
+from quokka_editor_back.utils.protocol import EncodedMessage
 
 
 async def test_websocket_manager_connect(websocket: WebSocket, active_user: User):
@@ -49,23 +59,6 @@ async def test_websocket_manager_send_personal_message(websocket: WebSocket):
     websocket.send_text.assert_called_once_with(message)
 
 
-async def test_websocket_manager_ack_message(websocket: WebSocket):
-    # Given
-    message = "ACK"
-    revision = 1
-    user_token = "user_token"
-    expected_data = {
-        "revision_log": revision,
-        "user_token": user_token,
-        "type": MessageTypeEnum.ACKNOWLEDGE,
-    }
-    # When
-    await manager.ack_message(websocket, revision, user_token)
-
-    # Then
-    websocket.send_json.assert_called_once_with(expected_data)
-
-
 @pytest.mark.parametrize(
     "send_to_owner, revision",
     [
@@ -93,18 +86,21 @@ async def test_websocket_manager_broadcast(
     # When
     await manager.broadcast(
         message,
-        websocket,
         document_id,
         user_token=user_token,
         revision=revision,
         send_to_owner=send_to_owner,
     )
+    await manager.drain(document_id)
 
     # Then
-    websocket.send_text.assert_not_called()
+    websocket.send_json.assert_called_once()
     if send_to_owner:
-        assert websocket.send_json.call_count == 3
-    other_websocket.send_text.assert_not_called()
+        assert websocket.send_text.call_count == 1
+        assert other_websocket.send_text.call_count == 1
+    else:
+        websocket.send_text.assert_not_called()
+        other_websocket.send_text.assert_not_called()
 
 
 async def test_websocket_manager_broadcast_without_not_required_fields(
@@ -137,9 +133,539 @@ async def test_websocket_manager_broadcast_without_not_required_fields(
     )
 
     # When
-    await manager.broadcast(message, websocket, document_id, user_token=user_token)
+    await manager.broadcast(message, document_id, user_token=user_token)
+    await manager.drain(document_id)
 
     # Then
-    websocket.send_text.assert_not_called()
-    websocket.send_json.assert_called_with(send_json_data)
+    websocket.send_text.assert_called_once_with(encode_message(send_json_data))
     other_websocket.send_json.assert_called_once_with(other_websocket_send_json_data)
+    other_websocket.send_text.assert_called_once_with(encode_message(send_json_data))
+
+
+async def test_websocket_manager_broadcast_acks_owner_and_forwards_to_others(
+    websocket: WebSocket, active_user: User
+):
+    # Given
+    document_id = uuid.uuid4()
+    message = {"data": "change"}
+    other_websocket = AsyncMock(spec=WebSocket)
+    await manager.connect(websocket, document_id, active_user.username, "owner")
+    await manager.connect(other_websocket, document_id, "other_user", "other")
+    await manager.drain(document_id)
+    websocket.send_text.reset_mock()
+    other_websocket.send_text.reset_mock()
+
+    # When
+    await manager.broadcast(message, document_id, user_token="owner", revision=2)
+    await manager.drain(document_id)
+
+    # Then
+    websocket.send_text.assert_called_once_with(
+        encode_message(
+            {
+                "revision_log": 2,
+                "user_token": "owner",
+                "type": MessageTypeEnum.ACKNOWLEDGE,
+            }
+        )
+    )
+    other_websocket.send_text.assert_called_once_with(encode_message(message))
+
+
+async def test_websocket_manager_broadcast_acks_batch_once(websocket: WebSocket):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    await connection_manager.connect(websocket, document_id, "owner", "owner")
+    await connection_manager.drain(document_id)
+    websocket.send_text.reset_mock()
+
+    # When
+    await connection_manager.broadcast(
+        "[]", document_id, user_token="owner", revision=6, first_revision=4
+    )
+    await connection_manager.drain(document_id)
+
+    # Then
+    websocket.send_text.assert_called_once_with(
+        encode_message(
+            {
+                "revision_log": 6,
+                "user_token": "owner",
+                "type": MessageTypeEnum.ACKNOWLEDGE,
+                "revision_range": [4, 6],
+            }
+        )
+    )
+
+
+async def test_websocket_manager_subscribe_once_per_document(
+    websocket: WebSocket, active_user: User
+):
+    # Given
+    document_id = uuid.uuid4()
+    listen = AsyncMock()
+    other_websocket = AsyncMock(spec=WebSocket)
+    await manager.connect(websocket, document_id, active_user.username, "first")
+    await manager.connect(other_websocket, document_id, "other_user", "second")
+
+    # When
+    manager.subscribe(document_id, listen)
+    manager.subscribe(document_id, listen)
+    listener = manager.listeners[document_id]
+
+    # Then
+    listen.assert_called_once_with(document_id, manager.subscribed[document_id])
+    await manager.disconnect(websocket, document_id)
+    assert manager.listeners[document_id] is listener
+    await manager.disconnect(other_websocket, document_id)
+    assert document_id not in manager.listeners
+    await asyncio.sleep(0)
+    assert listener.cancelled()
+
+
+async def test_websocket_manager_broadcast_does_not_wait_for_slow_socket(
+    websocket: WebSocket, active_user: User
+):
+    # Given
+    document_id = uuid.uuid4()
+    stalled = asyncio.Event()
+    slow_websocket = AsyncMock(spec=WebSocket)
+    await manager.connect(slow_websocket, document_id, "slow_user", "slow")
+    await manager.connect(websocket, document_id, active_user.username, "fast")
+    await manager.drain(document_id)
+
+    async def stall(message):
+        await stalled.wait()
+
+    slow_websocket.send_text.side_effect = stall
+
+    # When
+    await manager.broadcast({"data": "change"}, document_id, user_token="owner")
+    await manager.outboxes[websocket].join()
+
+    # Then
+    websocket.send_text.assert_called_with(encode_message({"data": "change"}))
+    assert manager.send_stats(document_id)["queue_depth"] == 0
+    assert len(manager.outboxes[slow_websocket]) == 0
+    stalled.set()
+    await manager.drain(document_id)
+    await manager.disconnect(slow_websocket, document_id)
+    await manager.disconnect(websocket, document_id)
+
+
+@pytest.mark.parametrize(
+    "overflow_policy, closed",
+    [(OverflowPolicy.DROP_CURSORS, False), (OverflowPolicy.DISCONNECT, True)],
+)
+async def test_websocket_manager_overflow_drops_cursors_first(
+    websocket: WebSocket, overflow_policy: OverflowPolicy, closed: bool
+):
+    # Given
+    connection_manager = ConnectionManager(
+        send_queue_size=2, overflow_policy=overflow_policy
+    )
+    document_id = uuid.uuid4()
+    await connection_manager.connect(websocket, document_id, "user", "user")
+    outbox = connection_manager.outboxes[websocket]
+    cursor, first_change, second_change = '"cursor"', '"change 1"', '"change 2"'
+
+    # When
+    connection_manager.enqueue(websocket, cursor, droppable=True)
+    connection_manager.enqueue(websocket, first_change)
+    connection_manager.enqueue(websocket, second_change)
+
+    # Then
+    assert outbox.closed is closed
+    if closed:
+        assert connection_manager.send_stats(document_id)["overflows"] == 1
+    else:
+        await outbox.join()
+        assert websocket.send_text.call_args_list == [
+            call(first_change),
+            call(second_change),
+        ]
+        assert connection_manager.send_stats(document_id)["dropped"] == 1
+
+
+async def test_websocket_manager_overflow_disconnects_when_only_changes_queued(
+    websocket: WebSocket,
+):
+    # Given
+    connection_manager = ConnectionManager(send_queue_size=1)
+    document_id = uuid.uuid4()
+    await connection_manager.connect(websocket, document_id, "user", "user")
+
+    # When
+    connection_manager.enqueue(websocket, '"change 1"')
+    dropped_cursor = connection_manager.enqueue(websocket, '"cursor"', droppable=True)
+    queued_change = connection_manager.enqueue(websocket, '"change 2"')
+    await asyncio.sleep(0)
+
+    # Then
+    assert dropped_cursor is False
+    assert queued_change is False
+    assert connection_manager.outboxes[websocket].closed
+    websocket.close.assert_called_once()
+
+
+async def test_websocket_manager_send_stats(websocket: WebSocket):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    await connection_manager.connect(websocket, document_id, "user", "user")
+
+    # When
+    await connection_manager.broadcast({"data": "change"}, document_id, "other")
+    await connection_manager.drain(document_id)
+    stats = connection_manager.send_stats(document_id)
+
+    # Then
+    assert stats["connections"] == 1
+    assert stats["queue_depth"] == 0
+    assert stats["peak_queue_depth"] == 1
+    assert stats["sent"] == 1
+    assert stats["max_send_latency"] >= 0
+
+
+async def test_websocket_manager_broadcast_per_protocol(websocket: WebSocket):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    msgpack_websocket = AsyncMock(spec=WebSocket)
+    await connection_manager.connect(websocket, document_id, "user", "json")
+    await connection_manager.connect(
+        msgpack_websocket,
+        document_id,
+        "other_user",
+        "msgpack",
+        WireProtocol.MSGPACK,
+        "quokka.msgpack",
+    )
+    await connection_manager.drain(document_id)
+    websocket.send_text.reset_mock()
+    message = {"data": "change", "user_token": "owner"}
+
+    # When
+    await connection_manager.broadcast(message, document_id, user_token="owner")
+    await connection_manager.drain(document_id)
+
+    # Then
+    msgpack_websocket.accept.assert_called_once_with(subprotocol="quokka.msgpack")
+    msgpack_websocket.send_bytes.assert_called_with(msgpack.packb(message))
+    websocket.send_text.assert_called_once_with(encode_message(message))
+
+
+async def test_websocket_manager_update_cursor_coalesces_per_user(
+    websocket: WebSocket,
+):
+    # Given
+    connection_manager = ConnectionManager(cursor_flush_rate=100)
+    document_id = uuid.uuid4()
+    await connection_manager.connect(websocket, document_id, "viewer", "viewer")
+    await connection_manager.drain(document_id)
+    websocket.send_text.reset_mock()
+    cursors = [{"data": {"type": "cursor", "line": line}} for line in range(3)]
+
+    # When
+    for cursor in cursors:
+        connection_manager.update_cursor(document_id, "editor", cursor)
+    await connection_manager.cursor_flushers[document_id]
+    await connection_manager.drain(document_id)
+
+    # Then
+    websocket.send_text.assert_called_once_with(encode_message(cursors[-1]))
+    assert connection_manager.send_stats(document_id)["coalesced"] == 2
+    assert not connection_manager.pending_cursors[document_id]
+
+
+async def test_websocket_manager_cursor_interval_adapts_to_viewers():
+    # Given
+    connection_manager = ConnectionManager(
+        cursor_flush_rate=20, cursor_send_budget=100
+    )
+    document_id = uuid.uuid4()
+    connection_manager.presence[document_id] = {
+        str(index): {"user_token": str(index)} for index in range(11)
+    }
+
+    # When
+    connection_manager.pending_cursors[document_id] = {"0": {}}
+    single_cursor = connection_manager.cursor_interval(document_id)
+    connection_manager.pending_cursors[document_id] = {"0": {}, "1": {}, "2": {}}
+    many_cursors = connection_manager.cursor_interval(document_id)
+
+    # Then
+    assert single_cursor == 0.1
+    assert many_cursors == pytest.approx(0.3)
+
+
+async def test_websocket_manager_disconnect_drops_pending_cursor(
+    websocket: WebSocket,
+):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    await connection_manager.connect(websocket, document_id, "user", "user")
+    connection_manager.update_cursor(document_id, "user", {"data": "cursor"})
+    flusher = connection_manager.cursor_flushers[document_id]
+
+    # When
+    await connection_manager.disconnect(websocket, document_id)
+    await asyncio.sleep(0)
+
+    # Then
+    assert flusher.cancelled()
+    assert document_id not in connection_manager.pending_cursors
+
+
+async def test_websocket_manager_connect_registers_presence(websocket: WebSocket):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    remote_user = {"username": "remote", "user_token": "remote", "clientColor": "#FFF"}
+
+    # When
+    connection_id = await connection_manager.connect(
+        websocket, document_id, "user", "user", users={"remote-id": remote_user}
+    )
+
+    # Then
+    websocket.send_json.assert_called_once_with([remote_user])
+    assert connection_manager.presence[document_id] == {
+        "remote-id": remote_user,
+        connection_id: connection_manager.active_connections[document_id][websocket],
+    }
+    assert connection_manager.local_presence(document_id) == {
+        connection_id: connection_manager.active_connections[document_id][websocket]
+    }
+
+
+async def test_websocket_manager_handle_event_join(websocket: WebSocket):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    await connection_manager.connect(websocket, document_id, "user", "user")
+    await connection_manager.drain(document_id)
+    user = {"username": "remote", "user_token": "remote", "clientColor": "#FFF"}
+
+    # When
+    await connection_manager.handle_event(
+        document_id,
+        PresenceEvent.JOIN,
+        {"origin": "other-node", "connection_id": "remote-id", "user": user},
+    )
+    await connection_manager.drain(document_id)
+
+    # Then
+    assert connection_manager.presence[document_id]["remote-id"] == user
+    websocket.send_text.assert_called_once_with(encode_message(user))
+
+
+async def test_websocket_manager_handle_event_ignores_own_events(
+    websocket: WebSocket,
+):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    await connection_manager.connect(websocket, document_id, "user", "user")
+    cursor = {"data": {"type": "cursor"}, "user_token": "other"}
+
+    # When
+    await connection_manager.handle_event(
+        document_id,
+        PresenceEvent.CURSORS,
+        {"origin": connection_manager.node_id, "cursors": [cursor]},
+    )
+    await connection_manager.drain(document_id)
+
+    # Then
+    websocket.send_text.assert_not_called()
+
+
+async def test_websocket_manager_handle_event_content_drops_cached_snapshot():
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    snapshot = EncodedMessage({"type": MessageTypeEnum.SNAPSHOT, "revision": 4})
+    connection_manager.cache_snapshot(document_id, 4, snapshot)
+    connection_manager.remember_operations(document_id, 5, 5, "change 5")
+
+    # When
+    await connection_manager.handle_event(
+        document_id, PresenceEvent.CONTENT, {"origin": "other"}
+    )
+
+    # Then
+    assert connection_manager.cached_snapshot(document_id) is None
+    assert connection_manager.recent_changes(document_id, 4) is None
+
+
+async def test_websocket_manager_sync_presence_announces_vanished_users(
+    websocket: WebSocket,
+):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    connection_id = await connection_manager.connect(
+        websocket,
+        document_id,
+        "user",
+        "user",
+        users={"dead-id": {"user_token": "dead"}, "live-id": {"user_token": "live"}},
+    )
+    await connection_manager.drain(document_id)
+
+    # When
+    await connection_manager.sync_presence(
+        document_id, {"live-id": {"user_token": "live"}}
+    )
+    await connection_manager.drain(document_id)
+
+    # Then
+    assert set(connection_manager.presence[document_id]) == {"live-id", connection_id}
+    websocket.send_text.assert_called_once_with(
+        encode_message(
+            {"message": "User dead Disconnected from the file.", "user_token": "dead"}
+        )
+    )
+
+
+async def test_websocket_manager_update_cursor_publishes_flushed_cursors():
+    # Given
+    connection_manager = ConnectionManager(cursor_flush_rate=100)
+    document_id = uuid.uuid4()
+    publish = AsyncMock()
+    cursor = {"data": {"type": "cursor"}, "user_token": "editor"}
+
+    # When
+    connection_manager.update_cursor(document_id, "editor", cursor, publish)
+    await connection_manager.cursor_flushers[document_id]
+
+    # Then
+    publish.assert_called_once_with(document_id, [cursor])
+
+
+def test_websocket_manager_recent_changes():
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    connection_manager.remember_operations(document_id, 3, 3, "change 3")
+    connection_manager.remember_operations(document_id, 4, 6, "changes 4-6")
+
+    # When / Then
+    assert connection_manager.recent_changes(document_id, 2) == CatchUp(
+        ["change 3", "changes 4-6"], 6
+    )
+    assert connection_manager.recent_changes(document_id, 6) == CatchUp([], 6)
+    assert connection_manager.recent_changes(document_id, 1) is None
+    assert connection_manager.recent_changes(document_id, 4) is None
+    assert connection_manager.recent_changes(document_id, 7) is None
+
+
+def test_websocket_manager_recent_changes_with_gap():
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    connection_manager.remember_operations(document_id, 3, 3, "change 3")
+    connection_manager.remember_operations(document_id, 6, 6, "change 6")
+
+    # When / Then
+    assert connection_manager.recent_changes(document_id, 2) is None
+    assert connection_manager.recent_changes(document_id, 5) == CatchUp(["change 6"], 6)
+
+
+def test_websocket_manager_cached_snapshot():
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    snapshot = EncodedMessage({"type": MessageTypeEnum.SNAPSHOT, "revision": 4})
+    connection_manager.cache_snapshot(document_id, 4, snapshot)
+    connection_manager.remember_operations(document_id, 5, 5, "change 5")
+
+    # When / Then
+    assert connection_manager.cached_snapshot(document_id) == CatchUp(
+        [snapshot, "change 5"], 5
+    )
+    connection_manager.remember_operations(document_id, 6, 6, "change 6")
+    connection_manager.recent_operations[document_id].popleft()
+    assert connection_manager.cached_snapshot(document_id) is None
+    assert connection_manager.cached_snapshot(uuid.uuid4()) is None
+
+
+async def test_websocket_manager_connect_sends_snapshot_first(websocket: WebSocket):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    snapshot = {"type": MessageTypeEnum.SNAPSHOT, "revision": 0, "content": [""]}
+    sent = []
+    websocket.send_text.side_effect = lambda frame: sent.append(frame)
+    websocket.send_json.side_effect = lambda users: sent.append(users)
+
+    # When
+    await connection_manager.connect(
+        websocket,
+        document_id,
+        "user",
+        "user",
+        catch_up=CatchUp([EncodedMessage(snapshot)], 0),
+    )
+    await connection_manager.drain(document_id)
+
+    # Then
+    assert sent == [
+        encode_message(snapshot),
+        [],
+        encode_message({"type": MessageTypeEnum.CATCH_UP, "revision": 0}),
+    ]
+
+
+async def test_websocket_manager_connect_catches_up(websocket: WebSocket):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    connection_manager.remember_operations(document_id, 5, 5, '"change 5"')
+    connection_manager.remember_operations(document_id, 6, 6, '"change 6"')
+
+    # When
+    await connection_manager.connect(
+        websocket,
+        document_id,
+        "user",
+        "user",
+        catch_up=CatchUp([{"revision": 5}], 5),
+    )
+    await connection_manager.drain(document_id)
+
+    # Then
+    assert websocket.send_text.call_args_list == [
+        call(encode_message({"revision": 5})),
+        call('"change 6"'),
+        call(encode_message({"type": MessageTypeEnum.CATCH_UP, "revision": 6})),
+    ]
+
+
+async def test_websocket_manager_broadcast_skips_caught_up_revisions(
+    websocket: WebSocket,
+):
+    # Given
+    connection_manager = ConnectionManager()
+    document_id = uuid.uuid4()
+    await connection_manager.connect(
+        websocket,
+        document_id,
+        "user",
+        "user",
+        catch_up=CatchUp([{"revision": 5}], 5),
+    )
+    await connection_manager.drain(document_id)
+    websocket.send_text.reset_mock()
+
+    # When
+    await connection_manager.broadcast('"change 5"', document_id, "other", 5)
+    await connection_manager.broadcast('"change 6"', document_id, "other", 6)
+    await connection_manager.drain(document_id)
+
+    # Then
+    websocket.send_text.assert_called_once_with('"change 6"')
+    assert websocket not in connection_manager.start_revisions
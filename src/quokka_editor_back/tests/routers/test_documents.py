@@ -1,16 +1,20 @@
 import json
 import uuid
+from unittest.mock import AsyncMock
 
 import pytest
 from fastapi import status
 from fastapi.testclient import TestClient
 
-from quokka_editor_back.models.document import Document
+from quokka_editor_back.models.document import Document, DocumentSnapshot
 from quokka_editor_back.models.project import Project, ShareRole
 from quokka_editor_back.models.user import User
 from quokka_editor_back.schema.document import (
     DocumentUpdatePayload,
 )
+from quokka_editor_back.schema.websocket import PresenceEvent
+from quokka_editor_back.utils.messages import pack_event
+from quokka_editor_back.utils.redis import document_channel
 
 
 async def test_share_document(
@@ -157,6 +161,51 @@ async def test_check_create_document(
     assert json_response["project_id"] == str(project.id)
 
 
+async def test_create_document_takes_initial_snapshot(
+    client: TestClient, mock_get_current_user, project: Project
+):
+    # When
+    response = client.post(url="/documents/", json={"project_id": str(project.id)})
+
+    # Then
+    snapshot = await DocumentSnapshot.get(document_id=response.json()["id"])
+    assert snapshot.revision == 0
+    assert snapshot.content == b'[""]'
+
+
+async def test_read_document_revision(
+    client: TestClient, mock_get_current_user, document: Document
+):
+    # Given
+    await DocumentSnapshot.create(document=document, revision=0, content=b'["old"]')
+
+    # When
+    response = client.get(url=f"/documents/{document.id}/revisions/0")
+
+    # Then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {
+        "id": str(document.id),
+        "revision": 0,
+        "content": ["old"],
+    }
+
+
+@pytest.mark.parametrize("revision", [0, 1])
+async def test_read_document_revision_not_found(
+    client: TestClient, mock_get_current_user, document: Document, revision: int
+):
+    # When
+    response = client.get(url=f"/documents/{document.id}/revisions/{revision}")
+
+    # Then
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert (
+        response.json()["detail"]
+        == f"Revision {revision} of document {document.id} not found"
+    )
+
+
 async def test_get_document_details1(
     client: TestClient, mock_get_current_user, document: Document, active_user: User
 ):
@@ -233,8 +282,10 @@ async def test_patch_document(
     key: str,
     value: str,
     desired_response: str,
+    mocker,
 ):
     # Given
+    mocker.patch("quokka_editor_back.routers.documents.get_redis", new=AsyncMock())
     request_data = {key: value}
 
     # When
@@ -246,6 +297,34 @@ async def test_patch_document(
     assert json_response[key] == desired_response
 
 
+async def test_patch_document_content_drops_cached_snapshots(
+    client: TestClient,
+    mock_get_current_user,
+    document: Document,
+    active_user: User,
+    mocker,
+):
+    # Given
+    redis_client = AsyncMock()
+    mocker.patch(
+        "quokka_editor_back.routers.documents.get_redis", return_value=redis_client
+    )
+    forget_content = mocker.patch(
+        "quokka_editor_back.routers.documents.manager.forget_content"
+    )
+
+    # When
+    response = client.patch(url=f"/documents/{document.id}/", json={"content": ["new"]})
+
+    # Then
+    assert response.status_code == status.HTTP_200_OK
+    forget_content.assert_called_once_with(document.id)
+    channel, event = redis_client.publish.call_args.args
+    assert channel == document_channel(document.id)
+    assert event.startswith(pack_event(PresenceEvent.CONTENT, ""))
+    redis_client.close.assert_called_once()
+
+
 async def test_patch_document_invalid_uuid(
     client: TestClient,
     mock_get_current_user,
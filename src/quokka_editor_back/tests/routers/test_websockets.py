@@ -1,31 +1,36 @@
+import asyncio
 import json
 from unittest.mock import AsyncMock, Mock, patch
 
+import msgpack
 import pytest
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeRedis
+from fastapi import WebSocketException, status
 from starlette.testclient import TestClient
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
 from quokka_editor_back.auth import auth_handler
 from quokka_editor_back.models.document import Document
+from quokka_editor_back.models.operation import Op, Operation, OperationType
 from quokka_editor_back.models.project import ShareRole
 from quokka_editor_back.routers import manager
+from quokka_editor_back.routers.connection_manager import CatchUp
 from quokka_editor_back.routers.websockets import (
-    decode_redis_message,
-    forward_from_redis_to_websocket,
+    forward_from_redis_to_websockets,
+    load_catch_up,
     process_websocket_message,
+    publish_cursors,
+    subscribe_channel_and_broadcast_redis_messages,
+    websocket_endpoint,
 )
 from quokka_editor_back.schema.auth import UserLogin
-
-
-async def test_decode_redis_message():
-    # Given
-    message = {"data": b'{"key": "value"}'}
-
-    # When
-    result = decode_redis_message(message)
-
-    # Then
-    assert result == {"key": "value"}
+from quokka_editor_back.schema.websocket import (
+    MessageTypeEnum,
+    PresenceEvent,
+    WireProtocol,
+)
+from quokka_editor_back.utils.messages import change_message
 
 
 class AsyncIterator:
@@ -41,39 +46,266 @@ class AsyncIterator:
         return self.items.pop(0)
 
 
-async def test_subscribe_channel_and_broadcast_redis_messages():
-    pass
+async def test_subscribe_channel_and_broadcast_redis_messages_event(
+    document: Document, mocker
+):
+    # Given
+    payload = {"origin": "node", "connection_id": "id", "user_token": "owner"}
+    pubsub = AsyncMock()
+    pubsub.listen = Mock(
+        return_value=AsyncIterator(
+            [{"type": "message", "data": f"!leave\n{json.dumps(payload)}".encode()}]
+        )
+    )
+    mocked_handle_event = mocker.patch(
+        "quokka_editor_back.routers.websockets.manager.handle_event",
+        new_callable=AsyncMock,
+    )
+    mocked_broadcast = mocker.patch(
+        "quokka_editor_back.routers.websockets.manager.broadcast",
+        new_callable=AsyncMock,
+    )
+
+    # When
+    await subscribe_channel_and_broadcast_redis_messages(
+        pubsub, document.id, "channel"
+    )
+
+    # Then
+    mocked_handle_event.assert_called_once_with(
+        document.id, PresenceEvent.LEAVE, payload
+    )
+    mocked_broadcast.assert_not_called()
+
+
+async def add_operations(document: Document, user_tokens: list[str]) -> list[Op]:
+    ops = [
+        Op(0, 4, 0, 4, ["!"], OperationType.INPUT, revision)
+        for revision in range(1, len(user_tokens) + 1)
+    ]
+    await Operation.bulk_create(
+        [
+            Operation.from_op(document.id, op, user_token)
+            for op, user_token in zip(ops, user_tokens)
+        ]
+    )
+    document.last_revision = len(ops)
+    await document.save()
+    return ops
+
+
+async def test_load_catch_up_from_operation_log(document: Document):
+    # Given
+    ops = await add_operations(document, ["first", "second"])
+
+    # When
+    result = await load_catch_up(document.id, 0)
+
+    # Then
+    assert result == CatchUp(
+        [change_message("first", ops[0]), change_message("second", ops[1])], 2
+    )
+
+
+async def test_load_catch_up_sends_snapshot_for_large_gap(
+    document: Document, mocker
+):
+    # Given
+    await add_operations(document, ["first", "second"])
+    mocker.patch(
+        "quokka_editor_back.routers.websockets.settings"
+        ".websocket_catch_up_max_operations",
+        1,
+    )
+
+    # When
+    result = await load_catch_up(document.id, 0)
+
+    # Then
+    assert result.revision == 2
+    assert [message.message for message in result.messages] == [
+        {"type": MessageTypeEnum.SNAPSHOT, "revision": 2, "content": ["test"]}
+    ]
+    manager.snapshots.pop(document.id)
+
+
+async def test_load_catch_up_sends_snapshot_on_join(document: Document):
+    # Given
+    await add_operations(document, ["first"])
+
+    # When
+    result = await load_catch_up(document.id, None)
+
+    # Then
+    (snapshot,) = result.messages
+    assert result.revision == 1
+    assert snapshot.message == {
+        "type": MessageTypeEnum.SNAPSHOT,
+        "revision": 1,
+        "content": ["test"],
+    }
+    assert manager.snapshots[document.id] == (1, snapshot)
+    manager.snapshots.pop(document.id)
+
+
+async def test_load_catch_up_serves_join_from_cached_snapshot(
+    document: Document, mocker
+):
+    # Given
+    snapshot = await load_catch_up(document.id, None)
+    manager.remember_operations(document.id, 1, 1, "change 1")
+    document_get = mocker.patch(
+        "quokka_editor_back.routers.websockets.Document.get"
+    )
+
+    # When
+    result = await load_catch_up(document.id, None)
+
+    # Then
+    assert result == CatchUp([*snapshot.messages, "change 1"], 1)
+    document_get.assert_not_called()
+    manager.snapshots.pop(document.id)
+    manager.recent_operations.pop(document.id)
+
+
+async def test_load_catch_up_from_recent_operations(document: Document):
+    # Given
+    manager.remember_operations(document.id, 1, 1, "change 1")
+
+    # When
+    result = await load_catch_up(document.id, 0)
+
+    # Then
+    assert result == CatchUp(["change 1"], 1)
+    manager.recent_operations.pop(document.id)
+
+
+def mock_redis_pipeline(dispatch: bool):
+    pipeline_mock = Mock(execute=AsyncMock(return_value=[1, dispatch]))
+    return Mock(pipeline=Mock(return_value=pipeline_mock)), pipeline_mock
+
+
+async def test_subscribe_channel_and_broadcast_redis_messages(
+    document: Document, mocker
+):
+    # Given
+    operation_message = {"data": {}, "user_token": "owner", "revision": 3}
+    pubsub = AsyncMock()
+    pubsub.listen = Mock(
+        return_value=AsyncIterator(
+            [
+                {"type": "subscribe", "data": 1},
+                {
+                    "type": "message",
+                    "data": f"owner 3\n{json.dumps(operation_message)}".encode(),
+                },
+            ]
+        )
+    )
+    mocked_broadcast = mocker.patch(
+        "quokka_editor_back.routers.websockets.manager.broadcast",
+        new_callable=AsyncMock,
+    )
+    subscribed = asyncio.Event()
+
+    # When
+    await subscribe_channel_and_broadcast_redis_messages(
+        pubsub, document.id, "channel", subscribed
+    )
+
+    # Then
+    pubsub.subscribe.assert_called_once_with("channel")
+    assert subscribed.is_set()
+    mocked_broadcast.assert_called_once_with(
+        message=json.dumps(operation_message),
+        document_id=document.id,
+        revision=3,
+        user_token="owner",
+        first_revision=3,
+    )
+    pubsub.unsubscribe.assert_called_once_with("channel")
+
+
+async def test_subscribe_channel_and_broadcast_redis_messages_survives_bad_message(
+    document: Document, mocker
+):
+    # Given
+    pubsub = AsyncMock()
+    pubsub.listen = Mock(
+        return_value=AsyncIterator(
+            [
+                {"type": "message", "data": b"garbage"},
+                {"type": "message", "data": b'owner 3\n{"data": {}}'},
+            ]
+        )
+    )
+    mocked_broadcast = mocker.patch(
+        "quokka_editor_back.routers.websockets.manager.broadcast",
+        new_callable=AsyncMock,
+    )
+
+    # When
+    await subscribe_channel_and_broadcast_redis_messages(pubsub, document.id, "channel")
+
+    # Then
+    mocked_broadcast.assert_called_once()
 
 
 @patch("quokka_editor_back.routers.websockets.get_redis", new_callable=AsyncMock)
-async def test_forward_from_redis_to_websocket(
-    mocked_get_redis,
-    client: TestClient,
-    active_user: UserLogin,
-    document: Document,
-    mocker,
+async def test_forward_from_redis_to_websockets(
+    mocked_get_redis, document: Document, mocker
 ):
     # Given
     mocked_subscribe_channel_and_broadcast_redis_messages = mocker.patch(
         "quokka_editor_back.routers.websockets.subscribe_channel_and_broadcast_redis_messages",
         new_callable=AsyncMock,
     )
-    pubsub_mock = AsyncMock()
+    pubsub_mock = Mock(return_value=AsyncMock())
     close_mock = AsyncMock()
     mocked_get_redis.return_value.pubsub = pubsub_mock
     mocked_get_redis.return_value.close = close_mock
-    token = auth_handler.encode_token(active_user.username)
 
     # When
-    await forward_from_redis_to_websocket(mocker.Mock(), document.id, token)
+    await forward_from_redis_to_websockets(document.id)
 
     # Then
     mocked_get_redis.assert_called_once()
-    mocked_subscribe_channel_and_broadcast_redis_messages.assert_called_once()
-    pubsub_mock.assert_called_once()
+    mocked_subscribe_channel_and_broadcast_redis_messages.assert_called_once_with(
+        pubsub_mock.return_value, document.id, f"document_{document.id}", None
+    )
+    pubsub_mock.return_value.reset.assert_called_once()
     close_mock.assert_called_once()
 
 
+@patch("quokka_editor_back.routers.websockets.get_redis", new_callable=AsyncMock)
+async def test_forward_from_redis_to_websockets_resubscribes(
+    mocked_get_redis, document: Document, mocker
+):
+    # Given
+    mocked_subscribe_channel_and_broadcast_redis_messages = mocker.patch(
+        "quokka_editor_back.routers.websockets.subscribe_channel_and_broadcast_redis_messages",
+        new_callable=AsyncMock,
+        side_effect=[ConnectionError("Connection closed by server."), None],
+    )
+    mocker.patch(
+        "quokka_editor_back.routers.websockets.settings.websocket_resubscribe_delay", 0
+    )
+    mocked_get_redis.return_value.pubsub = Mock(side_effect=[AsyncMock(), AsyncMock()])
+    forget_content = mocker.patch(
+        "quokka_editor_back.routers.websockets.manager.forget_content"
+    )
+    subscribed = asyncio.Event()
+    subscribed.set()
+
+    # When
+    await forward_from_redis_to_websockets(document.id, subscribed)
+
+    # Then
+    assert mocked_subscribe_channel_and_broadcast_redis_messages.call_count == 2
+    assert not subscribed.is_set()
+    forget_content.assert_called_once_with(document.id)
+
+
 async def test_process_websocket_message_cursor(
     active_user: UserLogin, document: Document, mocker
 ):
@@ -82,17 +314,12 @@ async def test_process_websocket_message_cursor(
     data = '{"type": "cursor"}'
     json_data = json.loads(data)
     new_data = {'data': json_data, 'user_token': token}
-    mock_manager = AsyncMock()
-    mocked_manager = mocker.patch(
-        "quokka_editor_back.routers.websockets.manager", mock_manager
-    )
+    mocked_manager = mocker.patch("quokka_editor_back.routers.websockets.manager")
     redis_client_mock = mocker.patch("redis.asyncio", new_callable=AsyncMock)
-    websocket_mock = mocker.Mock()
 
     # When
     await process_websocket_message(
         data=data,
-        websocket=websocket_mock,
         redis_client=redis_client_mock,
         document_id=document.id,
         user_token=token,
@@ -100,15 +327,11 @@ async def test_process_websocket_message_cursor(
     )
 
     # Then
-    mocked_manager.broadcast.assert_called_once_with(
-        new_data,
-        websocket_mock,
-        document_id=document.id,
-        send_to_owner=False,
-        user_token=token,
+    mocked_manager.update_cursor.assert_called_once_with(
+        document.id, token, new_data, publish_cursors
     )
-    redis_client_mock.rpush.assert_not_called()
-    redis_client_mock.set.assert_not_called()
+    mocked_manager.broadcast.assert_not_called()
+    redis_client_mock.pipeline.assert_not_called()
 
 
 @patch("quokka_editor_back.actors.transform_document.send", new_callable=AsyncMock)
@@ -125,12 +348,11 @@ async def test_process_websocket_message(
     json_data = json.loads(data)
     new_data = json.dumps({"data": json_data, "user_token": token})
     mock_manager = AsyncMock()
-    redis_client_mock = mocker.patch("redis.asyncio", new_callable=AsyncMock)
+    redis_client_mock, pipeline_mock = mock_redis_pipeline(dispatch=True)
 
     # When
     await process_websocket_message(
         data=data,
-        websocket=mocker.Mock(),
         redis_client=redis_client_mock,
         document_id=document.id,
         user_token=token,
@@ -139,13 +361,88 @@ async def test_process_websocket_message(
 
     # Then
     mock_manager.broadcast.assert_not_called()
-    redis_client_mock.rpush.assert_called_once_with(
+    pipeline_mock.rpush.assert_called_once_with(
         f"document_operations_{document.id}", new_data
     )
-    redis_client_mock.set.assert_called_once_with(
-        f"document_processing_{document.id}", 1, nx=True
+    lease_token = pipeline_mock.set.call_args.args[1]
+    pipeline_mock.set.assert_called_once_with(
+        f"document_processing_{document.id}", lease_token, nx=True, px=30000
+    )
+    pipeline_mock.execute.assert_called_once_with()
+    mock_transform_document_send.assert_called_once_with(
+        str(document.id), lease_token
+    )
+
+
+@patch("quokka_editor_back.actors.transform_document.send", new_callable=AsyncMock)
+async def test_process_websocket_message_batch(
+    mock_transform_document_send, document: Document
+):
+    # Given
+    ops = [
+        {
+            "from_pos": {"line": 0, "ch": ch},
+            "to_pos": {"line": 0, "ch": ch},
+            "text": [text],
+            "type": "+INPUT",
+            "revision": 3,
+        }
+        for ch, text in enumerate("ab")
+    ]
+    redis_client_mock, pipeline_mock = mock_redis_pipeline(dispatch=False)
+
+    # When
+    await process_websocket_message(
+        data=json.dumps(ops),
+        redis_client=redis_client_mock,
+        document_id=document.id,
+        user_token="token",
+        read_only=False,
+    )
+
+    # Then
+    pipeline_mock.rpush.assert_called_once_with(
+        f"document_operations_{document.id}",
+        json.dumps({"data": ops, "user_token": "token"}),
+    )
+    pipeline_mock.execute.assert_called_once_with()
+    mock_transform_document_send.assert_not_called()
+
+
+@patch("quokka_editor_back.actors.transform_document.send", new_callable=AsyncMock)
+async def test_process_websocket_message_msgpack(
+    mock_transform_document_send, document: Document
+):
+    # Given
+    data = msgpack.packb([0, 1, 0, 1, ["x"], "+INPUT", 3])
+    redis_client_mock, pipeline_mock = mock_redis_pipeline(dispatch=True)
+
+    # When
+    await process_websocket_message(
+        data=data,
+        redis_client=redis_client_mock,
+        document_id=document.id,
+        user_token="token",
+        read_only=False,
+        protocol=WireProtocol.MSGPACK,
+    )
+
+    # Then
+    pipeline_mock.rpush.assert_called_once_with(
+        f"document_operations_{document.id}",
+        json.dumps(
+            {
+                "data": {
+                    "from_pos": {"line": 0, "ch": 1},
+                    "to_pos": {"line": 0, "ch": 1},
+                    "text": ["x"],
+                    "type": "+INPUT",
+                    "revision": 3,
+                },
+                "user_token": "token",
+            }
+        ),
     )
-    mock_transform_document_send.assert_called_once_with(str(document.id))
 
 
 @patch("quokka_editor_back.routers.websockets.get_redis", new_callable=AsyncMock)
@@ -160,7 +457,6 @@ async def test_process_websocket_message_read_only(
     # When
     await process_websocket_message(
         data=data,
-        websocket=mocker.Mock(),
         redis_client=mock_redis,
         document_id=document.id,
         user_token=token,
@@ -169,8 +465,7 @@ async def test_process_websocket_message_read_only(
 
     # Then
     mock_manager.broadcast.assert_not_called()
-    mock_redis.rpush.assert_not_called()
-    mock_redis.set.assert_not_called()
+    mock_redis.pipeline.assert_not_called()
 
 
 @pytest.mark.skip("Testing the websocket connection will be fixed later")
@@ -199,7 +494,7 @@ async def test_websocket_properly_connect_and_disconnect(
     )
     mocker.patch("asyncio.create_task", mock_manager)
     mocker.patch(
-        "quokka_editor_back.routers.websockets.forward_from_redis_to_websocket",
+        "quokka_editor_back.routers.websockets.forward_from_redis_to_websockets",
         mock_manager,
     )
 
@@ -215,7 +510,6 @@ async def test_websocket_properly_connect_and_disconnect(
                     "user_token": token,
                 }
             ),
-            websocket=websocket,
             document_id=document.id,
             user_token=token,
             send_to_owner=False,
@@ -224,6 +518,34 @@ async def test_websocket_properly_connect_and_disconnect(
         mocked_manager.disconnect.assert_called_once_with(websocket, document.id)
 
 
+@patch("quokka_editor_back.routers.websockets.get_redis", new_callable=AsyncMock)
+async def test_websocket_endpoint_closes_when_subscribing_times_out(
+    mocked_get_redis, websocket, document: Document, mocker
+):
+    # Given
+    mocker.patch(
+        "quokka_editor_back.routers.websockets.authenticate_websocket",
+        return_value=(None, ShareRole.READ),
+    )
+    mocker.patch(
+        "quokka_editor_back.routers.websockets.settings.websocket_subscribe_timeout",
+        0.01,
+    )
+    mocked_manager = mocker.patch("quokka_editor_back.routers.websockets.manager")
+    mocked_manager.subscribe.return_value = asyncio.Event()
+    websocket.scope = {}
+
+    # When
+    with pytest.raises(WebSocketException) as exc_info:
+        await websocket_endpoint(websocket, document.id, None, None, None)
+
+    # Then
+    assert exc_info.value.code == status.WS_1013_TRY_AGAIN_LATER
+    mocked_manager.connect.assert_not_called()
+    mocked_manager.unsubscribe_idle.assert_called_once_with(document.id)
+    mocked_get_redis.return_value.close.assert_called_once()
+
+
 @pytest.mark.skip("Testing the websocket connection will be fixed later")
 @patch("quokka_editor_back.actors.transform_document", new_callable=AsyncMock)
 @patch("quokka_editor_back.routers.websockets.get_redis", new_callable=AsyncMock)
@@ -284,7 +606,7 @@ async def test_websocket_communication(
     token = auth_handler.encode_token(active_user.username)
 
     # When
-    with client.websocket_connect(f"/ws/{document.id}?token={token}") as websocket:
+    with client.websocket_connect(f"/ws/{document.id}?token={token}"):
         # Then
         mocked_manager_broadcast.assert_called_once_with(
             message=json.dumps(
@@ -293,7 +615,6 @@ async def test_websocket_communication(
                     "user_token": token,
                 }
             ),
-            websocket=websocket,
             document_id=document.id,
             user_token=token,
             send_to_owner=False,
@@ -307,10 +628,13 @@ async def test_get_redis(
     websocket,
     active_user: UserLogin,
     document: Document,
+    mocker,
 ):
-    close_mock = AsyncMock()
-    mocked_get_redis.return_value.close = close_mock
+    server = FakeServer()
+    mocked_get_redis.side_effect = lambda: FakeRedis(server=server)
+    close_mock = mocker.patch.object(FakeRedis, "close", new_callable=AsyncMock)
     token = auth_handler.encode_token(active_user.username)
     with client.websocket_connect(f"/ws/{document.id}?token={token}"):
         assert mocked_get_redis.call_count == 2
-    close_mock.assert_called_once()
+    # the document listener closes its own client too
+    assert close_mock.call_count == 2
@@ -0,0 +1,123 @@
+import random
+
+import pytest
+
+from quokka_editor_back.utils import buffer
+from quokka_editor_back.utils.buffer import LineBuffer
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(buffer, "CHUNK_SIZE", 4)
+
+
+def test_line_buffer_from_lines():
+    # Given
+    lines = ["first", "second", "third"]
+
+    # When
+    line_buffer = LineBuffer(lines)
+
+    # Then
+    assert len(line_buffer) == 3
+    assert list(line_buffer) == lines
+    assert line_buffer.char_count == sum(map(len, lines))
+    assert line_buffer == lines
+
+
+def test_line_buffer_empty():
+    # When
+    line_buffer = LineBuffer()
+
+    # Then
+    assert len(line_buffer) == 0
+    assert list(line_buffer) == []
+    with pytest.raises(IndexError):
+        line_buffer[0]
+
+
+def test_line_buffer_get_item(small_chunks):
+    # Given
+    lines = [str(number) for number in range(20)]
+
+    # When
+    line_buffer = LineBuffer(lines)
+
+    # Then
+    assert [line_buffer[index] for index in range(20)] == lines
+    assert line_buffer[-1] == "19"
+    assert line_buffer[3:11] == lines[3:11]
+    with pytest.raises(IndexError):
+        line_buffer[20]
+
+
+def test_line_buffer_rejects_extended_slices():
+    # Given
+    line_buffer = LineBuffer(["a", "b", "c"])
+
+    # When / Then
+    with pytest.raises(ValueError):
+        line_buffer[::2]
+
+
+@pytest.mark.parametrize(
+    "start, stop, new_lines",
+    [
+        (0, 0, ["new"]),
+        (5, 6, ["changed"]),
+        (3, 3, ["x"] * 30),
+        (2, 17, ["joined"]),
+        (0, 20, []),
+        (20, 20, ["appended", "lines"]),
+        (7, 9, []),
+    ],
+)
+def test_line_buffer_set_slice(small_chunks, start, stop, new_lines):
+    # Given
+    lines = [str(number) for number in range(20)]
+    line_buffer = LineBuffer(lines)
+
+    # When
+    line_buffer[start:stop] = new_lines
+    lines[start:stop] = new_lines
+
+    # Then
+    assert list(line_buffer) == lines
+    assert len(line_buffer) == len(lines)
+    assert line_buffer.char_count == sum(map(len, lines))
+
+
+def test_line_buffer_matches_list_under_random_edits(small_chunks):
+    # Given
+    randomizer = random.Random(42)
+    lines = [str(number) for number in range(50)]
+    line_buffer = LineBuffer(lines)
+
+    for _ in range(500):
+        start = randomizer.randint(0, len(lines))
+        stop = randomizer.randint(start, len(lines))
+        new_lines = [str(randomizer.random()) for _ in range(randomizer.randint(0, 9))]
+
+        # When
+        line_buffer[start:stop] = new_lines
+        lines[start:stop] = new_lines
+
+        # Then
+        assert list(line_buffer) == lines
+        if lines:
+            index = randomizer.randrange(len(lines))
+            assert line_buffer[index] == lines[index]
+
+
+def test_line_buffer_insert_and_delete(small_chunks):
+    # Given
+    line_buffer = LineBuffer(["a", "b", "c"])
+
+    # When
+    line_buffer.insert(1, "inserted")
+    line_buffer.append("last")
+    del line_buffer[0]
+    line_buffer[0] = "replaced"
+
+    # Then
+    assert list(line_buffer) == ["replaced", "b", "c", "last"]
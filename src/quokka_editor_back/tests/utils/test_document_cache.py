@@ -0,0 +1,128 @@
+import uuid
+
+from quokka_editor_back.utils.document_cache import (
+    DocumentCache,
+    estimate_content_size,
+)
+
+
+def test_document_cache_get_hit():
+    # Given
+    cache = DocumentCache(max_documents=2, max_bytes=10_000)
+    document_id = uuid.uuid4()
+    content = ["first line", "second line"]
+    cache.put(document_id, content, 3)
+
+    # When
+    result = cache.get(document_id, 3)
+
+    # Then
+    assert result is content
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 0
+
+
+def test_document_cache_get_miss():
+    # Given
+    cache = DocumentCache(max_documents=2, max_bytes=10_000)
+
+    # When
+    result = cache.get(uuid.uuid4(), 0)
+
+    # Then
+    assert result is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_document_cache_get_stale_revision():
+    # Given
+    cache = DocumentCache(max_documents=2, max_bytes=10_000)
+    document_id = uuid.uuid4()
+    cache.put(document_id, ["text"], 3)
+
+    # When
+    result = cache.get(document_id, 4)
+
+    # Then
+    assert result is None
+    assert document_id not in cache
+    assert cache.stats()["stale"] == 1
+    assert cache.stats()["bytes"] == 0
+
+
+def test_document_cache_get_stale_generation():
+    # Given
+    cache = DocumentCache(max_documents=2, max_bytes=10_000)
+    document_id = uuid.uuid4()
+    cache.put(document_id, ["text"], 3, 0)
+
+    # When
+    result = cache.get(document_id, 3, 1)
+
+    # Then
+    assert result is None
+    assert document_id not in cache
+    assert cache.stats()["stale"] == 1
+
+
+def test_document_cache_evicts_least_recently_used():
+    # Given
+    cache = DocumentCache(max_documents=2, max_bytes=10_000)
+    first_id, second_id, third_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    cache.put(first_id, ["first"], 1)
+    cache.put(second_id, ["second"], 1)
+    cache.get(first_id, 1)
+
+    # When
+    cache.put(third_id, ["third"], 1)
+
+    # Then
+    assert first_id in cache
+    assert second_id not in cache
+    assert third_id in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def test_document_cache_evicts_over_memory_limit():
+    # Given
+    content = ["x" * 100]
+    cache = DocumentCache(
+        max_documents=10, max_bytes=estimate_content_size(content) * 2
+    )
+    ids = [uuid.uuid4() for _ in range(3)]
+
+    # When
+    for document_id in ids:
+        cache.put(document_id, list(content), 1)
+
+    # Then
+    assert len(cache) == 2
+    assert ids[0] not in cache
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+
+def test_document_cache_skips_document_bigger_than_limit():
+    # Given
+    cache = DocumentCache(max_documents=10, max_bytes=10)
+    document_id = uuid.uuid4()
+
+    # When
+    cache.put(document_id, ["x" * 100], 1)
+
+    # Then
+    assert document_id not in cache
+    assert cache.stats()["bytes"] == 0
+
+
+def test_document_cache_invalidate():
+    # Given
+    cache = DocumentCache(max_documents=2, max_bytes=10_000)
+    document_id = uuid.uuid4()
+    cache.put(document_id, ["text"], 1)
+
+    # When
+    cache.invalidate(document_id)
+
+    # Then
+    assert document_id not in cache
+    assert cache.stats()["bytes"] == 0
@@ -0,0 +1,163 @@
+import uuid
+
+from quokka_editor_back.models.operation import Op, OperationType
+from quokka_editor_back.utils.history_cache import HistoryCache
+
+
+def make_ops(first_revision: int, count: int) -> list[Op]:
+    return [
+        Op(0, 0, 0, 0, ["a"], OperationType.INPUT, revision)
+        for revision in range(first_revision, first_revision + count)
+    ]
+
+
+def test_history_cache_bridge_hit():
+    # Given
+    cache = HistoryCache(max_documents=2, max_operations=100, max_age=60)
+    document_id = uuid.uuid4()
+    ops = make_ops(3, 4)
+    cache.store(document_id, 2, ops)
+
+    # When
+    result = cache.bridge(document_id, 4, 6)
+
+    # Then
+    assert result == ops[2:]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 0
+
+
+def test_history_cache_bridge_miss():
+    # Given
+    cache = HistoryCache(max_documents=2, max_operations=100, max_age=60)
+    document_id = uuid.uuid4()
+    cache.store(document_id, 2, make_ops(3, 4))
+
+    # When
+    older = cache.bridge(document_id, 1, 6)
+    moved_head = cache.bridge(document_id, 2, 7)
+    unknown = cache.bridge(uuid.uuid4(), 2, 6)
+
+    # Then
+    assert older is None
+    assert moved_head is None
+    assert unknown is None
+    assert cache.stats()["misses"] == 3
+
+
+def test_history_cache_store_older_base_replaces_run():
+    # Given
+    cache = HistoryCache(max_documents=2, max_operations=100, max_age=60)
+    document_id = uuid.uuid4()
+    cache.store(document_id, 4, make_ops(5, 2))
+
+    # When
+    cache.store(document_id, 2, make_ops(3, 4))
+
+    # Then
+    assert cache.bridge(document_id, 2, 6) == make_ops(3, 4)
+    assert cache.bridge(document_id, 4, 6) == make_ops(5, 2)
+
+
+def test_history_cache_store_ignores_gaps():
+    # Given
+    cache = HistoryCache(max_documents=2, max_operations=100, max_age=60)
+    document_id = uuid.uuid4()
+
+    # When
+    cache.store(document_id, 2, make_ops(3, 1) + make_ops(5, 1))
+
+    # Then
+    assert document_id not in cache
+
+
+def test_history_cache_extend():
+    # Given
+    cache = HistoryCache(max_documents=2, max_operations=100, max_age=60)
+    document_id = uuid.uuid4()
+    cache.store(document_id, 2, make_ops(3, 2))
+
+    # When
+    cache.extend(document_id, make_ops(5, 2))
+
+    # Then
+    assert cache.bridge(document_id, 2, 6) == make_ops(3, 4)
+
+
+def test_history_cache_extend_with_gap_drops_document():
+    # Given
+    cache = HistoryCache(max_documents=2, max_operations=100, max_age=60)
+    document_id = uuid.uuid4()
+    cache.store(document_id, 2, make_ops(3, 2))
+
+    # When
+    cache.extend(document_id, make_ops(6, 1))
+
+    # Then
+    assert document_id not in cache
+
+
+def test_history_cache_caps_operations():
+    # Given
+    cache = HistoryCache(max_documents=2, max_operations=3, max_age=60)
+    document_id = uuid.uuid4()
+    cache.store(document_id, 0, make_ops(1, 2))
+
+    # When
+    cache.extend(document_id, make_ops(3, 3))
+
+    # Then
+    assert cache.stats()["operations"] == 3
+    assert cache.bridge(document_id, 0, 5) is None
+    assert cache.bridge(document_id, 2, 5) == make_ops(3, 3)
+
+
+def test_history_cache_expires_unused_bridges(mocker):
+    # Given
+    cache = HistoryCache(max_documents=2, max_operations=100, max_age=60)
+    document_id = uuid.uuid4()
+    clock = mocker.patch(
+        "quokka_editor_back.utils.history_cache.time.monotonic", return_value=0
+    )
+    cache.store(document_id, 2, make_ops(3, 4))
+    clock.return_value = 50
+    cache.store(document_id, 4, make_ops(5, 2))
+
+    # When
+    clock.return_value = 100
+    result = cache.bridge(document_id, 4, 6)
+
+    # Then
+    assert result == make_ops(5, 2)
+    assert cache.stats()["operations"] == 2
+    assert cache.bridge(document_id, 2, 6) is None
+
+
+def test_history_cache_evicts_least_recently_used():
+    # Given
+    cache = HistoryCache(max_documents=2, max_operations=100, max_age=60)
+    first_id, second_id, third_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    cache.store(first_id, 0, make_ops(1, 1))
+    cache.store(second_id, 0, make_ops(1, 1))
+    cache.bridge(first_id, 0, 1)
+
+    # When
+    cache.store(third_id, 0, make_ops(1, 1))
+
+    # Then
+    assert first_id in cache
+    assert second_id not in cache
+    assert third_id in cache
+
+
+def test_history_cache_invalidate():
+    # Given
+    cache = HistoryCache(max_documents=2, max_operations=100, max_age=60)
+    document_id = uuid.uuid4()
+    cache.store(document_id, 0, make_ops(1, 1))
+
+    # When
+    cache.invalidate(document_id)
+
+    # Then
+    assert document_id not in cache
@@ -0,0 +1,69 @@
+from unittest.mock import AsyncMock, Mock
+
+from redis.exceptions import LockNotOwnedError
+
+from quokka_editor_back.utils.leases import (
+    DocumentLease,
+    acquire_lease,
+    orphaned_documents,
+    processing_key,
+)
+
+
+async def test_acquire_lease():
+    # Given
+    redis_client_mock = AsyncMock()
+    redis_client_mock.set.return_value = True
+
+    # When
+    result = await acquire_lease(redis_client_mock, "document")
+
+    # Then
+    redis_client_mock.set.assert_called_once_with(
+        processing_key("document"), result, nx=True, px=30000
+    )
+
+
+async def test_acquire_lease_held_by_another_worker():
+    # Given
+    redis_client_mock = AsyncMock()
+    redis_client_mock.set.return_value = None
+
+    # When
+    result = await acquire_lease(redis_client_mock, "document")
+
+    # Then
+    assert result is None
+
+
+async def test_document_lease_keep_alive_stops_once_lost(mocker):
+    # Given
+    mocker.patch("quokka_editor_back.utils.leases.asyncio.sleep", new=AsyncMock())
+    lock_mock = Mock(extend=AsyncMock(side_effect=[True, LockNotOwnedError("gone")]))
+    redis_client_mock = Mock(lock=Mock(return_value=lock_mock))
+    lease = DocumentLease(redis_client_mock, "document", "token")
+
+    # When
+    await lease.keep_alive()
+
+    # Then
+    assert lease.lost
+    assert lock_mock.local.token == b"token"
+    assert lock_mock.extend.call_count == 2
+    lock_mock.extend.assert_called_with(30.0, replace_ttl=True)
+
+
+async def test_orphaned_documents():
+    # Given
+    async def scan_iter(match):
+        for key in (b"document_operations_first", b"document_operations_second"):
+            yield key
+
+    redis_client_mock = Mock(scan_iter=scan_iter, exists=AsyncMock(side_effect=[1, 0]))
+
+    # When
+    result = [document async for document in orphaned_documents(redis_client_mock)]
+
+    # Then
+    assert result == ["second"]
+    redis_client_mock.exists.assert_called_with(processing_key("second"))
@@ -0,0 +1,218 @@
+import json
+from unittest.mock import AsyncMock, MagicMock, Mock
+
+from fakeredis.aioredis import FakeRedis
+
+from quokka_editor_back.models.document import Document
+from quokka_editor_back.models.operation import Op, Operation, OperationType
+from quokka_editor_back.utils.leases import processing_key
+from quokka_editor_back.utils.live_documents import (
+    LIVE_DOCUMENTS_KEY,
+    decode_log_entry,
+    encode_log_entry,
+    evict_live_document,
+    flush_live_document,
+    live_log_key,
+    live_state_key,
+    load_live_changes,
+    load_live_document,
+    save_live_operations,
+)
+
+
+def make_op(revision: int, text: str = "!") -> Op:
+    return Op(0, 4, 0, 4, [text], OperationType.INPUT, revision)
+
+
+def mock_redis(entries: list[bytes], content: bytes | None, revision: int | None):
+    pipeline_mock = Mock(
+        execute=AsyncMock(
+            return_value=[
+                entries,
+                [content, None if revision is None else str(revision).encode()],
+            ]
+        )
+    )
+    redis_client_mock = AsyncMock()
+    redis_client_mock.pipeline = Mock(return_value=pipeline_mock)
+    redis_client_mock.set.return_value = True
+    return redis_client_mock
+
+
+def test_encode_and_decode_log_entry():
+    # Given
+    op = make_op(3)
+
+    # When
+    result = decode_log_entry(encode_log_entry(op, "user").encode())
+
+    # Then
+    assert result == ("user", op)
+
+
+async def test_save_live_operations(document: Document):
+    # Given
+    pipeline_mock = Mock(execute=AsyncMock())
+    redis_client_mock = Mock(pipeline=Mock(return_value=pipeline_mock))
+    ops = [make_op(1), make_op(2)]
+
+    # When
+    await save_live_operations(
+        redis_client_mock, document.id, ops, ["a", None], b'["test!!"]'
+    )
+
+    # Then
+    redis_client_mock.pipeline.assert_called_once_with(transaction=True)
+    mapping = pipeline_mock.hset.call_args.kwargs["mapping"]
+    assert (mapping["content"], mapping["revision"]) == (b'["test!!"]', 2)
+    pipeline_mock.rpush.assert_called_once_with(
+        live_log_key(document.id),
+        encode_log_entry(ops[0], "a"),
+        encode_log_entry(ops[1], None),
+    )
+    pipeline_mock.sadd.assert_called_once_with(LIVE_DOCUMENTS_KEY, str(document.id))
+
+
+async def test_load_live_document(document: Document):
+    # Given
+    redis_client_mock = AsyncMock()
+    redis_client_mock.hmget.return_value = [b'["live"]', b"4"]
+
+    # When
+    await load_live_document(redis_client_mock, document)
+
+    # Then
+    redis_client_mock.hmget.assert_called_once_with(
+        live_state_key(document.id), "content", "revision"
+    )
+    assert (document.content, document.last_revision) == (b'["live"]', 4)
+
+
+async def test_load_live_document_rereads_evicted_document(document: Document):
+    # Given
+    stale_document = await Document.get(id=document.id)
+    document.content, document.last_revision = b'["flushed"]', 3
+    await document.save()
+    redis_client_mock = AsyncMock()
+    redis_client_mock.hmget.return_value = [None, None]
+    redis_client_mock.llen.return_value = 0
+
+    # When
+    await load_live_document(redis_client_mock, stale_document)
+
+    # Then
+    assert (stale_document.content, stale_document.last_revision) == (
+        b'["flushed"]',
+        3,
+    )
+
+
+async def test_load_live_changes_merges_persisted_and_logged(document: Document):
+    # Given
+    await Operation.from_op(document.id, make_op(1), "a").save()
+    redis_client_mock = AsyncMock()
+    redis_client_mock.lrange.return_value = [
+        encode_log_entry(make_op(2), "b").encode(),
+        encode_log_entry(make_op(3), "c").encode(),
+    ]
+
+    # When
+    result = await load_live_changes(redis_client_mock, document.id, 0, 2)
+
+    # Then
+    assert result == [("a", make_op(1)), ("b", make_op(2))]
+
+
+async def test_flush_live_document(document: Document):
+    # Given
+    entries = [encode_log_entry(make_op(1), "a").encode()]
+    redis_client_mock = mock_redis(entries, b'["test!"]', 1)
+
+    # When
+    result = await flush_live_document(redis_client_mock, document.id)
+
+    # Then
+    assert result == 1
+    await document.refresh_from_db()
+    assert (document.content, document.last_revision) == (b'["test!"]', 1)
+    assert await Operation.load_changes(document.id, 0) == [("a", make_op(1))]
+    redis_client_mock.ltrim.assert_called_once_with(live_log_key(document.id), 1, -1)
+    redis_client_mock.delete.assert_called_once()
+
+
+async def test_flush_live_document_replays_log_without_state(document: Document):
+    # Given
+    document.last_revision = 1
+    await document.save()
+    entries = [
+        encode_log_entry(make_op(1, "?"), "a").encode(),
+        encode_log_entry(make_op(2), "b").encode(),
+    ]
+    redis_client_mock = mock_redis(entries, None, None)
+
+    # When
+    result = await flush_live_document(redis_client_mock, document.id)
+
+    # Then
+    assert result == 2
+    await document.refresh_from_db()
+    assert json.loads(document.content) == ["test!"]
+    assert await Operation.load_changes(document.id, 0) == [("b", make_op(2))]
+    redis_client_mock.ltrim.assert_called_once_with(live_log_key(document.id), 2, -1)
+
+
+async def test_flush_live_document_held_by_another_flusher(document: Document):
+    # Given
+    redis_client_mock = mock_redis([], None, None)
+    redis_client_mock.set.return_value = None
+
+    # When
+    result = await flush_live_document(redis_client_mock, document.id)
+
+    # Then
+    assert result is None
+    redis_client_mock.pipeline.assert_not_called()
+
+
+async def test_evict_live_document_keeps_unflushed_operations(
+    document: Document, mocker
+):
+    # Given
+    mocker.patch(
+        "quokka_editor_back.utils.live_documents.flush_live_document",
+        new_callable=AsyncMock,
+    )
+    pipeline_mock = MagicMock(
+        watch=AsyncMock(),
+        exists=AsyncMock(return_value=0),
+        llen=AsyncMock(return_value=1),
+    )
+    pipeline_mock.__aenter__.return_value = pipeline_mock
+    redis_client_mock = Mock(pipeline=Mock(return_value=pipeline_mock))
+
+    # When
+    result = await evict_live_document(redis_client_mock, document.id)
+
+    # Then
+    assert result is False
+    pipeline_mock.multi.assert_not_called()
+
+
+async def test_evict_live_document_skips_processing_document(
+    document: Document, mocker
+):
+    # Given
+    mocker.patch(
+        "quokka_editor_back.utils.live_documents.flush_live_document",
+        new_callable=AsyncMock,
+    )
+    redis_client = FakeRedis()
+    await redis_client.hset(live_state_key(document.id), "revision", 1)
+    await redis_client.set(processing_key(document.id), "lease")
+
+    # When
+    result = await evict_live_document(redis_client, document.id)
+
+    # Then
+    assert result is False
+    assert await redis_client.exists(live_state_key(document.id))
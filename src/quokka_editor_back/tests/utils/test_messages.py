@@ -0,0 +1,55 @@
+import json
+
+from quokka_editor_back.utils.messages import (
+    encode_message,
+    is_event,
+    pack_event,
+    pack_message,
+    unpack_event,
+    unpack_message,
+)
+
+
+def test_encode_message():
+    # When
+    result = encode_message({"key": "wartość", "items": [1, 2]})
+
+    # Then
+    assert result == '{"key":"wartość","items":[1,2]}'
+
+
+def test_pack_and_unpack_message():
+    # Given
+    payload = json.dumps({"data": {"text": ["line\nbreak"]}, "revision": 7})
+
+    # When
+    result = unpack_message(pack_message("user-token", 7, payload).encode())
+
+    # Then
+    assert result == ("user-token", 7, 7, payload)
+
+
+def test_pack_and_unpack_message_with_revision_range():
+    # Given
+    payload = json.dumps([{"revision": 5}, {"revision": 6}])
+
+    # When
+    packed = pack_message("user-token", 6, payload, first_revision=5)
+    result = unpack_message(packed.encode())
+
+    # Then
+    assert packed.startswith("user-token 5-6\n")
+    assert result == ("user-token", 5, 6, payload)
+
+
+def test_pack_and_unpack_event():
+    # Given
+    payload = json.dumps({"origin": "node", "cursors": []})
+
+    # When
+    packed = pack_event("cursors", payload).encode()
+
+    # Then
+    assert is_event(packed)
+    assert not is_event(pack_message("user-token", 7, payload).encode())
+    assert unpack_event(packed) == ("cursors", payload)
@@ -1,36 +1,42 @@
 import pytest
+from pydantic import ValidationError
 
 from quokka_editor_back.models.operation import (
+    Op,
     OperationSchema,
     OperationType,
     PosSchema,
 )
-from quokka_editor_back.utils.ot import adjust_position, apply_operation, transform
+from quokka_editor_back.utils.buffer import LineBuffer
+from quokka_editor_back.utils.ot import (
+    adjust_ch,
+    apply_operation,
+    rebase_batch,
+    transform,
+    transform_many,
+)
 
 
 @pytest.mark.parametrize(
-    "new_pos_ch, new_pos_line, expected_pos_ch, expected_pos_line",
+    "new_pos_ch, new_pos_line, expected_pos_ch",
     [
-        (0, 0, 0, 0),
-        (0, 1, 0, 1),
-        (0, 2, 0, 2),
-        (11, 1, 15, 1),
-        (11, 2, 11, 2),
+        (0, 0, 0),
+        (0, 1, 0),
+        (0, 2, 0),
+        (10, 1, 14),
+        (11, 1, 15),
+        (11, 2, 11),
     ],
 )
-def test_adjust_position(
-    new_pos_ch: int, new_pos_line: int, expected_pos_ch: int, expected_pos_line: int
-):
+def test_adjust_ch(new_pos_ch: int, new_pos_line: int, expected_pos_ch: int):
     # Given
-    new_pos = PosSchema(ch=new_pos_ch, line=new_pos_line)
-    prev_pos = PosSchema(ch=10, line=1)
     prev_text = "text"
 
     # When
-    result = adjust_position(new_pos, prev_pos, prev_text)
+    result = adjust_ch(new_pos_line, new_pos_ch, 1, 10, prev_text)
 
     # Then
-    assert result == PosSchema(ch=expected_pos_ch, line=expected_pos_line)
+    assert result == expected_pos_ch
 
 
 @pytest.mark.parametrize(
@@ -69,13 +75,13 @@ def test_transform_both_input_operation_types(new_op_type, prev_op_type):
     )
 
     # When
-    result = transform(new_op, prev_op)
+    result = transform(Op.from_schema(new_op), Op.from_schema(prev_op))
 
     # Then
     # I have some questions about that
     result_from_pos = PosSchema(ch=8, line=0)
     result_to_pos = PosSchema(ch=12, line=0)
-    assert result == OperationSchema(
+    assert result.to_schema() == OperationSchema(
         from_pos=result_from_pos,
         to_pos=result_to_pos,
         text=new_op.text,
@@ -84,6 +90,18 @@ def test_transform_both_input_operation_types(new_op_type, prev_op_type):
     )
 
 
+def test_operation_schema_rejects_text_with_newline():
+    # When
+    with pytest.raises(ValidationError):
+        OperationSchema(
+            from_pos=PosSchema(ch=0, line=0),
+            to_pos=PosSchema(ch=0, line=0),
+            text=["first\nsecond"],
+            type=OperationType.INPUT,
+            revision=0,
+        )
+
+
 @pytest.mark.parametrize(
     "new_op_type, new_op_from_pos",
     [
@@ -131,10 +149,10 @@ def test_transform_prev_op_delete(new_op_type, new_op_from_pos):
     )
 
     # When
-    result = transform(new_op, prev_op)
+    result = transform(Op.from_schema(new_op), Op.from_schema(prev_op))
 
     # Then
-    assert result == OperationSchema(
+    assert result.to_schema() == OperationSchema(
         from_pos=PosSchema(line=new_op.from_pos.line - 1, ch=new_op.from_pos.ch),
         to_pos=new_op.to_pos,
         text=new_op.text,
@@ -204,10 +222,10 @@ def test_transform_prev_op_delete_with_specific_conditions(
     )
 
     # When
-    result = transform(new_op, prev_op)
+    result = transform(Op.from_schema(new_op), Op.from_schema(prev_op))
 
     # Then
-    assert result == new_op
+    assert result.to_schema() == new_op
 
 
 @pytest.mark.parametrize(
@@ -236,10 +254,10 @@ def test_new_op_delete(prev_op_type):
     )
 
     # When
-    result = transform(new_op, prev_op)
+    result = transform(Op.from_schema(new_op), Op.from_schema(prev_op))
 
     # Then
-    assert result == OperationSchema(
+    assert result.to_schema() == OperationSchema(
         from_pos=PosSchema(ch=8, line=0),
         to_pos=new_op.to_pos,
         text=new_op.text,
@@ -267,10 +285,10 @@ def test_both_delete_operation(from_pos_line):
     )
 
     # When
-    result = transform(new_op, prev_op)
+    result = transform(Op.from_schema(new_op), Op.from_schema(prev_op))
 
     # Then
-    assert result == new_op
+    assert result.to_schema() == new_op
 
 
 @pytest.fixture
@@ -294,7 +312,7 @@ def test_apply_operation_input(sample_document_content, operation_type):
     )
 
     # When
-    result = apply_operation(sample_document_content.copy(), op)
+    result = apply_operation(sample_document_content.copy(), Op.from_schema(op))
 
     # Then
     assert result == ["abcXYZ def", "ghi jkl", "mno pqr"]
@@ -316,7 +334,7 @@ def test_apply_operation_input_1(sample_document_content, operation_type):
     )
 
     # When
-    result = apply_operation(sample_document_content.copy(), op)
+    result = apply_operation(sample_document_content.copy(), Op.from_schema(op))
 
     # Then
     assert result == ["abcXYZf", "ghi jkl", "mno pqr"]
@@ -333,7 +351,176 @@ def test_apply_operation_delete(sample_document_content):
     )
 
     # When
-    result = apply_operation(sample_document_content.copy(), op)
+    result = apply_operation(sample_document_content.copy(), Op.from_schema(op))
 
     # Then
     assert result == [" def", "ghi jkl", "mno pqr"]
+
+
+@pytest.mark.parametrize(
+    "from_pos, to_pos, text, operation_type",
+    [
+        (PosSchema(ch=3, line=0), PosSchema(ch=3, line=0), ["XY"], OperationType.INPUT),
+        (
+            PosSchema(ch=1, line=1),
+            PosSchema(ch=1, line=1),
+            ["", ""],
+            OperationType.UNDO,
+        ),
+        (
+            PosSchema(ch=3, line=0),
+            PosSchema(ch=2, line=2),
+            ["1", "2", "3"],
+            OperationType.PASTE,
+        ),
+        (PosSchema(ch=7, line=0), PosSchema(ch=0, line=1), [""], OperationType.DELETE),
+    ],
+)
+def test_apply_operation_line_buffer(
+    sample_document_content, from_pos, to_pos, text, operation_type
+):
+    # Given
+    op = OperationSchema(
+        from_pos=from_pos,
+        to_pos=to_pos,
+        text=text,
+        type=operation_type,
+        revision=1,
+    )
+
+    # When
+    result = apply_operation(LineBuffer(sample_document_content), Op.from_schema(op))
+
+    # Then
+    assert list(result) == apply_operation(
+        sample_document_content.copy(), Op.from_schema(op)
+    )
+
+
+def test_transform_returns_same_op_when_unaffected():
+    # Given
+    prev_op = Op(2, 0, 2, 0, ["text"], OperationType.INPUT, 0)
+    new_op = Op(0, 3, 0, 3, ["x"], OperationType.INPUT, 0)
+
+    # When
+    result = transform(new_op, prev_op)
+
+    # Then
+    assert result is new_op
+
+
+def test_op_schema_round_trip():
+    # Given
+    schema = OperationSchema(
+        from_pos=PosSchema(ch=1, line=2),
+        to_pos=PosSchema(ch=3, line=4),
+        text=["a", "b"],
+        type=OperationType.PASTE,
+        revision=5,
+    )
+
+    # When
+    op = Op.from_schema(schema)
+
+    # Then
+    assert op == Op(2, 1, 4, 3, ["a", "b"], OperationType.PASTE, 5)
+    assert op.to_schema() == schema
+    assert op.to_dict() == schema.dict()
+
+
+@pytest.fixture
+def history():
+    return [
+        Op(0, 0, 0, 0, ["ab"], OperationType.INPUT, 1),
+        Op(1, 0, 1, 2, [""], OperationType.DELETE, 2),
+        Op(0, 2, 0, 2, ["cd"], OperationType.INPUT, 3),
+        Op(2, 1, 2, 1, ["e"], OperationType.PASTE, 4),
+    ]
+
+
+def test_transform_many(history):
+    # Given
+    op = Op(0, 1, 0, 1, ["x"], OperationType.INPUT, 0)
+    expected = op
+    for prev_op in history:
+        expected = transform(expected, prev_op)
+
+    # When
+    result = transform_many(op, history)
+
+    # Then
+    assert result == expected
+    assert result == Op(0, 5, 0, 5, ["x"], OperationType.INPUT, 0)
+
+
+def test_transform_many_empty_history():
+    # Given
+    op = Op(0, 1, 0, 1, ["x"], OperationType.INPUT, 0)
+
+    # When
+    result = transform_many(op, [])
+
+    # Then
+    assert result is op
+
+
+def test_rebase_batch_matches_sequential_rebase(history):
+    # Given
+    ops = [
+        Op(0, 1, 0, 1, ["x"], OperationType.INPUT, 0),
+        Op(2, 1, 2, 2, [""], OperationType.DELETE, 2),
+        Op(0, 3, 0, 3, ["y"], OperationType.UNDO, 0),
+        Op(2, 0, 2, 0, ["z"], OperationType.INPUT, 4),
+    ]
+    expected = []
+    sequential_history = list(history)
+    for op in ops:
+        op = transform_many(
+            op, [prev for prev in sequential_history if prev.revision > op.revision]
+        )
+        op = op._replace(revision=len(sequential_history) + 1)
+        sequential_history.append(op)
+        expected.append(op)
+
+    # When
+    result = rebase_batch(ops, history, head_revision=4)
+
+    # Then
+    assert result == expected
+    assert [op.revision for op in result] == [5, 6, 7, 8]
+
+
+def test_rebase_batch_without_history():
+    # Given
+    ops = [
+        Op(0, 0, 0, 0, ["a"], OperationType.INPUT, 7),
+        Op(0, 0, 0, 0, ["b"], OperationType.INPUT, 7),
+    ]
+
+    # When
+    result = rebase_batch(ops, [], head_revision=7)
+
+    # Then
+    assert result == [
+        Op(0, 0, 0, 0, ["a"], OperationType.INPUT, 8),
+        Op(0, 1, 0, 1, ["b"], OperationType.INPUT, 9),
+    ]
+
+
+def test_rebase_batch_skips_operations_of_the_same_group():
+    # Given
+    ops = [
+        Op(0, 0, 0, 0, ["a"], OperationType.INPUT, 7),
+        Op(0, 0, 0, 0, ["x"], OperationType.INPUT, 7),
+        Op(0, 1, 0, 1, ["y"], OperationType.INPUT, 7),
+    ]
+
+    # When
+    result = rebase_batch(ops, [], head_revision=7, groups=[0, 1, 1])
+
+    # Then
+    assert result == [
+        Op(0, 0, 0, 0, ["a"], OperationType.INPUT, 8),
+        Op(0, 1, 0, 1, ["x"], OperationType.INPUT, 9),
+        Op(0, 2, 0, 2, ["y"], OperationType.INPUT, 10),
+    ]
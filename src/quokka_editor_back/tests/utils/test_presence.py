@@ -0,0 +1,55 @@
+import json
+import time
+import uuid
+from unittest.mock import AsyncMock, Mock
+
+from quokka_editor_back.utils.presence import (
+    load_presence,
+    presence_key,
+    refresh_presence,
+)
+
+
+async def test_refresh_presence():
+    # Given
+    document_id = uuid.uuid4()
+    pipeline_mock = Mock(execute=AsyncMock())
+    redis_client_mock = Mock(pipeline=Mock(return_value=pipeline_mock))
+
+    # When
+    await refresh_presence(redis_client_mock, document_id, {"id": {"user_token": "a"}})
+
+    # Then
+    key, mapping = presence_key(document_id), pipeline_mock.hset.call_args.kwargs
+    assert pipeline_mock.hset.call_args.args == (key,)
+    assert json.loads(mapping["mapping"]["id"])["user_token"] == "a"
+    pipeline_mock.expire.assert_called_once_with(key, 30)
+    pipeline_mock.execute.assert_called_once_with()
+
+
+async def test_refresh_presence_without_connections():
+    # Given
+    redis_client_mock = Mock()
+
+    # When
+    await refresh_presence(redis_client_mock, uuid.uuid4(), {})
+
+    # Then
+    redis_client_mock.pipeline.assert_not_called()
+
+
+async def test_load_presence_drops_expired_connections():
+    # Given
+    document_id = uuid.uuid4()
+    redis_client_mock = AsyncMock()
+    redis_client_mock.hgetall.return_value = {
+        b"live": json.dumps({"user_token": "a", "seen_at": time.time()}),
+        b"dead": json.dumps({"user_token": "b", "seen_at": time.time() - 60}),
+    }
+
+    # When
+    result = await load_presence(redis_client_mock, document_id)
+
+    # Then
+    assert result == {"live": {"user_token": "a"}}
+    redis_client_mock.hdel.assert_called_once_with(presence_key(document_id), b"dead")
@@ -0,0 +1,108 @@
+import json
+
+import msgpack
+import pytest
+
+from quokka_editor_back.schema.websocket import WireProtocol
+from quokka_editor_back.utils.protocol import (
+    EncodedMessage,
+    decode_frame,
+    encode_frame,
+    negotiate_protocol,
+)
+
+OPERATION = {
+    "from_pos": {"line": 1, "ch": 2},
+    "to_pos": {"line": 1, "ch": 2},
+    "text": ["x"],
+    "type": "+INPUT",
+    "revision": 5,
+}
+
+
+@pytest.mark.parametrize(
+    "offered, requested, expected",
+    [
+        ([], None, (WireProtocol.JSON, None)),
+        ([], WireProtocol.MSGPACK, (WireProtocol.MSGPACK, None)),
+        (["chat", "quokka.msgpack"], None, (WireProtocol.MSGPACK, "quokka.msgpack")),
+        (["quokka.json"], WireProtocol.MSGPACK, (WireProtocol.JSON, "quokka.json")),
+    ],
+)
+def test_negotiate_protocol(offered, requested, expected):
+    # When
+    result = negotiate_protocol(offered, requested)
+
+    # Then
+    assert result == expected
+
+
+def test_encode_frame_msgpack_compacts_operations():
+    # Given
+    message = {"data": OPERATION, "type": "EXT_CHANGE", "revision": 5}
+
+    # When
+    frame = encode_frame(json.dumps(message), WireProtocol.MSGPACK)
+
+    # Then
+    assert msgpack.unpackb(frame) == {
+        "data": [1, 2, 1, 2, ["x"], "+INPUT", 5],
+        "type": "EXT_CHANGE",
+        "revision": 5,
+    }
+
+
+def test_encode_frame_json_keeps_encoded_text():
+    # Given
+    message = json.dumps({"data": OPERATION})
+
+    # When
+    frame = encode_frame(message, WireProtocol.JSON)
+
+    # Then
+    assert frame is message
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        OPERATION,
+        {"type": "cursor", "from_pos": {"line": 3, "ch": 4}},
+        {"type": "cursor", "selection": {"to_pos": {"line": 3, "ch": 4}}},
+    ],
+)
+def test_decode_frame_msgpack_round_trip(message):
+    # Given
+    frame = encode_frame(message, WireProtocol.MSGPACK)
+
+    # When
+    result = decode_frame(frame, WireProtocol.MSGPACK)
+
+    # Then
+    assert result == message
+
+
+def test_decode_frame_msgpack_batch():
+    # Given
+    frame = encode_frame([OPERATION, OPERATION], WireProtocol.MSGPACK)
+
+    # When
+    result = decode_frame(frame, WireProtocol.MSGPACK)
+
+    # Then
+    assert result == [OPERATION, OPERATION]
+
+
+def test_encoded_message_encodes_once_per_protocol(mocker):
+    # Given
+    message = EncodedMessage({"key": "value"})
+    encode = mocker.spy(msgpack, "packb")
+
+    # When
+    first = message.frame(WireProtocol.MSGPACK)
+    second = message.frame(WireProtocol.MSGPACK)
+
+    # Then
+    assert first is second
+    assert encode.call_count == 1
+    assert message.frame(WireProtocol.JSON) == '{"key":"value"}'
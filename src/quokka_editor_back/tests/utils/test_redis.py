@@ -0,0 +1,78 @@
+import asyncio
+
+from redis.asyncio import BlockingConnectionPool
+
+from quokka_editor_back.utils.redis import (
+    close_redis_pool,
+    document_channel,
+    get_redis,
+    redis_pool,
+    redis_pool_stats,
+)
+
+
+async def test_get_redis_shares_pool():
+    # When
+    first_client = await get_redis()
+    second_client = await get_redis()
+
+    # Then
+    assert first_client.connection_pool is redis_pool()
+    assert second_client.connection_pool is redis_pool()
+
+
+async def test_redis_pool_uses_settings(mocker):
+    # Given
+    await close_redis_pool()
+    mocker.patch("quokka_editor_back.utils.redis.settings.redis_host", "cache")
+    mocker.patch("quokka_editor_back.utils.redis.settings.redis_pool_size", 8)
+
+    # When
+    pool = redis_pool()
+
+    # Then
+    assert isinstance(pool, BlockingConnectionPool)
+    assert pool.connection_kwargs["host"] == "cache"
+    assert redis_pool_stats() == {
+        "max_connections": 8,
+        "created": 0,
+        "in_use": 0,
+        "available": 0,
+    }
+    await close_redis_pool()
+
+
+async def test_close_redis_pool_recreates_pool():
+    # Given
+    pool = redis_pool()
+
+    # When
+    await close_redis_pool()
+
+    # Then
+    assert redis_pool() is not pool
+
+
+async def test_redis_pool_per_event_loop():
+    # Given
+    pool = redis_pool()
+
+    async def open_and_close_pool():
+        other_pool = redis_pool()
+        await close_redis_pool()
+        return other_pool
+
+    # When
+    other_pool = await asyncio.to_thread(asyncio.run, open_and_close_pool())
+
+    # Then
+    assert other_pool is not pool
+    assert redis_pool() is pool
+
+
+def test_document_channel():
+    # When
+    result = document_channel("some-id")
+
+    # Then
+    assert result == "document_some-id"
@@ -0,0 +1,95 @@
+import uuid
+from unittest.mock import AsyncMock, Mock
+
+from redis.exceptions import LockNotOwnedError
+
+from quokka_editor_back.utils.sharding import (
+    HashRing,
+    ShardRouter,
+    WorkerSlot,
+    live_slots,
+    slot_key,
+)
+
+
+def test_hash_ring_is_stable():
+    # Given
+    document_ids = [str(uuid.uuid4()) for _ in range(100)]
+
+    # When
+    first = [HashRing([0, 1, 2], 64).slot_for(key) for key in document_ids]
+    second = [HashRing([2, 1, 0], 64).slot_for(key) for key in document_ids]
+
+    # Then
+    assert first == second
+    assert set(first) == {0, 1, 2}
+
+
+def test_hash_ring_only_moves_documents_of_a_leaving_slot():
+    # Given
+    document_ids = [str(uuid.uuid4()) for _ in range(1000)]
+    ring = HashRing([0, 1, 2, 3], 64)
+    shrunk = HashRing([0, 1, 3], 64)
+
+    # When
+    moved = [key for key in document_ids if ring.slot_for(key) != shrunk.slot_for(key)]
+
+    # Then
+    assert moved
+    assert all(ring.slot_for(key) == 2 for key in moved)
+
+
+def test_hash_ring_without_slots():
+    # When / Then
+    assert HashRing([], 64).slot_for("document") is None
+
+
+async def test_live_slots(mocker):
+    # Given
+    mocker.patch("quokka_editor_back.utils.sharding.settings.worker_slots", 3)
+    redis_client_mock = AsyncMock()
+    redis_client_mock.mget.return_value = [b"token", None, b"token"]
+
+    # When
+    result = await live_slots(redis_client_mock)
+
+    # Then
+    assert result == [0, 2]
+    redis_client_mock.mget.assert_called_once_with(
+        [slot_key(0), slot_key(1), slot_key(2)]
+    )
+
+
+async def test_shard_router_refreshes_slots_once_per_interval(mocker):
+    # Given
+    mocker.patch("quokka_editor_back.utils.sharding.settings.worker_slots", 2)
+    redis_client_mock = AsyncMock()
+    redis_client_mock.mget.return_value = [None, b"token"]
+    router = ShardRouter(refresh_interval=60)
+
+    # When
+    first = await router.queue_for(redis_client_mock, "document")
+    second = await router.queue_for(redis_client_mock, "other document")
+
+    # Then
+    assert first == second == "documents-1"
+    redis_client_mock.mget.assert_called_once()
+
+
+async def test_worker_slot_keep_alive_returns_slot_taken_over(mocker):
+    # Given
+    mocker.patch("quokka_editor_back.utils.sharding.asyncio.sleep", new=AsyncMock())
+    lock_mock = Mock(
+        extend=AsyncMock(side_effect=[True, LockNotOwnedError("gone")]),
+        acquire=AsyncMock(return_value=False),
+    )
+    worker_slot = WorkerSlot(AsyncMock())
+    worker_slot.slot, worker_slot.lock = 3, lock_mock
+
+    # When
+    result = await worker_slot.keep_alive()
+
+    # Then
+    assert result == 3
+    assert (worker_slot.slot, worker_slot.lock) == (None, None)
+    assert lock_mock.extend.call_count == 2
@@ -0,0 +1,167 @@
+import uuid
+from datetime import timedelta
+
+from tortoise import timezone
+
+from quokka_editor_back.models.document import Document, DocumentSnapshot
+from quokka_editor_back.models.operation import Operation, OperationType
+from quokka_editor_back.utils.snapshots import (
+    SnapshotMark,
+    SnapshotMarks,
+    is_snapshot_due,
+    load_document_at,
+    maybe_take_snapshot,
+    snapshot_marks,
+    take_snapshot,
+)
+
+
+async def add_insert_operation(
+    document: Document, line: int, ch: int, text: str, revision: int
+) -> None:
+    await Operation.create(
+        document=document,
+        from_line=line,
+        from_ch=ch,
+        to_line=line,
+        to_ch=ch,
+        text=text,
+        type=OperationType.INPUT,
+        revision=revision,
+    )
+
+
+async def test_take_snapshot_overwrites_same_revision(document: Document):
+    # Given
+    await take_snapshot(document, b'["old"]', 0)
+
+    # When
+    await take_snapshot(document, b'["new"]', 0)
+
+    # Then
+    snapshots = await DocumentSnapshot.filter(document_id=document.id)
+    assert len(snapshots) == 1
+    assert snapshots[0].content == b'["new"]'
+
+
+def test_is_snapshot_due_without_snapshot():
+    # When
+    result = is_snapshot_due(None, 1)
+
+    # Then
+    assert result is True
+
+
+def test_is_snapshot_due_by_revisions(mocker):
+    # Given
+    mocker.patch(
+        "quokka_editor_back.utils.snapshots.settings.snapshot_interval_revisions", 10
+    )
+    snapshot = DocumentSnapshot(revision=5, created_at=timezone.now())
+
+    # When / Then
+    assert is_snapshot_due(snapshot, 14) is False
+    assert is_snapshot_due(snapshot, 15) is True
+
+
+def test_is_snapshot_due_by_time(mocker):
+    # Given
+    mocker.patch(
+        "quokka_editor_back.utils.snapshots.settings.snapshot_interval_seconds", 60
+    )
+    snapshot = DocumentSnapshot(
+        revision=5, created_at=timezone.now() - timedelta(seconds=61)
+    )
+
+    # When
+    result = is_snapshot_due(snapshot, 6)
+
+    # Then
+    assert result is True
+
+
+async def test_maybe_take_snapshot_skips_recent_snapshot(document: Document):
+    # Given
+    await take_snapshot(document, document.content, 0)
+
+    # When
+    result = await maybe_take_snapshot(document, b'["test!"]', 1)
+
+    # Then
+    assert result is None
+    assert await DocumentSnapshot.filter(document_id=document.id).count() == 1
+
+
+async def test_maybe_take_snapshot_skips_query_while_not_due(
+    document: Document, mocker
+):
+    # Given
+    await maybe_take_snapshot(document, document.content, 0)
+    snapshot_filter = mocker.spy(DocumentSnapshot, "filter")
+
+    # When
+    result = await maybe_take_snapshot(document, b'["test!"]', 1)
+
+    # Then
+    assert result is None
+    snapshot_filter.assert_not_called()
+
+
+async def test_maybe_take_snapshot_checks_due_mark_against_database(
+    document: Document, mocker
+):
+    # Given
+    mocker.patch(
+        "quokka_editor_back.utils.snapshots.settings.snapshot_interval_revisions", 10
+    )
+    await maybe_take_snapshot(document, document.content, 0)
+    # another worker snapshotted the document since
+    await take_snapshot(document, b'["test!"]', 5)
+
+    # When
+    result = await maybe_take_snapshot(document, b'["test!!"]', 10)
+
+    # Then
+    assert result is None
+    assert snapshot_marks.get(document.id).revision == 5
+
+
+def test_snapshot_marks_evicts_least_recently_used():
+    # Given
+    marks = SnapshotMarks(max_documents=2)
+    first, second, third = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    now = timezone.now()
+    marks.put(first, DocumentSnapshot(revision=1, created_at=now))
+    marks.put(second, DocumentSnapshot(revision=2, created_at=now))
+    marks.get(first)
+
+    # When
+    marks.put(third, DocumentSnapshot(revision=3, created_at=now))
+
+    # Then
+    assert len(marks) == 2
+    assert marks.get(first) == SnapshotMark(1, now)
+    assert marks.get(second) is None
+
+
+async def test_load_document_at_replays_from_nearest_snapshot(document: Document):
+    # Given
+    await take_snapshot(document, b'["test"]', 0)
+    await add_insert_operation(document, 0, 4, "1", 1)
+    await take_snapshot(document, b'["test1"]', 1)
+    await add_insert_operation(document, 0, 5, "2", 2)
+    await add_insert_operation(document, 0, 6, "3", 3)
+
+    # When
+    result = await load_document_at(document, 2)
+
+    # Then
+    assert list(result) == ["test12"]
+
+
+async def test_load_document_at_without_snapshot(document: Document):
+    # When
+    result = await load_document_at(document, 0)
+
+    # Then
+    assert result is None
@@ -0,0 +1,193 @@
+from collections.abc import Iterable, Iterator, MutableSequence, Sequence
+from itertools import chain
+from typing import overload
+
+CHUNK_SIZE = 512
+
+
+class LineBuffer(MutableSequence[str]):
+    """
+    Mutable sequence of document lines stored in fixed-size chunks.
+
+    A Fenwick tree over the chunk lengths maps a line number to its chunk in
+    O(log n), so editing a line or splicing a few lines in costs
+    O(log n + CHUNK_SIZE) regardless of the document size. It behaves like a
+    ``list[str]`` for everything ``apply_operation`` needs, and converts back
+    to the stored JSON line format with ``list(buffer)``.
+    """
+
+    def __init__(self, lines: Iterable[str] = ()):
+        lines = list(lines)
+        self._chunks: list[list[str]] = [
+            lines[start : start + CHUNK_SIZE]
+            for start in range(0, len(lines), CHUNK_SIZE)
+        ] or [[]]
+        self._len = len(lines)
+        self.char_count = sum(map(len, lines))
+        self._rebuild_index()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[str]:
+        return chain.from_iterable(self._chunks)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return len(self) == len(other) and all(
+                line == other_line for line, other_line in zip(self, other)
+            )
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"LineBuffer({list(self)!r})"
+
+    @overload
+    def __getitem__(self, index: int) -> str:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[str]:
+        ...
+
+    def __getitem__(self, index: int | slice) -> str | list[str]:
+        if isinstance(index, slice):
+            start, stop = self._slice_bounds(index)
+            return self._lines(start, stop)
+        chunk_index, offset = self._locate(self._line_index(index))
+        return self._chunks[chunk_index][offset]
+
+    def __setitem__(self, index: int | slice, value) -> None:
+        if isinstance(index, slice):
+            start, stop = self._slice_bounds(index)
+            self._replace(start, stop, list(value))
+            return
+        index = self._line_index(index)
+        self._replace(index, index + 1, [value])
+
+    def __delitem__(self, index: int | slice) -> None:
+        if isinstance(index, slice):
+            start, stop = self._slice_bounds(index)
+        else:
+            start = self._line_index(index)
+            stop = start + 1
+        self._replace(start, stop, [])
+
+    def insert(self, index: int, value: str) -> None:
+        index = min(max(index + self._len if index < 0 else index, 0), self._len)
+        self._replace(index, index, [value])
+
+    def _line_index(self, index: int) -> int:
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("LineBuffer index out of range")
+        return index
+
+    def _slice_bounds(self, index: slice) -> tuple[int, int]:
+        start, stop, step = index.indices(self._len)
+        if step != 1:
+            raise ValueError("LineBuffer only supports contiguous slices")
+        return start, max(start, stop)
+
+    def _lines(self, start: int, stop: int) -> list[str]:
+        lines: list[str] = []
+        if start >= stop:
+            return lines
+        chunk_index, offset = self._locate(start)
+        while len(lines) < stop - start:
+            chunk = self._chunks[chunk_index]
+            lines.extend(chunk[offset : offset + stop - start - len(lines)])
+            chunk_index, offset = chunk_index + 1, 0
+        return lines
+
+    def _replace(self, start: int, stop: int, lines: list[str]) -> None:
+        chunk_index, offset = self._locate(start)
+        self._cursor = None
+        chunk = self._chunks[chunk_index]
+        removed = stop - start
+        restructured = False
+
+        if offset + removed <= len(chunk):
+            self.char_count -= sum(map(len, chunk[offset : offset + removed]))
+            chunk[offset : offset + removed] = lines
+        else:
+            # The range spans chunks: keep the head of the first one and the
+            # tail of the last one, and drop everything in between.
+            self.char_count -= sum(map(len, self._lines(start, stop)))
+            last_index, last_offset = self._locate(stop)
+            tail = self._chunks[last_index][last_offset:]
+            chunk[offset:] = lines
+            chunk.extend(tail)
+            del self._chunks[chunk_index + 1 : last_index + 1]
+            restructured = True
+
+        self.char_count += sum(map(len, lines))
+        self._len += len(lines) - removed
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self._chunks[chunk_index : chunk_index + 1] = [
+                chunk[split : split + CHUNK_SIZE]
+                for split in range(0, len(chunk), CHUNK_SIZE)
+            ]
+            restructured = True
+        elif len(chunk) < CHUNK_SIZE // 4 and len(self._chunks) > 1:
+            next_index = chunk_index + 1
+            if not chunk:
+                del self._chunks[chunk_index]
+                restructured = True
+            elif (
+                next_index < len(self._chunks)
+                and len(chunk) + len(self._chunks[next_index]) <= CHUNK_SIZE
+            ):
+                chunk.extend(self._chunks.pop(next_index))
+                restructured = True
+
+        if restructured:
+            self._rebuild_index()
+        else:
+            self._add_to_index(chunk_index, len(lines) - removed)
+
+    def _rebuild_index(self) -> None:
+        size = len(self._chunks)
+        tree = [0] * (size + 1)
+        for position, chunk in enumerate(self._chunks, start=1):
+            tree[position] += len(chunk)
+            parent = position + (position & -position)
+            if parent <= size:
+                tree[parent] += tree[position]
+        self._tree = tree
+        self._top_bit = 1 << (size.bit_length() - 1)
+        self._cursor: tuple[int, int] | None = None
+
+    def _add_to_index(self, chunk_index: int, delta: int) -> None:
+        if not delta:
+            return
+        tree = self._tree
+        position = chunk_index + 1
+        while position < len(tree):
+            tree[position] += delta
+            position += position & -position
+
+    def _locate(self, index: int) -> tuple[int, int]:
+        """Return the chunk holding line `index` and the line's offset in it."""
+        if self._cursor:
+            # Operations touch a few neighbouring lines, usually in one chunk
+            chunk_index, chunk_start = self._cursor
+            if 0 <= index - chunk_start < len(self._chunks[chunk_index]):
+                return chunk_index, index - chunk_start
+        tree = self._tree
+        size = len(tree) - 1
+        position = 0
+        remaining = index
+        bit = self._top_bit
+        while bit:
+            candidate = position + bit
+            if candidate <= size and tree[candidate] <= remaining:
+                position = candidate
+                remaining -= tree[candidate]
+            bit >>= 1
+        if position == size:
+            # Appending past the last line lands at the end of the last chunk
+            return size - 1, len(self._chunks[-1])
+        self._cursor = (position, index - remaining)
+        return position, remaining
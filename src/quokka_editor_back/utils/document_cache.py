@@ -0,0 +1,121 @@
+import sys
+import threading
+from collections import OrderedDict
+from collections.abc import MutableSequence
+from uuid import UUID
+
+from quokka_editor_back.utils.buffer import LineBuffer
+
+LINE_OVERHEAD = sys.getsizeof("") + 8
+
+
+def estimate_content_size(content: MutableSequence[str]) -> int:
+    if isinstance(content, LineBuffer):
+        char_count = content.char_count
+    else:
+        char_count = sum(map(len, content))
+    return char_count + len(content) * LINE_OVERHEAD
+
+
+class CachedDocument:
+    __slots__ = ("content", "last_revision", "generation", "size")
+
+    def __init__(
+        self, content: MutableSequence[str], last_revision: int, generation: int = 0
+    ):
+        self.content = content
+        self.last_revision = last_revision
+        self.generation = generation
+        self.size = estimate_content_size(content)
+
+
+class DocumentCache:
+    """
+    LRU cache of parsed document lines keyed by document id.
+
+    Entries are only served when their revision and content generation match
+    the `last_revision` and `content_generation` the caller has just read, so
+    a document changed behind the worker's back, by an operation or by its
+    content being replaced, is treated as a miss and dropped.
+    """
+
+    def __init__(self, max_documents: int, max_bytes: int):
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self._entries: OrderedDict[UUID, CachedDocument] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, document_id: UUID) -> bool:
+        return document_id in self._entries
+
+    def get(
+        self, document_id: UUID, last_revision: int, generation: int = 0
+    ) -> MutableSequence[str] | None:
+        with self._lock:
+            entry = self._entries.get(document_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.last_revision != last_revision or entry.generation != generation:
+                self._remove(document_id)
+                self.stale += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(document_id)
+            self.hits += 1
+            return entry.content
+
+    def put(
+        self,
+        document_id: UUID,
+        content: MutableSequence[str],
+        last_revision: int,
+        generation: int = 0,
+    ) -> None:
+        entry = CachedDocument(content, last_revision, generation)
+        with self._lock:
+            self._remove(document_id)
+            if self.max_documents <= 0 or entry.size > self.max_bytes:
+                return
+            self._entries[document_id] = entry
+            self.size += entry.size
+            self._evict()
+
+    def invalidate(self, document_id: UUID) -> None:
+        with self._lock:
+            self._remove(document_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "documents": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, document_id: UUID) -> None:
+        if entry := self._entries.pop(document_id, None):
+            self.size -= entry.size
+
+    def _evict(self) -> None:
+        while self._entries and (
+            len(self._entries) > self.max_documents or self.size > self.max_bytes
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
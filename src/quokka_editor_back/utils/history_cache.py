@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import OrderedDict
+from uuid import UUID
+
+from quokka_editor_back.models.operation import Op
+
+
+class DocumentHistory:
+    """Decoded operations from `base_revision + 1` up to the document head."""
+
+    __slots__ = ("base_revision", "ops", "bridges")
+
+    def __init__(self, base_revision: int, ops: list[Op]):
+        self.base_revision = base_revision
+        self.ops = ops
+        # base revision of every bridge served -> when it was last used
+        self.bridges: dict[int, float] = {}
+
+    @property
+    def head_revision(self) -> int:
+        return self.base_revision + len(self.ops)
+
+
+class HistoryCache:
+    """
+    Per-document cache of the operations lagging clients get rebased over.
+
+    A bridge is the slice of history from some base revision R to the head.
+    Clients that fall behind tend to sit at the same few revisions, so every
+    document keeps one contiguous run of decoded operations covering its
+    oldest live bridge; any bridge is then a slice of that run. The run is
+    extended in place as new operations are committed, and bridges unused
+    for `max_age` seconds are forgotten, letting the run shrink from the
+    front.
+    """
+
+    def __init__(self, max_documents: int, max_operations: int, max_age: float):
+        self.max_documents = max_documents
+        self.max_operations = max_operations
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[UUID, DocumentHistory] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, document_id: UUID) -> bool:
+        return document_id in self._entries
+
+    def bridge(
+        self, document_id: UUID, base_revision: int, head_revision: int
+    ) -> list[Op] | None:
+        """Return the operations after `base_revision`, if still cached."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(document_id)
+            if (
+                entry is None
+                or entry.head_revision != head_revision
+                or base_revision < entry.base_revision
+            ):
+                self.misses += 1
+                return None
+            entry.bridges[base_revision] = now
+            self._entries.move_to_end(document_id)
+            self.hits += 1
+            return entry.ops[base_revision - entry.base_revision :]
+
+    def store(self, document_id: UUID, base_revision: int, ops: list[Op]) -> None:
+        """Remember `ops`, the full history after `base_revision`."""
+        if not self._is_contiguous(base_revision, ops):
+            return
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(document_id)
+            if (
+                entry
+                and entry.base_revision <= base_revision
+                and entry.head_revision == base_revision + len(ops)
+            ):
+                entry.bridges[base_revision] = now
+                return
+            new_entry = DocumentHistory(base_revision, list(ops))
+            if entry and entry.head_revision == new_entry.head_revision:
+                new_entry.bridges.update(entry.bridges)
+            new_entry.bridges[base_revision] = now
+            self._entries[document_id] = new_entry
+            self._entries.move_to_end(document_id)
+            self._trim(new_entry)
+            while len(self._entries) > self.max_documents:
+                self._entries.popitem(last=False)
+
+    def extend(self, document_id: UUID, ops: list[Op]) -> None:
+        """Append freshly committed operations to the document's history."""
+        with self._lock:
+            entry = self._entries.get(document_id)
+            if entry is None or not ops:
+                return
+            if not self._is_contiguous(entry.head_revision, ops):
+                del self._entries[document_id]
+                return
+            entry.ops.extend(ops)
+            self._trim(entry)
+
+    def invalidate(self, document_id: UUID) -> None:
+        with self._lock:
+            self._entries.pop(document_id, None)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "documents": len(self._entries),
+            "operations": sum(len(entry.ops) for entry in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    @staticmethod
+    def _is_contiguous(base_revision: int, ops: list[Op]) -> bool:
+        return all(
+            op.revision == base_revision + offset
+            for offset, op in enumerate(ops, start=1)
+        )
+
+    def _expire(self, now: float) -> None:
+        for document_id, entry in list(self._entries.items()):
+            entry.bridges = {
+                base_revision: used_at
+                for base_revision, used_at in entry.bridges.items()
+                if now - used_at <= self.max_age
+            }
+            if not entry.bridges:
+                del self._entries[document_id]
+                continue
+            self._trim(entry)
+
+    def _trim(self, entry: DocumentHistory) -> None:
+        """Drop operations no live bridge needs, and cap the run's length."""
+        base_revision = max(
+            min(entry.bridges, default=entry.head_revision),
+            entry.head_revision - self.max_operations,
+        )
+        if base_revision > entry.base_revision:
+            del entry.ops[: base_revision - entry.base_revision]
+            entry.base_revision = base_revision
+            cut_off = [
+                used_at
+                for bridge, used_at in entry.bridges.items()
+                if bridge < base_revision
+            ]
+            entry.bridges = {
+                bridge: used_at
+                for bridge, used_at in entry.bridges.items()
+                if bridge >= base_revision
+            }
+            if cut_off:
+                # keep the capped run alive for as long as its clients are
+                entry.bridges[base_revision] = max(
+                    cut_off + [entry.bridges.get(base_revision, 0.0)]
+                )
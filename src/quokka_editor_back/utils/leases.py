@@ -0,0 +1,93 @@
+"""
+Lease on processing a document's operation queue.
+
+Whoever finds the queue unattended takes the lease with a fresh token and
+dispatches a worker, which renews it every ``document_lease_renew_interval``
+seconds while processing. A worker that dies leaves the lease to expire
+after ``document_lease_ttl`` seconds, and the sweeper dispatches the queue
+it left behind.
+"""
+import asyncio
+import logging
+from collections.abc import AsyncIterator
+from uuid import UUID, uuid4
+
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import LockError
+
+from quokka_editor_back.settings import settings
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS_KEY_PREFIX = "document_operations_"
+
+
+def operations_key(document_id: UUID | str) -> str:
+    return f"{OPERATIONS_KEY_PREFIX}{document_id}"
+
+
+def processing_key(document_id: UUID | str) -> str:
+    return f"document_processing_{document_id}"
+
+
+def new_lease_token() -> str:
+    return uuid4().hex
+
+
+def lease_ttl_ms() -> int:
+    return int(settings.document_lease_ttl * 1000)
+
+
+async def acquire_lease(
+    redis_client: AsyncRedis, document_id: UUID | str
+) -> str | None:
+    """Take the lease on an unattended queue, returning its token."""
+    token = new_lease_token()
+    key = processing_key(document_id)
+    if await redis_client.set(key, token, nx=True, px=lease_ttl_ms()):
+        return token
+    return None
+
+
+class DocumentLease:
+    """A lease taken with `token`, held by the worker processing the queue."""
+
+    def __init__(self, redis_client: AsyncRedis, document_id: UUID | str, token: str):
+        self.document_id = document_id
+        self.lock = redis_client.lock(
+            processing_key(document_id),
+            timeout=settings.document_lease_ttl,
+            thread_local=False,
+        )
+        self.lock.local.token = token.encode()
+        self.lost = False
+
+    async def held(self) -> bool:
+        self.lost = not await self.lock.owned()
+        return not self.lost
+
+    async def keep_alive(self) -> None:
+        while True:
+            await asyncio.sleep(settings.document_lease_renew_interval)
+            try:
+                await self.lock.extend(settings.document_lease_ttl, replace_ttl=True)
+            except LockError as err:
+                self.lost = True
+                logger.warning("Lost the lease on %s: %s", self.document_id, err)
+                return
+
+    async def release(self) -> None:
+        if self.lost:
+            return
+        try:
+            await self.lock.release()
+        except LockError as err:
+            logger.warning("Lease on %s expired early: %s", self.document_id, err)
+
+
+async def orphaned_documents(redis_client: AsyncRedis) -> AsyncIterator[str]:
+    """Yield the ids of documents with queued operations and no lease."""
+    async for key in redis_client.scan_iter(match=f"{OPERATIONS_KEY_PREFIX}*"):
+        document_id = key.decode().removeprefix(OPERATIONS_KEY_PREFIX)
+        if not await redis_client.exists(processing_key(document_id)):
+            yield document_id
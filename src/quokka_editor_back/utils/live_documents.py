@@ -0,0 +1,254 @@
+"""
+State of the documents being edited, kept in Redis and written behind to
+Postgres.
+
+With ``document_state_backend`` set to REDIS the worker commits operations to
+Redis only. The document's state hash holds its content and revision, and its
+log holds the operations not persisted yet, oldest first. Both are written in
+one transaction, so the hash always matches the tail of the log.
+
+The flusher persists every live document each ``live_document_flush_interval``
+seconds, and evicts those idle for ``live_document_idle_ttl``. A log found
+without its hash is replayed onto the persisted content instead.
+"""
+import asyncio
+import json
+import logging
+import time
+from uuid import UUID
+
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import WatchError
+from tortoise.exceptions import DoesNotExist
+from tortoise.transactions import in_transaction
+
+from quokka_editor_back.models.document import Document
+from quokka_editor_back.models.operation import Op, Operation
+from quokka_editor_back.schema.document import DocumentStateBackend
+from quokka_editor_back.settings import settings
+from quokka_editor_back.utils.buffer import LineBuffer
+from quokka_editor_back.utils.leases import processing_key
+from quokka_editor_back.utils.messages import encode_message
+from quokka_editor_back.utils.ot import apply_operation
+from quokka_editor_back.utils.redis import get_redis
+from quokka_editor_back.utils.snapshots import maybe_take_snapshot
+
+logger = logging.getLogger(__name__)
+
+LIVE_DOCUMENTS_KEY = "live_documents"
+FLUSH_LOCK_TTL = 60
+
+
+def is_live_backend() -> bool:
+    return settings.document_state_backend == DocumentStateBackend.REDIS
+
+
+def live_state_key(document_id: UUID | str) -> str:
+    return f"document_state_{document_id}"
+
+
+def live_log_key(document_id: UUID | str) -> str:
+    return f"document_log_{document_id}"
+
+
+def flush_lock_key(document_id: UUID | str) -> str:
+    return f"document_flushing_{document_id}"
+
+
+def encode_log_entry(op: Op, user_token: str | None) -> str:
+    return encode_message({**op.to_dict(), "user_token": user_token})
+
+
+def decode_log_entry(entry: bytes) -> tuple[str | None, Op]:
+    data = json.loads(entry)
+    return data["user_token"], Op.from_dict(data)
+
+
+async def save_live_operations(
+    redis_client: AsyncRedis,
+    document_id: UUID,
+    ops: list[Op],
+    user_tokens: list[str | None],
+    content: bytes,
+) -> None:
+    pipeline = redis_client.pipeline(transaction=True)
+    pipeline.hset(
+        live_state_key(document_id),
+        mapping={
+            "content": content,
+            "revision": ops[-1].revision,
+            "updated_at": time.time(),
+        },
+    )
+    pipeline.rpush(
+        live_log_key(document_id),
+        *[encode_log_entry(op, user_token) for op, user_token in zip(ops, user_tokens)],
+    )
+    pipeline.sadd(LIVE_DOCUMENTS_KEY, str(document_id))
+    await pipeline.execute()
+
+
+async def load_live_document(redis_client: AsyncRedis, document: Document) -> Document:
+    """Bring the persisted `document` up to its live content and revision."""
+    content, revision = await redis_client.hmget(
+        live_state_key(document.id), "content", "revision"
+    )
+    if content is not None:
+        document.content, document.last_revision = content, int(revision)
+        return document
+    if await redis_client.llen(live_log_key(document.id)):
+        await flush_live_document(redis_client, document.id)
+    # The row may have been read before the document was flushed and evicted
+    await document.refresh_from_db(fields=["content", "last_revision"])
+    return document
+
+
+async def load_live_changes(
+    redis_client: AsyncRedis,
+    document_id: UUID,
+    after_revision: int,
+    up_to_revision: int | None = None,
+) -> list[tuple[str | None, Op]]:
+    """Like ``Operation.load_changes``, with the operations not persisted yet."""
+    # The log is read first: whatever the flusher trims from it meanwhile has
+    # already been committed to Postgres
+    logged = [
+        decode_log_entry(entry)
+        for entry in await redis_client.lrange(live_log_key(document_id), 0, -1)
+    ]
+    changes: list[tuple[str | None, Op]] = []
+    first_logged = logged[0][1].revision if logged else None
+    if first_logged is None or after_revision + 1 < first_logged:
+        persisted_up_to = up_to_revision
+        if first_logged is not None and (
+            up_to_revision is None or up_to_revision >= first_logged
+        ):
+            persisted_up_to = first_logged - 1
+        changes = await Operation.load_changes(
+            document_id, after_revision, persisted_up_to
+        )
+    changes.extend(
+        (user_token, op)
+        for user_token, op in logged
+        if op.revision > after_revision
+        and (up_to_revision is None or op.revision <= up_to_revision)
+    )
+    return changes
+
+
+async def flush_live_document(
+    redis_client: AsyncRedis, document_id: UUID
+) -> int | None:
+    """
+    Persist the operations logged for the document and its content.
+
+    Returns the revision persisted, or None when there was nothing to flush
+    or another flusher holds the document.
+    """
+    lock = flush_lock_key(document_id)
+    if not await redis_client.set(lock, 1, nx=True, ex=FLUSH_LOCK_TTL):
+        return None
+    try:
+        return await persist_live_document(redis_client, document_id)
+    finally:
+        await redis_client.delete(lock)
+
+
+async def persist_live_document(
+    redis_client: AsyncRedis, document_id: UUID
+) -> int | None:
+    log_key = live_log_key(document_id)
+    pipeline = redis_client.pipeline(transaction=True)
+    pipeline.lrange(log_key, 0, -1)
+    pipeline.hmget(live_state_key(document_id), "content", "revision")
+    entries, (content, revision) = await pipeline.execute()
+    if not entries:
+        return None
+    try:
+        document = await Document.get(id=document_id)
+    except DoesNotExist:
+        await drop_live_document(redis_client, document_id)
+        return None
+
+    # Entries persisted before a crash cut the flush short are skipped
+    changes = [
+        (user_token, op)
+        for user_token, op in map(decode_log_entry, entries)
+        if op.revision > document.last_revision
+    ]
+    if changes:
+        last_revision = changes[-1][1].revision
+        if revision is None or int(revision) != last_revision:
+            lines = LineBuffer(json.loads((document.content or b"[]").decode()))
+            for _, op in changes:
+                apply_operation(lines, op)
+            content = json.dumps(list(lines)).encode()
+        async with in_transaction():
+            await Operation.bulk_create(
+                [
+                    Operation.from_op(document_id, op, user_token)
+                    for user_token, op in changes
+                ]
+            )
+            document.update_from_dict(
+                {"content": content, "last_revision": last_revision}
+            )
+            await document.save(update_fields=["content", "last_revision"])
+        await maybe_take_snapshot(document, content, last_revision)
+    await redis_client.ltrim(log_key, len(entries), -1)
+    return document.last_revision
+
+
+async def evict_live_document(redis_client: AsyncRedis, document_id: UUID) -> bool:
+    """
+    Flush the document and drop its live state, unless it changed meanwhile
+    or a worker is processing its operations.
+    """
+    await flush_live_document(redis_client, document_id)
+    log_key, state_key = live_log_key(document_id), live_state_key(document_id)
+    lease_key = processing_key(document_id)
+    async with redis_client.pipeline(transaction=True) as pipeline:
+        try:
+            await pipeline.watch(log_key, state_key, lease_key)
+            if await pipeline.exists(lease_key) or await pipeline.llen(log_key):
+                return False
+            pipeline.multi()
+            pipeline.delete(state_key)
+            pipeline.srem(LIVE_DOCUMENTS_KEY, str(document_id))
+            await pipeline.execute()
+        except WatchError:
+            return False
+    return True
+
+
+async def drop_live_document(redis_client: AsyncRedis, document_id: UUID) -> None:
+    pipeline = redis_client.pipeline(transaction=True)
+    pipeline.delete(live_state_key(document_id), live_log_key(document_id))
+    pipeline.srem(LIVE_DOCUMENTS_KEY, str(document_id))
+    await pipeline.execute()
+
+
+async def flush_live_documents(redis_client: AsyncRedis) -> None:
+    idle_since = time.time() - settings.live_document_idle_ttl
+    for member in await redis_client.smembers(LIVE_DOCUMENTS_KEY):
+        document_id = UUID(member.decode())
+        try:
+            updated_at = await redis_client.hget(
+                live_state_key(document_id), "updated_at"
+            )
+            if updated_at is None or float(updated_at) < idle_since:
+                await evict_live_document(redis_client, document_id)
+            else:
+                await flush_live_document(redis_client, document_id)
+        except Exception as err:
+            logger.warning("Flushing document %s failed: %s", document_id, err)
+
+
+async def run_flusher() -> None:
+    while True:
+        await asyncio.sleep(settings.live_document_flush_interval)
+        redis_client = await get_redis()
+        try:
+            await flush_live_documents(redis_client)
+        finally:
+            await redis_client.close()
@@ -0,0 +1,59 @@
+import json
+
+from quokka_editor_back.models.operation import Op
+from quokka_editor_back.schema.websocket import MessageTypeEnum
+
+
+def change_message(user_token: str | None, op: Op) -> dict:
+    return {
+        "data": op.to_dict(),
+        "type": MessageTypeEnum.EXT_CHANGE,
+        "user_token": user_token,
+        "revision": op.revision,
+    }
+
+
+def encode_message(message: dict | list) -> str:
+    """Serialize a websocket message the way ``WebSocket.send_json`` does."""
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+def pack_message(
+    user_token: str, revision: int, payload: str, first_revision: int | None = None
+) -> str:
+    """
+    Prefix an encoded operation message with its routing header.
+
+    Subscribers only need the author and revision to decide between an ack
+    and a broadcast, so they can read the header and forward `payload` as is.
+    A batch of operations carries its revision range as ``first-last``.
+    """
+    if first_revision is not None:
+        return f"{user_token} {first_revision}-{revision}\n{payload}"
+    return f"{user_token} {revision}\n{payload}"
+
+
+def unpack_message(data: bytes) -> tuple[str, int, int, str]:
+    """Split a packed message into author, first and last revision, payload."""
+    header, _, payload = data.decode("utf-8").partition("\n")
+    user_token, _, revisions = header.partition(" ")
+    first_revision, _, revision = revisions.partition("-")
+    return user_token, int(first_revision), int(revision or first_revision), payload
+
+
+# Operation headers start with the author's token, which never starts with it
+EVENT_PREFIX = "!"
+
+
+def pack_event(event: str, payload: str) -> str:
+    """Frame a presence or cursor event for the document channel."""
+    return f"{EVENT_PREFIX}{event}\n{payload}"
+
+
+def is_event(data: bytes) -> bool:
+    return data.startswith(EVENT_PREFIX.encode())
+
+
+def unpack_event(data: bytes) -> tuple[str, str]:
+    header, _, payload = data.decode("utf-8").partition("\n")
+    return header.removeprefix(EVENT_PREFIX), payload
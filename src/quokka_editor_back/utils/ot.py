@@ -1,85 +1,163 @@
+import bisect
 import logging
+from collections.abc import Iterable, MutableSequence, Sequence
+from operator import attrgetter
 
-from quokka_editor_back.models.operation import (
-    OperationSchema,
-    OperationType,
-    PosSchema,
-)
+from quokka_editor_back.models.operation import Op, OperationType
 
 logger = logging.getLogger(__name__)
 
+INSERT_TYPES = frozenset((OperationType.INPUT, OperationType.PASTE, OperationType.UNDO))
+
+get_revision = attrgetter("revision")
 
-def adjust_position(
-    new_pos: PosSchema, prev_pos: PosSchema, prev_text: str
-) -> PosSchema:
-    if (
-        new_pos.line < prev_pos.line
-        or (new_pos.line == prev_pos.line and new_pos.ch < prev_pos.ch)
-        or (new_pos.line > prev_pos.line)
-    ):
-        return new_pos
-    return PosSchema(
-        line=new_pos.line,
-        ch=new_pos.ch + len(prev_text),
-    )
 
+def adjust_ch(line: int, ch: int, prev_line: int, prev_ch: int, prev_text: str) -> int:
+    if line == prev_line and ch >= prev_ch:
+        return ch + len(prev_text)
+    return ch
 
-def transform(new_op: OperationSchema, prev_op: OperationSchema) -> OperationSchema:
-    input_add_types = (OperationType.INPUT, OperationType.PASTE, OperationType.UNDO)
-    if new_op.type in input_add_types and prev_op.type in input_add_types:
-        adjusted_from_pos = adjust_position(
-            new_op.from_pos, prev_op.from_pos, prev_op.text[0]
+
+def transform(new_op: Op, prev_op: Op) -> Op | None:
+    if new_op.type in INSERT_TYPES and prev_op.type in INSERT_TYPES:
+        prev_text = prev_op.text[0]
+        from_ch = adjust_ch(
+            new_op.from_line,
+            new_op.from_ch,
+            prev_op.from_line,
+            prev_op.from_ch,
+            prev_text,
         )
-        adjusted_to_pos = adjust_position(
-            new_op.to_pos, prev_op.to_pos, prev_op.text[0]
+        to_ch = adjust_ch(
+            new_op.to_line, new_op.to_ch, prev_op.to_line, prev_op.to_ch, prev_text
         )
-        return OperationSchema(
-            from_pos=adjusted_from_pos,
-            to_pos=adjusted_to_pos,
-            text=new_op.text,
-            type=new_op.type,
-            revision=new_op.revision,
+        if from_ch == new_op.from_ch and to_ch == new_op.to_ch:
+            return new_op
+        return Op(
+            new_op.from_line,
+            from_ch,
+            new_op.to_line,
+            to_ch,
+            new_op.text,
+            new_op.type,
+            new_op.revision,
         )
 
-    if new_op.type in input_add_types and prev_op.type == OperationType.DELETE:
-        if new_op.from_pos.line < prev_op.from_pos.line or (
-            new_op.from_pos.line == prev_op.from_pos.line
-            and new_op.from_pos.ch <= prev_op.from_pos.ch
+    if new_op.type in INSERT_TYPES and prev_op.type == OperationType.DELETE:
+        if new_op.from_line < prev_op.from_line or (
+            new_op.from_line == prev_op.from_line and new_op.from_ch <= prev_op.from_ch
         ):
             return new_op
-        return OperationSchema(
-            from_pos=PosSchema(line=new_op.from_pos.line - 1, ch=new_op.from_pos.ch),
-            to_pos=new_op.to_pos,
-            text=new_op.text,
-            type=new_op.type,
-            revision=new_op.revision,
+        return Op(
+            new_op.from_line - 1,
+            new_op.from_ch,
+            new_op.to_line,
+            new_op.to_ch,
+            new_op.text,
+            new_op.type,
+            new_op.revision,
         )
 
-    if new_op.type == OperationType.DELETE and prev_op.type in input_add_types:
-        adjusted_from_pos = adjust_position(
-            new_op.from_pos, prev_op.from_pos, prev_text=prev_op.text[0]
+    if new_op.type == OperationType.DELETE and prev_op.type in INSERT_TYPES:
+        from_ch = adjust_ch(
+            new_op.from_line,
+            new_op.from_ch,
+            prev_op.from_line,
+            prev_op.from_ch,
+            prev_op.text[0],
         )
-        return OperationSchema(
-            from_pos=adjusted_from_pos,
-            to_pos=new_op.to_pos,
-            text=new_op.text,
-            type=OperationType.DELETE,
-            revision=new_op.revision,
+        if from_ch == new_op.from_ch:
+            return new_op
+        return Op(
+            new_op.from_line,
+            from_ch,
+            new_op.to_line,
+            new_op.to_ch,
+            new_op.text,
+            OperationType.DELETE,
+            new_op.revision,
         )
 
     if new_op.type == OperationType.DELETE and prev_op.type == OperationType.DELETE:
         return new_op
 
 
-def apply_operation(document_content: list[str], op: OperationSchema) -> list[str]:
-    start_line, start_ch = op.from_pos.line, op.from_pos.ch
-    end_line, end_ch = op.to_pos.line, op.to_pos.ch
+def transform_many(op: Op, history: Iterable[Op]) -> Op | None:
+    """Rebase `op` over already decoded history operations, oldest first."""
+    for prev_op in history:
+        op = transform(op, prev_op)
+        if op is None:
+            return None
+    return op
+
+
+def rebase_batch(
+    ops: Sequence[Op],
+    history: Sequence[Op],
+    head_revision: int,
+    groups: Sequence[int] | None = None,
+) -> list[Op | None]:
+    """
+    Rebase queued operations onto `head_revision` and number them after it.
+
+    Every operation is transformed against the `history` newer than its own
+    base revision, then against the queued operations rebased before it, as
+    if they had been committed one at a time. The history is walked once for
+    the whole batch, but each operation is still transformed against every
+    history entry newer than its base revision; only the iteration and the
+    history load are shared. `history` must be sorted by revision.
+
+    Operations sharing a `groups` entry were composed one after another by a
+    single client, so they are not transformed against each other.
+    """
+    rebased: list[Op | None] = list(ops)
+    by_base_revision = sorted(range(len(ops)), key=lambda index: ops[index].revision)
+    active = 0
+    start = bisect.bisect_right(
+        history, min((op.revision for op in ops), default=0), key=get_revision
+    )
+    for prev_op in history[start:]:
+        while (
+            active < len(by_base_revision)
+            and ops[by_base_revision[active]].revision < prev_op.revision
+        ):
+            active += 1
+        for index in by_base_revision[:active]:
+            if op := rebased[index]:
+                rebased[index] = transform(op, prev_op)
+
+    committed: list[Op] = []
+    committed_groups: list[int | None] = []
+    for index, op in enumerate(rebased):
+        group = groups[index] if groups else None
+        if op:
+            op = transform_many(
+                op,
+                (
+                    prev_op
+                    for prev_op, prev_group in zip(committed, committed_groups)
+                    if group is None or prev_group != group
+                ),
+            )
+        if op:
+            op = op._replace(revision=head_revision + len(committed) + 1)
+            committed.append(op)
+            committed_groups.append(group)
+        rebased[index] = op
+    return rebased
+
+
+def apply_operation(
+    document_content: MutableSequence[str], op: Op
+) -> MutableSequence[str]:
+    start_line, start_ch = op.from_line, op.from_ch
+    end_line, end_ch = op.to_line, op.to_ch
 
     before = document_content[start_line][:start_ch]
     middle = op.text
     after = document_content[end_line][end_ch:]
     combined = []
-    if op.type in (OperationType.INPUT, OperationType.PASTE, OperationType.UNDO):
+    if op.type in INSERT_TYPES:
         if len(middle) == 2:
             combined = [before + middle[0]] + [middle[-1] + after]
         elif len(middle) > 2:
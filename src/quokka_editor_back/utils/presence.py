@@ -0,0 +1,72 @@
+"""
+Who is connected to a document, across every websocket process.
+
+Each connection is a field of the document's presence hash, holding its
+user data and the time of its last heartbeat. Processes refresh their own
+connections every ``presence_heartbeat_interval`` seconds. A field whose
+heartbeat is older than ``presence_ttl`` was left behind by a process that
+died, and the next reader removes it. The whole hash expires with the last
+heartbeat of the document.
+"""
+import json
+import time
+from uuid import UUID
+
+from redis.asyncio import Redis as AsyncRedis
+
+from quokka_editor_back.settings import settings
+
+
+def presence_key(document_id: UUID | str) -> str:
+    return f"document_presence_{document_id}"
+
+
+def encode_presence(data: dict) -> str:
+    return json.dumps({**data, "seen_at": time.time()})
+
+
+async def join_presence(
+    redis_client: AsyncRedis, document_id: UUID, connection_id: str, data: dict
+) -> None:
+    await refresh_presence(redis_client, document_id, {connection_id: data})
+
+
+async def leave_presence(
+    redis_client: AsyncRedis, document_id: UUID, connection_id: str
+) -> None:
+    await redis_client.hdel(presence_key(document_id), connection_id)
+
+
+async def refresh_presence(
+    redis_client: AsyncRedis, document_id: UUID, connections: dict[str, dict]
+) -> None:
+    if not connections:
+        return
+    key = presence_key(document_id)
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.hset(
+        key,
+        mapping={
+            connection_id: encode_presence(data)
+            for connection_id, data in connections.items()
+        },
+    )
+    pipeline.expire(key, int(settings.presence_ttl))
+    await pipeline.execute()
+
+
+async def load_presence(redis_client: AsyncRedis, document_id: UUID) -> dict[str, dict]:
+    """Return the live connections of the document, keyed by connection id."""
+    key = presence_key(document_id)
+    deadline = time.time() - settings.presence_ttl
+    members: dict[str, dict] = {}
+    expired: list[bytes] = []
+    for connection_id, value in (await redis_client.hgetall(key)).items():
+        data = json.loads(value)
+        if data.pop("seen_at") < deadline:
+            expired.append(connection_id)
+        else:
+            members[connection_id.decode()] = data
+    if expired:
+        await redis_client.hdel(key, *expired)
+    return members
@@ -0,0 +1,125 @@
+"""
+Wire encodings of the document websocket.
+
+JSON text frames are the default. A client can negotiate MessagePack binary
+frames with the ``quokka.msgpack`` subprotocol or ``?protocol=msgpack``.
+MessagePack frames carry the same messages as JSON, with two compactions
+applied in both directions:
+
+* a ``from_pos``/``to_pos`` position travels as ``[line, ch]``;
+* an operation travels as ``[from_line, from_ch, to_line, to_ch, text, type,
+  revision]``, both as a client's own message and as ``data`` of EXT_CHANGE.
+
+In both protocols a client may send a batch of operations as an array, all
+based on the same revision and each applied after the ones before it. The
+batch is broadcast back as an array of EXT_CHANGE messages and acknowledged
+once, with the revision range it was committed as.
+"""
+import json
+from collections.abc import Iterable
+
+import msgpack
+
+from quokka_editor_back.schema.websocket import WireProtocol
+from quokka_editor_back.utils.messages import encode_message
+
+SUBPROTOCOLS = {
+    "quokka.json": WireProtocol.JSON,
+    "quokka.msgpack": WireProtocol.MSGPACK,
+}
+POSITION_KEYS = frozenset(("from_pos", "to_pos"))
+OPERATION_KEYS = frozenset(("from_pos", "to_pos", "text", "type", "revision"))
+
+Frame = str | bytes
+
+
+def negotiate_protocol(
+    offered_subprotocols: Iterable[str], requested: WireProtocol | None = None
+) -> tuple[WireProtocol, str | None]:
+    """Pick the wire protocol, and the subprotocol to accept the socket with."""
+    for subprotocol in offered_subprotocols:
+        if subprotocol in SUBPROTOCOLS:
+            return SUBPROTOCOLS[subprotocol], subprotocol
+    return requested or WireProtocol.JSON, None
+
+
+def compact(value):
+    if isinstance(value, dict):
+        if value.keys() == OPERATION_KEYS:
+            return [
+                *compact_position(value["from_pos"]),
+                *compact_position(value["to_pos"]),
+                value["text"],
+                value["type"],
+                value["revision"],
+            ]
+        return {
+            key: compact_position(item) if key in POSITION_KEYS else compact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [compact(item) for item in value]
+    return value
+
+
+def compact_position(position: dict) -> list[int]:
+    return [position["line"], position["ch"]]
+
+
+def expand(value):
+    if isinstance(value, list):
+        if value and isinstance(value[0], list | dict):
+            return [expand(item) for item in value]
+        from_line, from_ch, to_line, to_ch, text, type, revision = value
+        return {
+            "from_pos": {"line": from_line, "ch": from_ch},
+            "to_pos": {"line": to_line, "ch": to_ch},
+            "text": text,
+            "type": type,
+            "revision": revision,
+        }
+    if isinstance(value, dict):
+        return expand_positions(value)
+    return value
+
+
+def expand_positions(value: dict) -> dict:
+    expanded = {}
+    for key, item in value.items():
+        if key in POSITION_KEYS and isinstance(item, list):
+            item = {"line": item[0], "ch": item[1]}
+        elif isinstance(item, dict):
+            item = expand_positions(item)
+        expanded[key] = item
+    return expanded
+
+
+def encode_frame(message: dict | list | str, protocol: WireProtocol) -> Frame:
+    """Encode a message, or already encoded JSON text, for `protocol`."""
+    if protocol == WireProtocol.MSGPACK:
+        if isinstance(message, str):
+            message = json.loads(message)
+        return msgpack.packb(compact(message))
+    return message if isinstance(message, str) else encode_message(message)
+
+
+def decode_frame(data: Frame, protocol: WireProtocol) -> dict | list[dict]:
+    """Decode a client's frame into the JSON message shape."""
+    if protocol == WireProtocol.MSGPACK:
+        return expand(msgpack.unpackb(data))
+    return json.loads(data)
+
+
+class EncodedMessage:
+    """A message encoded lazily, and at most once, per wire protocol."""
+
+    __slots__ = ("message", "_frames")
+
+    def __init__(self, message: dict | list | str):
+        self.message = message
+        self._frames: dict[WireProtocol, Frame] = {}
+
+    def frame(self, protocol: WireProtocol) -> Frame:
+        if (frame := self._frames.get(protocol)) is None:
+            frame = self._frames[protocol] = encode_frame(self.message, protocol)
+        return frame
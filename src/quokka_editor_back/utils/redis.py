@@ -1,6 +1,62 @@
-from redis.asyncio import Redis
+import asyncio
+from uuid import UUID
+
+from redis.asyncio import BlockingConnectionPool, ConnectionPool, Redis
+
+from quokka_editor_back.settings import settings
+
+# Pooled connections are bound to the event loop that opened them
+_pools: dict[asyncio.AbstractEventLoop | None, ConnectionPool] = {}
+
+
+def running_loop() -> asyncio.AbstractEventLoop | None:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def redis_pool() -> ConnectionPool:
+    """
+    Return the running event loop's connection pool, creating it on first use.
+
+    The API runs one loop and so shares one pool per process. Every document
+    listener holds a connection, so a full pool waits for one to be released
+    instead of failing.
+    """
+    loop = running_loop()
+    if (pool := _pools.get(loop)) is None:
+        pool = _pools[loop] = BlockingConnectionPool(
+            host=settings.redis_host,
+            port=settings.redis_port,
+            password=settings.redis_password,
+            max_connections=settings.redis_pool_size,
+            timeout=settings.redis_pool_timeout,
+        )
+    return pool
+
+
+async def close_redis_pool() -> None:
+    if (pool := _pools.pop(running_loop(), None)) is not None:
+        await pool.disconnect()
+
+
+def redis_pool_stats() -> dict[str, int]:
+    pool = redis_pool()
+    in_use, available = len(pool._in_use_connections), len(pool._available_connections)
+    return {
+        "max_connections": pool.max_connections,
+        "created": in_use + available,
+        "in_use": in_use,
+        "available": available,
+    }
 
 
 async def get_redis() -> Redis:
-    redis = await Redis(host="redis", port=6379)
-    return redis
+    # Clients built on a shared pool only hand their connection back on close
+    return Redis(connection_pool=redis_pool())
+
+
+def document_channel(document_id: UUID | str) -> str:
+    """Pub/sub channel carrying every committed operation of a document."""
+    return f"document_{document_id}"
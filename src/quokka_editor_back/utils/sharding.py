@@ -0,0 +1,122 @@
+"""
+Pinning documents to worker slots.
+
+Each worker process claims a free slot at boot, holds it with a heartbeat
+while it runs and consumes the queue of its slot. Documents are spread over
+the live slots by consistent hashing on their id, so a worker joining or
+leaving only moves the documents it takes over or gives up, and the rest stay
+with the worker whose caches are warm for them.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from bisect import bisect
+from collections.abc import Iterable
+
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio.lock import Lock
+from redis.exceptions import LockError
+
+from quokka_editor_back.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+def slot_key(slot: int) -> str:
+    return f"worker_slot_{slot}"
+
+
+def slot_queue(slot: int) -> str:
+    return f"documents-{slot}"
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest())
+
+
+class HashRing:
+    """Consistent hashing ring with `replicas` points per slot."""
+
+    def __init__(self, slots: Iterable[int], replicas: int):
+        self.slots = frozenset(slots)
+        points = sorted(
+            (ring_hash(f"{slot}:{replica}"), slot)
+            for slot in self.slots
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._slots = [slot for _, slot in points]
+
+    def slot_for(self, key: str) -> int | None:
+        if not self._slots:
+            return None
+        index = bisect(self._hashes, ring_hash(key)) % len(self._slots)
+        return self._slots[index]
+
+
+async def live_slots(redis_client: AsyncRedis) -> list[int]:
+    held = await redis_client.mget(
+        [slot_key(slot) for slot in range(settings.worker_slots)]
+    )
+    return [slot for slot, token in enumerate(held) if token is not None]
+
+
+class ShardRouter:
+    """Routes documents over the live slots, re-read every `refresh_interval`."""
+
+    def __init__(self, refresh_interval: float | None = None):
+        self.refresh_interval = refresh_interval or settings.worker_slot_ttl / 3
+        self.ring = HashRing((), settings.shard_ring_replicas)
+        self.refreshed_at = float("-inf")
+
+    async def queue_for(self, redis_client: AsyncRedis, document_id: str) -> str | None:
+        if time.monotonic() - self.refreshed_at >= self.refresh_interval:
+            slots = await live_slots(redis_client)
+            if frozenset(slots) != self.ring.slots:
+                logger.info("Rebalancing documents over worker slots %s", slots)
+                self.ring = HashRing(slots, settings.shard_ring_replicas)
+            self.refreshed_at = time.monotonic()
+        slot = self.ring.slot_for(document_id)
+        return None if slot is None else slot_queue(slot)
+
+
+class WorkerSlot:
+    """The slot claimed by this worker process."""
+
+    def __init__(self, redis_client: AsyncRedis):
+        self.redis_client = redis_client
+        self.slot: int | None = None
+        self.lock: Lock | None = None
+
+    async def claim(self) -> int | None:
+        for slot in range(settings.worker_slots):
+            lock = self.redis_client.lock(
+                slot_key(slot), timeout=settings.worker_slot_ttl, thread_local=False
+            )
+            if await lock.acquire(blocking=False):
+                self.slot, self.lock = slot, lock
+                return slot
+        return None
+
+    async def keep_alive(self) -> int:
+        """Renew the slot until another worker takes it over, and return it."""
+        while True:
+            await asyncio.sleep(settings.worker_slot_ttl / 3)
+            try:
+                await self.lock.extend(settings.worker_slot_ttl, replace_ttl=True)
+            except LockError:
+                token = self.lock.local.token
+                if not await self.lock.acquire(blocking=False, token=token):
+                    logger.error("Worker slot %s was taken over", self.slot)
+                    lost, self.slot, self.lock = self.slot, None, None
+                    return lost
+
+    async def release(self) -> None:
+        try:
+            if self.lock is not None:
+                await self.lock.release()
+        except LockError as err:
+            logger.warning("Worker slot %s expired early: %s", self.slot, err)
+        finally:
+            await self.redis_client.close()
@@ -0,0 +1,120 @@
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import NamedTuple
+from uuid import UUID
+
+from tortoise import timezone
+
+from quokka_editor_back.models.document import Document, DocumentSnapshot
+from quokka_editor_back.models.operation import Operation
+from quokka_editor_back.settings import settings
+from quokka_editor_back.utils.buffer import LineBuffer
+from quokka_editor_back.utils.ot import apply_operation
+
+
+async def take_snapshot(
+    document: Document, content: bytes | None, revision: int
+) -> DocumentSnapshot:
+    snapshot, _ = await DocumentSnapshot.update_or_create(
+        defaults={"content": content, "updated_at": timezone.now()},
+        document_id=document.id,
+        revision=revision,
+    )
+    return snapshot
+
+
+class SnapshotMark(NamedTuple):
+    revision: int
+    created_at: datetime
+
+
+class SnapshotMarks:
+    """
+    LRU record of the newest snapshot this process has seen of each document.
+
+    A mark can only be older than the real newest snapshot, since another
+    worker may have taken one since; so a mark saying no snapshot is due is
+    trusted, and only one saying it is due is checked against the database.
+    """
+
+    def __init__(self, max_documents: int):
+        self.max_documents = max_documents
+        self._entries: OrderedDict[UUID, SnapshotMark] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, document_id: UUID) -> SnapshotMark | None:
+        with self._lock:
+            mark = self._entries.get(document_id)
+            if mark is not None:
+                self._entries.move_to_end(document_id)
+            return mark
+
+    def put(self, document_id: UUID, snapshot: DocumentSnapshot) -> None:
+        with self._lock:
+            self._entries[document_id] = SnapshotMark(
+                snapshot.revision, snapshot.created_at
+            )
+            self._entries.move_to_end(document_id)
+            while len(self._entries) > self.max_documents:
+                self._entries.popitem(last=False)
+
+
+snapshot_marks = SnapshotMarks(max_documents=settings.snapshot_marks_max_documents)
+
+
+def is_snapshot_due(
+    last_snapshot: DocumentSnapshot | SnapshotMark | None, revision: int
+) -> bool:
+    if last_snapshot is None:
+        return True
+    return (
+        revision - last_snapshot.revision >= settings.snapshot_interval_revisions
+        or (timezone.now() - last_snapshot.created_at).total_seconds()
+        >= settings.snapshot_interval_seconds
+    )
+
+
+async def maybe_take_snapshot(
+    document: Document, content: bytes | None, revision: int
+) -> DocumentSnapshot | None:
+    """Snapshot `content` every K revisions or T seconds of activity."""
+    mark = snapshot_marks.get(document.id)
+    if mark is not None and not is_snapshot_due(mark, revision):
+        return None
+    last_snapshot = (
+        await DocumentSnapshot.filter(document_id=document.id)
+        .order_by("-revision")
+        .first()
+    )
+    if not is_snapshot_due(last_snapshot, revision):
+        snapshot_marks.put(document.id, last_snapshot)
+        return None
+    snapshot = await take_snapshot(document, content, revision)
+    snapshot_marks.put(document.id, snapshot)
+    return snapshot
+
+
+async def load_document_at(document: Document, revision: int) -> LineBuffer | None:
+    """
+    Rebuild the document content as of `revision`.
+
+    Starts from the newest snapshot at or before `revision` and replays only
+    the operations committed after it. Returns None when no snapshot is old
+    enough to replay from.
+    """
+    snapshot = (
+        await DocumentSnapshot.filter(document_id=document.id, revision__lte=revision)
+        .order_by("-revision")
+        .first()
+    )
+    if snapshot is None:
+        return None
+    content = LineBuffer(json.loads((snapshot.content or b"[]").decode()))
+    for op in await Operation.load_ops(document.id, snapshot.revision, revision):
+        apply_operation(content, op)
+    return content